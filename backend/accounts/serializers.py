@@ -14,6 +14,21 @@ from django.contrib.auth.hashers import check_password
 
 
 User = get_user_model()
+
+
+def issue_tokens(user):
+    """Refresh token for a user, carrying the claims WebSocket auth reads without a DB hit.
+
+    Claims on the refresh token are copied into every access token minted from it:
+    `username` names the TokenUser, and `sid` (the refresh token's jti) lets a
+    blacklisted refresh token revoke its access tokens too.
+    """
+    refresh = RefreshToken.for_user(user)
+    refresh["username"] = user.username
+    refresh["sid"] = refresh["jti"]
+    return refresh
+
+
 class RegisterSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, required=True, validators=[validate_password])
     password2 = serializers.CharField(write_only=True, required=True)
@@ -63,7 +78,7 @@ class LoginSerializer(serializers.Serializer):
             raise serializers.ValidationError("Invalid email or password")
         
         # Generate tokens
-        refresh = RefreshToken.for_user(user)
+        refresh = issue_tokens(user)
 
         return {
             "access": str(refresh.access_token),
@@ -12,14 +12,16 @@ django_asgi_app = get_asgi_application()
 
 # Now import your routing after Django setup
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
 import chats.routing
+from chats.lifespan import lifespan_app
+from chats.middleware import JWTAuthMiddlewareStack
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
+    "lifespan": lifespan_app,
     "websocket": AllowedHostsOriginValidator(
-        AuthMiddlewareStack(
+        JWTAuthMiddlewareStack(
             URLRouter(
                 chats.routing.websocket_urlpatterns
             )
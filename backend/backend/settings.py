@@ -66,13 +66,52 @@ TEMPLATES = [
 ASGI_APPLICATION = 'backend.asgi.application'
 WSGI_APPLICATION = 'backend.wsgi.application'  # Keep for HTTP
 
-# Database
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# Database: SQLite unless DB_ENGINE=postgres (the production profile).
+# Consumer queries run on CHAT_DB_THREADS threads (see chats/db.py; 0 keeps channels'
+# single shared thread). With DB_POOL on, connections are borrowed per query from a
+# pool of DB_POOL_SIZE that stays open between them (chats/backends/postgresql_pool);
+# size it for the consumer threads plus concurrent HTTP requests. DB_CONN_MAX_AGE
+# is then the age at which pooled connections are replaced. With DB_POOL off it is
+# Django's CONN_MAX_AGE, which suits a WSGI deployment under gunicorn.
+DB_ENGINE = config('DB_ENGINE', default='sqlite')
+CHAT_DB_THREADS = config('CHAT_DB_THREADS', default=8 if DB_ENGINE == 'postgres' else 0, cast=int)
+
+if DB_ENGINE == 'postgres':
+    DB_POOL = config('DB_POOL', default=True, cast=bool)
+    DB_CONN_MAX_AGE = config('DB_CONN_MAX_AGE', default=600, cast=int)
+    DATABASES = {
+        'default': {
+            'ENGINE': 'chats.backends.postgresql_pool' if DB_POOL else 'django.db.backends.postgresql',
+            'NAME': config('DB_NAME', default='chat'),
+            'USER': config('DB_USER', default='chat'),
+            'PASSWORD': config('DB_PASSWORD', default=''),
+            'HOST': config('DB_HOST', default='127.0.0.1'),
+            'PORT': config('DB_PORT', default='5432'),
+            'CONN_MAX_AGE': 0 if DB_POOL else DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool_size': config('DB_POOL_SIZE', default=CHAT_DB_THREADS + 8, cast=int),
+                'pool_timeout': config('DB_POOL_TIMEOUT', default=10, cast=float),
+                'max_lifetime': DB_CONN_MAX_AGE,
+            } if DB_POOL else {},
+        }
     }
-}
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        }
+    }
+
+# SQLite performance mode (chats/db.py): WAL journal, synchronous=NORMAL, memory-mapped
+# reads and a busy timeout on every connection, and consumer writes funnelled through
+# one writer thread that commits up to CHAT_SQLITE_WRITE_BATCH of them per transaction.
+# Off by default: switching to WAL leaves -wal/-shm files next to the database.
+CHAT_SQLITE_PERFORMANCE = config('CHAT_SQLITE_PERFORMANCE', default=False, cast=bool)
+CHAT_SQLITE_MMAP_SIZE = config('CHAT_SQLITE_MMAP_SIZE', default=256 * 1024 * 1024, cast=int)
+CHAT_SQLITE_BUSY_TIMEOUT = config('CHAT_SQLITE_BUSY_TIMEOUT', default=5000, cast=int)  # ms
+CHAT_SQLITE_WRITE_BATCH = config('CHAT_SQLITE_WRITE_BATCH', default=100, cast=int)
 
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
@@ -153,6 +192,86 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Single-process deployments can skip the Redis round trip with CHAT_CHANNEL_LAYER=sharded
+if config('CHAT_CHANNEL_LAYER', default='redis') == 'sharded':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chats.layers.ShardedChannelLayer',
+            'CONFIG': {
+                'capacity': config('CHAT_CHANNEL_LAYER_CAPACITY', default=1000, cast=int),
+                'expiry': 60,
+            },
+        },
+    }
+
+# Chat message persistence
+# Write-behind mode broadcasts messages before they are stored and inserts them in batches.
+# It requires CHAT_WORKER_ID (0-63), distinct for every server process, for snowflake message ids.
+CHAT_WRITE_BEHIND = config('CHAT_WRITE_BEHIND', default=False, cast=bool)
+CHAT_WRITE_BEHIND_BATCH_SIZE = config('CHAT_WRITE_BEHIND_BATCH_SIZE', default=200, cast=int)
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = config('CHAT_WRITE_BEHIND_FLUSH_INTERVAL', default=0.05, cast=float)
+CHAT_WRITE_BEHIND_MAX_PENDING = config('CHAT_WRITE_BEHIND_MAX_PENDING', default=10000, cast=int)
+CHAT_WORKER_ID = config('CHAT_WORKER_ID', default=None, cast=lambda value: None if value is None else int(value))
+
+# WebSocket JWT auth reloads the refresh-token blacklist at most this often (seconds)
+CHAT_JWT_BLACKLIST_TTL = config('CHAT_JWT_BLACKLIST_TTL', default=30, cast=float)
+
+# In-process cache of room metadata and membership used to authorize WebSocket connects
+CHAT_ROOM_CACHE_SIZE = config('CHAT_ROOM_CACHE_SIZE', default=10000, cast=int)
+CHAT_ROOM_CACHE_TTL = config('CHAT_ROOM_CACHE_TTL', default=60, cast=float)
+
+# User-picker search results, cached per user and query to absorb typeahead bursts
+CHAT_USER_SEARCH_CACHE_SIZE = config('CHAT_USER_SEARCH_CACHE_SIZE', default=2000, cast=int)
+CHAT_USER_SEARCH_CACHE_TTL = config('CHAT_USER_SEARCH_CACHE_TTL', default=10, cast=float)
+
+# Typing indicators: one coalesced event per room per window; typers expire after the TTL
+CHAT_TYPING_WINDOW = config('CHAT_TYPING_WINDOW', default=1.0, cast=float)
+CHAT_TYPING_TTL = config('CHAT_TYPING_TTL', default=5.0, cast=float)
+
+# Read receipts are debounced per user per room and flushed once per window (seconds)
+CHAT_RECEIPT_WINDOW = config('CHAT_RECEIPT_WINDOW', default=0.5, cast=float)
+
+# Rooms a single multiplexed socket (ws/chat/) may subscribe to
+CHAT_MAX_SUBSCRIPTIONS = config('CHAT_MAX_SUBSCRIPTIONS', default=100, cast=int)
+
+# Per-socket outbound buffer: past HIGH_WATER frames typing is dropped and frames are
+# batched, past LIMIT the client is evicted with a resume token
+CHAT_OUTBOX_HIGH_WATER = config('CHAT_OUTBOX_HIGH_WATER', default=200, cast=int)
+CHAT_OUTBOX_LIMIT = config('CHAT_OUTBOX_LIMIT', default=2000, cast=int)
+CHAT_OUTBOX_BATCH_SIZE = config('CHAT_OUTBOX_BATCH_SIZE', default=50, cast=int)
+
+# Reconnect catch-up: missed messages stream in chunks of CHUNK; past MAX the client
+# gets a history_gap and pages the rest over REST
+CHAT_CATCH_UP_CHUNK = config('CHAT_CATCH_UP_CHUNK', default=100, cast=int)
+CHAT_CATCH_UP_MAX = config('CHAT_CATCH_UP_MAX', default=1000, cast=int)
+CHAT_RESUME_TOKEN_MAX_AGE = config('CHAT_RESUME_TOKEN_MAX_AGE', default=3600, cast=int)
+
+# Room broadcasts are delivered by a pool of fan-out workers (0 sends inline from the consumer).
+# `channel` rooms with LARGE_ROOM+ members get events batched per BATCH_WINDOW seconds
+# and typing frames capped at TYPING_SAMPLE typers.
+CHAT_FANOUT_WORKERS = config('CHAT_FANOUT_WORKERS', default=4, cast=int)
+CHAT_FANOUT_LARGE_ROOM = config('CHAT_FANOUT_LARGE_ROOM', default=500, cast=int)
+CHAT_FANOUT_BATCH_WINDOW = config('CHAT_FANOUT_BATCH_WINDOW', default=0.1, cast=float)
+CHAT_FANOUT_TYPING_SAMPLE = config('CHAT_FANOUT_TYPING_SAMPLE', default=3, cast=int)
+
+# Most user ids a single room creation or membership change may add or remove
+CHAT_MEMBERSHIP_BATCH_LIMIT = config('CHAT_MEMBERSHIP_BATCH_LIMIT', default=1000, cast=int)
+
+# Presence: online/offline transitions are written to UserStatus in batches
+CHAT_PRESENCE_FLUSH_INTERVAL = config('CHAT_PRESENCE_FLUSH_INTERVAL', default=2.0, cast=float)
+
+# Retention, applied by `manage.py apply_retention` (chats/retention.py): messages older
+# than archive_after_days move into compressed MessageArchive chunks of up to
+# CHAT_ARCHIVE_CHUNK_SIZE messages, which history pages still read; chunks older than
+# delete_after_days are dropped. None never archives / never deletes. A room's own
+# archive_after_days and delete_after_days override its room_type's values.
+CHAT_RETENTION = {
+    'direct': {'archive_after_days': 365, 'delete_after_days': None},
+    'group': {'archive_after_days': 180, 'delete_after_days': None},
+    'channel': {'archive_after_days': 90, 'delete_after_days': None},
+}
+CHAT_ARCHIVE_CHUNK_SIZE = config('CHAT_ARCHIVE_CHUNK_SIZE', default=500, cast=int)
+
 # ✅ Add logging for debugging
 LOGGING = {
     'version': 1,
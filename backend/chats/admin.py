@@ -5,4 +5,5 @@ from .models import *
 admin.site.register(ChatRoom)
 admin.site.register(Message)
 admin.site.register(UserStatus)
-admin.site.register(RoomParticipant)
\ No newline at end of file
+admin.site.register(RoomParticipant)
+admin.site.register(RoomMemberState)
\ No newline at end of file
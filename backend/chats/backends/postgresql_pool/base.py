@@ -0,0 +1,156 @@
+# chat/backends/postgresql_pool/base.py
+import logging
+import threading
+import time
+from collections import deque
+
+from django.db import DatabaseError
+from django.db.backends.postgresql import base
+from django.db.backends.postgresql.psycopg_any import IsolationLevel
+
+from chats import metrics
+
+logger = logging.getLogger(__name__)
+
+# OPTIONS read by the pool rather than passed to psycopg
+POOL_OPTIONS = ('pool_size', 'pool_timeout', 'max_lifetime', 'health_check_after')
+
+
+class ConnectionPool:
+    """A bounded set of open connections shared by every thread of the process.
+
+    At most `size` connections are checked out at once; further checkouts wait up
+    to `timeout` seconds and then fail. Idle connections are reused newest first,
+    checked with SELECT 1 when they sat idle for `health_check_after` seconds, and
+    replaced once they are `max_lifetime` seconds old (None keeps them forever).
+    """
+
+    def __init__(self, size, timeout, max_lifetime, health_check_after):
+        self.size = size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_after = health_check_after
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        # (connection, created_at, returned_at)
+        self.idle = deque()
+        # id(connection) -> created_at, for checked out connections
+        self.in_use = {}
+
+    def getconn(self, connect):
+        if not self.slots.acquire(timeout=self.timeout):
+            metrics.incr('db_pool.timeouts')
+            raise DatabaseError(f"No database connection became free within {self.timeout}s (pool size {self.size})")
+        try:
+            while True:
+                with self.lock:
+                    item = self.idle.pop() if self.idle else None
+                if item is None:
+                    connection, created_at = connect(), time.monotonic()
+                    metrics.incr('db_pool.connects')
+                    break
+                connection, created_at, returned_at = item
+                if self.usable(connection, created_at, returned_at):
+                    break
+                self.discard(connection)
+            with self.lock:
+                self.in_use[id(connection)] = created_at
+            return connection
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def usable(self, connection, created_at, returned_at):
+        now = time.monotonic()
+        if connection.closed:
+            return False
+        if self.max_lifetime is not None and now - created_at > self.max_lifetime:
+            return False
+        if now - returned_at > self.health_check_after:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+            except Exception:
+                metrics.incr('db_pool.health_check_failures')
+                return False
+        return True
+
+    def putconn(self, connection, reuse=True):
+        with self.lock:
+            created_at = self.in_use.pop(id(connection), None)
+        if created_at is None:
+            # Not one of ours (or already returned)
+            self.discard(connection)
+            return
+        try:
+            if reuse and not connection.closed:
+                try:
+                    # Leave nothing open for the next borrower
+                    connection.rollback()
+                    with self.lock:
+                        self.idle.append((connection, created_at, time.monotonic()))
+                    return
+                except Exception:
+                    logger.warning("Dropping a pooled database connection that failed to reset", exc_info=True)
+            self.discard(connection)
+        finally:
+            self.slots.release()
+
+    def discard(self, connection):
+        metrics.incr('db_pool.discards')
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        with self.lock:
+            return {'in_use': len(self.in_use), 'idle': len(self.idle), 'size': self.size}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """PostgreSQL backend whose connections come from a per-process ConnectionPool.
+
+    Django closes connections after each request and each database_sync_to_async
+    call when CONN_MAX_AGE is 0; here closing hands the connection back to the pool
+    instead, so it stays open without being tied to a thread. Pool OPTIONS:
+    pool_size, pool_timeout, max_lifetime and health_check_after.
+    """
+
+    pools = {}
+    pools_lock = threading.Lock()
+
+    def get_pool(self):
+        with self.pools_lock:
+            pool = self.pools.get(self.alias)
+            if pool is None:
+                options = self.settings_dict['OPTIONS']
+                pool = self.pools[self.alias] = ConnectionPool(
+                    size=options.get('pool_size', 10),
+                    timeout=options.get('pool_timeout', 10),
+                    max_lifetime=options.get('max_lifetime'),
+                    health_check_after=options.get('health_check_after', 30),
+                )
+                metrics.register_gauge(f'db_pool.{self.alias}', pool.stats)
+            return pool
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        for option in POOL_OPTIONS:
+            params.pop(option, None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        connection = self.get_pool().getconn(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+        # super() sets this for new connections; pooled ones were opened with the same OPTIONS
+        self.isolation_level = IsolationLevel(
+            self.settings_dict['OPTIONS'].get('isolation_level', IsolationLevel.READ_COMMITTED)
+        )
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                # Closed mid-transaction, Django keeps using self.connection until the
+                # atomic block exits, so it can't go back to the pool
+                self.get_pool().putconn(self.connection, reuse=not self.in_atomic_block)
@@ -0,0 +1,142 @@
+# chat/cache.py
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import metrics
+
+MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after `ttl` seconds.
+
+    Process-local: other processes only see a change once their copy expires,
+    so keep the TTL short where several processes serve the same rooms.
+    """
+
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        metrics.register_gauge(f'{name}.size', lambda: len(self.data))
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None and item[0] > now:
+                self.data.move_to_end(key)
+                self.hits += 1
+                value = item[1]
+            else:
+                if item is not None:
+                    del self.data[key]
+                self.misses += 1
+                value = MISSING
+        metrics.incr(f'{self.name}.hits' if value is not MISSING else f'{self.name}.misses')
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                metrics.incr(f'{self.name}.evictions')
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+# Room metadata and participants keyed by room id (see get_room_entry)
+room_cache = TTLCache('room_cache', settings.CHAT_ROOM_CACHE_SIZE, settings.CHAT_ROOM_CACHE_TTL)
+
+# Serialized user search results keyed by (user id, query), absorbing typeahead bursts
+user_search_cache = TTLCache('user_search_cache', settings.CHAT_USER_SEARCH_CACHE_SIZE, settings.CHAT_USER_SEARCH_CACHE_TTL)
+
+
+def parse_room_id(room_id):
+    try:
+        return int(room_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def load_room_entry(room_id):
+    """Read a room's metadata and participants from the database and cache them."""
+    from .models import ChatRoom, RoomParticipant
+
+    room_id = parse_room_id(room_id)
+    if room_id is None:
+        return None
+    room = ChatRoom.objects.filter(id=room_id).values('id', 'name', 'room_type').first()
+    entry = None
+    if room is not None:
+        participants = RoomParticipant.objects.filter(room_id=room_id).values_list(
+            'user_id', 'user__username'
+        )
+        entry = {
+            'room_id': room['id'],
+            'room_name': room['name'],
+            'room_type': room['room_type'],
+            'participants': dict(participants),
+        }
+    room_cache.set(room_id, entry)
+    return entry
+
+
+def load_room_entries(room_ids):
+    """Bulk version of load_room_entry: two queries however many rooms are missing."""
+    from .models import ChatRoom, RoomParticipant
+
+    room_ids = {room_id for room_id in map(parse_room_id, room_ids) if room_id is not None}
+    if not room_ids:
+        return {}
+    entries = {room_id: None for room_id in room_ids}
+    for room in ChatRoom.objects.filter(id__in=room_ids).values('id', 'name', 'room_type'):
+        entries[room['id']] = {
+            'room_id': room['id'],
+            'room_name': room['name'],
+            'room_type': room['room_type'],
+            'participants': {},
+        }
+    participants = RoomParticipant.objects.filter(room_id__in=room_ids).values_list(
+        'room_id', 'user_id', 'user__username'
+    )
+    for room_id, user_id, username in participants:
+        entries[room_id]['participants'][user_id] = username
+    for room_id, entry in entries.items():
+        room_cache.set(room_id, entry)
+    return entries
+
+
+def get_cached_room_entry(room_id):
+    """The cached entry for a room, or MISSING; safe to call from async code."""
+    room_id = parse_room_id(room_id)
+    if room_id is None:
+        return None
+    return room_cache.get(room_id)
+
+
+def get_room_entry(room_id):
+    """Room metadata with a participant id -> username map, or None if the room doesn't exist."""
+    entry = get_cached_room_entry(room_id)
+    if entry is MISSING:
+        entry = load_room_entry(room_id)
+    return entry
+
+
+def invalidate_room(room_id):
+    room_cache.delete(int(room_id))
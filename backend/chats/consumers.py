@@ -1,19 +1,330 @@
 # chat/consumers.py
-import json
 import logging
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.contrib.auth.models import AnonymousUser
-from .models import ChatRoom, Message, UserStatus, RoomParticipant
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.urls import reverse
+from rest_framework.exceptions import ValidationError
+from .db import database_sync_to_async, database_write
+from .models import ChatRoom, Message, UserStatus, RoomMemberState, message_readers
+from .pagination import history_page, message_page, parse_cursor, clamp_page_size, DEFAULT_PAGE_SIZE
+from .persistence import message_writer
+from .summaries import record_messages
+from .encoding import dumps, loads
+from .groups import room_group_name
+from .fanout import fanout
+from .typing import typing_coalescer
+from .presence import presence
+from .receipts import receipt_aggregator, parse_read_up_to
+from .middleware import TOKEN_SUBPROTOCOL
+from .outbox import EVICTED_CLOSE_CODE, make_outbox, make_resume_token, read_resume_token
+from .cache import MISSING, get_cached_room_entry, load_room_entry, load_room_entries, parse_room_id
 
 User = get_user_model()
 logger = logging.getLogger(__name__)
 
-class ChatConsumer(AsyncWebsocketConsumer):
+# Close code for a per-room socket whose user was removed from the room
+REMOVED_CLOSE_CODE = 4003
+
+def get_online_user_ids(user_ids):
+    online = set(UserStatus.objects.filter(
+        user_id__in=user_ids, is_online=True
+    ).values_list('user_id', flat=True))
+    # Sockets on this process count straight away, before presence is flushed
+    online.update(user_id for user_id in user_ids if presence.is_online(user_id))
+    return online
+
+
+def describe_room(room, online):
+    return {
+        'room_id': room['room_id'],
+        'room_name': room['room_name'],
+        'room_type': room['room_type'],
+        'participants': [
+            {
+                'id': user_id,
+                'username': username,
+                'is_online': user_id in online
+            }
+            for user_id, username in room['participants'].items()
+        ]
+    }
+
+
+def serialize_messages(messages, readers):
+    return [
+        {
+            'id': msg.id,
+            'sender': msg.sender.username,
+            'sender_id': msg.sender.id,
+            'content': msg.content,
+            'timestamp': msg.timestamp.isoformat(),
+            'is_edited': msg.is_edited,
+            'read_by': [user.id for user in message_readers(msg, readers)]
+        }
+        for msg in messages
+    ]
+
+
+def get_recent_messages(room_ids, limit=50):
+    """The latest `limit` messages of each room, oldest first, serialized; a fixed number of queries."""
+    if len(room_ids) == 1:
+        room_id = room_ids[0]
+        messages = Message.objects.filter(room_id=room_id).select_related('sender').order_by('-id')[:limit]
+        by_room = {room_id: list(reversed(messages))}
+    else:
+        # Id of each room's limit-th newest message, read off the (room, id) index
+        floors = ChatRoom.objects.filter(id__in=room_ids).annotate(floor=Subquery(
+            Message.objects.filter(room_id=OuterRef('pk')).order_by('-id').values('id')[limit - 1:limit]
+        )).values_list('id', 'floor')
+        window = Q()
+        for room_id, floor in floors:
+            window |= Q(room_id=room_id, id__gte=floor or 0)
+        by_room = {room_id: [] for room_id in room_ids}
+        if window:
+            for message in Message.objects.filter(window).select_related('sender').order_by('id'):
+                by_room[message.room_id].append(message)
+    readers = RoomMemberState.readers(room_ids)
+    return {room_id: serialize_messages(messages, readers[room_id]) for room_id, messages in by_room.items()}
+
+
+def apply_membership(room, added, removed):
+    # Cache entries are shared between consumers, so changes go into a copy
+    participants = dict(room['participants'])
+    participants.update((user['id'], user['username']) for user in added)
+    for user_id in removed:
+        participants.pop(user_id, None)
+    return dict(room, participants=participants)
+
+
+class RoomFramesMixin:
+    """Room-scoped frames, shared by the per-room and the multiplexed consumer."""
+
+    async def handle_room_frame(self, room_id, message_type, data):
+        if message_type == 'chat_message':
+            await self.handle_chat_message(room_id, data)
+        elif message_type == 'typing_start':
+            await self.handle_typing_start(room_id)
+        elif message_type == 'typing_stop':
+            await self.handle_typing_stop(room_id)
+        elif message_type == 'read_receipt':
+            await self.handle_read_receipt(room_id, data)
+        elif message_type == 'load_history':
+            await self.handle_load_history(room_id, data)
+
+    async def join_room(self, room_id):
+        await self.channel_layer.group_add(room_group_name(room_id), self.channel_name)
+        # Update presence; user_joined only goes out for the user's first socket in the room
+        came_online, joined_room = presence.connect(self.user.id, room_id)
+        if joined_room:
+            await self.broadcast(room_id, {
+                'type': 'user_joined',
+                'user': self.user.username,
+                'user_id': self.user.id,
+            })
+
+    async def leave_room(self, room_id):
+        await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+        typing_coalescer.stop(room_id, self.user.id)
+        # user_left only goes out when the user's last socket in the room closes
+        went_offline, left_room = presence.disconnect(self.user.id, room_id)
+        if left_room:
+            await self.broadcast(room_id, {
+                'type': 'user_left',
+                'user': self.user.username,
+                'user_id': self.user.id,
+            })
+
+    async def handle_chat_message(self, room_id, data):
+        message_content = data.get('message')
+        if not isinstance(message_content, str) or not message_content.strip():
+            await self.send_frame({'type': 'error', 'room_id': room_id, 'error': 'invalid_message'})
+            return
+        
+        if settings.CHAT_WRITE_BEHIND:
+            # Broadcast first, the writer stores it with the next batch
+            saved_message = message_writer.build(room_id, self.user.id, message_content)
+            await message_writer.enqueue(saved_message)
+        else:
+            # Save message to database
+            saved_message = await self.save_message(room_id, message_content)
+        
+        # Sending a message ends the typing indicator
+        typing_coalescer.stop(room_id, self.user.id)
+        
+        # Send message to room group
+        await self.broadcast(room_id, {
+            'type': 'chat_message',
+            'message_id': saved_message.id,
+            'sender': self.user.username,
+            'sender_id': self.user.id,
+            'content': saved_message.content,
+            'timestamp': saved_message.timestamp.isoformat(),
+            'is_edited': saved_message.is_edited,
+        })
+
+    async def handle_typing_start(self, room_id):
+        # Coalesced into one `typing` frame per room per CHAT_TYPING_WINDOW
+        typing_coalescer.start(room_id, self.user.id, self.user.username)
+
+    async def handle_typing_stop(self, room_id):
+        typing_coalescer.stop(room_id, self.user.id)
+
+    async def handle_read_receipt(self, room_id, data):
+        # Debounced per user per room and broadcast as one read_receipts frame per window
+        up_to = parse_read_up_to(data)
+        if up_to is not None:
+            receipt_aggregator.add(room_id, self.user.id, self.user.username, up_to)
+
+    async def handle_load_history(self, room_id, data):
+        try:
+            before = parse_cursor(data.get('before'), 'before')
+            after = parse_cursor(data.get('after'), 'after')
+        except ValidationError:
+            await self.send_frame({'type': 'error', 'room_id': room_id, 'error': 'invalid_cursor'})
+            return
+        limit = clamp_page_size(data.get('limit', DEFAULT_PAGE_SIZE))
+        messages, has_more = await self.get_history_page(room_id, before, after, limit)
+        
+        await self.send_frame({
+            'type': 'history',
+            'room_id': room_id,
+            'before': before,
+            'after': after,
+            'messages': messages,
+            'has_more': has_more,
+        })
+
+    async def send_catch_up(self, room_id, last_id):
+        """Send a reconnecting client what it missed after `last_id`, or a history_gap if that's too much.
+
+        The delta streams as `catch_up` frames of CHAT_CATCH_UP_CHUNK messages, the last
+        one marked complete. Frames broadcast meanwhile can repeat messages from it, so
+        clients dedupe by id.
+        """
+        if await self.gap_exceeds(room_id, last_id):
+            # Too far behind: show the latest page and let REST fill in the rest
+            messages = (await database_sync_to_async(get_recent_messages)([room_id]))[room_id]
+            await self.send_frame({
+                'type': 'history_gap',
+                'room_id': room_id,
+                'after': last_id,
+                'before': messages[0]['id'] if messages else None,
+                'messages_url': f"{reverse('message-list')}?room_id={room_id}&after={last_id}",
+            })
+            await self.send_frame({
+                'type': 'recent_messages',
+                'room_id': room_id,
+                'messages': messages,
+            }, room_id, messages[-1]['id'] if messages else None)
+            return
+
+        after = last_id
+        while True:
+            messages, has_more = await self.get_catch_up_chunk(room_id, after)
+            await self.send_frame({
+                'type': 'catch_up',
+                'room_id': room_id,
+                'after': after,
+                'messages': messages,
+                'complete': not has_more,
+            }, room_id, messages[-1]['id'] if messages else None)
+            if not has_more:
+                break
+            after = messages[-1]['id']
+
+    # Outgoing frames all go through the outbox, which absorbs slow clients
+    async def send_frame(self, data, room_id=None, message_id=None):
+        self.outbox.push(data['type'], dumps(data), room_id, message_id)
+
+    async def broadcast(self, room_id, data):
+        # Handed to the fan-out workers, which encode it once for every member's consumer
+        await fanout.publish(room_id, data)
+
+    # Handler methods for different message types
+    async def forward_frame(self, event):
+        self.outbox.push(event['type'], event['frame'], event.get('room_id'), event.get('message_id'))
+
+    chat_message = forward_frame
+    user_typing = forward_frame
+    typing = forward_frame
+    read_receipt = forward_frame
+    read_receipts = forward_frame
+    user_joined = forward_frame
+    user_left = forward_frame
+    batch = forward_frame
+
+    async def membership(self, event):
+        await self.forward_frame(event)
+        change = loads(event['frame'])
+        await self.membership_changed(change['room_id'], change['added'], change['removed'])
+
+    async def accept_connection(self):
+        self.outbox = make_outbox(self)
+        # Echo the token subprotocol, or browsers that sent it drop the connection
+        subprotocols = self.scope.get('subprotocols') or []
+        await self.accept(TOKEN_SUBPROTOCOL if TOKEN_SUBPROTOCOL in subprotocols else None)
+
+    def close_outbox(self):
+        if hasattr(self, 'outbox'):
+            self.outbox.close()
+
+    async def evict(self):
+        # The client fell too far behind; it can reconnect and resume from what it got
+        logger.warning(f"Evicting slow WebSocket client: user={self.user.username}")
+        await self.send(text_data=dumps({
+            'type': 'evicted',
+            'reason': 'slow_consumer',
+            'resume_token': make_resume_token(self.user.id, self.outbox.delivered),
+        }))
+        await self.close(code=EVICTED_CLOSE_CODE)
+
+    # Database operations
+    @database_write
+    def save_message(self, room_id, content):
+        with transaction.atomic():
+            message = Message.objects.create(
+                room_id=room_id,
+                sender_id=self.user.id,
+                content=content
+            )
+            record_messages([message])
+        return message
+
+    @database_sync_to_async
+    def gap_exceeds(self, room_id, last_id):
+        limit = settings.CHAT_CATCH_UP_MAX
+        return Message.objects.filter(room_id=room_id, id__gt=last_id).order_by('id')[limit:limit + 1].exists()
+
+    @database_sync_to_async
+    def get_catch_up_chunk(self, room_id, after):
+        queryset = Message.objects.filter(room_id=room_id).select_related('sender')
+        messages, has_more = message_page(queryset, None, after, settings.CHAT_CATCH_UP_CHUNK)
+        if not has_more:
+            # Broadcast already, but still waiting in the write-behind buffer
+            unflushed = message_writer.unflushed(room_id, messages[-1].id if messages else after)
+            if unflushed:
+                senders = User.objects.in_bulk({message.sender_id for message in unflushed})
+                for message in unflushed:
+                    message.sender = senders[message.sender_id]
+                messages += unflushed
+        return serialize_messages(messages, RoomMemberState.readers([room_id])[room_id]), has_more
+
+    @database_sync_to_async
+    def get_history_page(self, room_id, before, after, limit):
+        queryset = Message.objects.filter(room_id=room_id).select_related('sender')
+        messages, has_more = history_page(queryset, before, after, limit, lambda: room_id)
+        return serialize_messages(messages, RoomMemberState.readers([room_id])[room_id]), has_more
+
+
+class ChatConsumer(RoomFramesMixin, AsyncWebsocketConsumer):
+    present = False
+
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.room_group_name = f'chat_{self.room_name}'
         self.user = self.scope['user']
 
         logger.info(f"WebSocket connection attempt - Room: {self.room_name}, User: {self.user}")
@@ -24,26 +335,28 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
 
         # Verify user can access this room
-        if not await self.is_user_in_room():
+        self.room = await self.get_room()
+        if not self.is_user_in_room():
             logger.warning(f"Connection rejected: User {self.user.id} not in room {self.room_name}")
             await self.close()
             return
+        self.room_id = self.room['room_id']
 
         try:
-            # Join room group
-            await self.channel_layer.group_add(
-                self.room_group_name,
-                self.channel_name
-            )
-            await self.accept()
+            await self.accept_connection()
             logger.info(f"WebSocket connected successfully: room={self.room_name}, user={self.user.username}")
             
-            # Update user status
-            await self.update_user_status(True)
+            # Join room group and update presence
+            self.present = True
+            await self.join_room(self.room_id)
             
-            # Send room info and recent messages
+            # Send room info, then either what the client missed or the recent messages
             await self.send_room_info()
-            await self.send_recent_messages()
+            last_id = self.get_resume_point()
+            if last_id is None:
+                await self.send_recent_messages()
+            else:
+                await self.send_catch_up(self.room_id, last_id)
             
         except Exception as e:
             logger.error(f"Error during WebSocket connection: {e}")
@@ -51,204 +364,217 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def disconnect(self, close_code):
         logger.info(f"WebSocket disconnected: room={self.room_name}, code={close_code}")
-        if hasattr(self, 'room_group_name'):
-            await self.channel_layer.group_discard(
-                self.room_group_name,
-                self.channel_name
-            )
-        
-        # Update user status
-        if not self.user.is_anonymous:
-            await self.update_user_status(False)
+        self.close_outbox()
+        if self.present:
+            self.present = False
+            await self.leave_room(self.room_id)
 
     async def receive(self, text_data):
         if self.user.is_anonymous:
             return
  
-        text_data_json = json.loads(text_data)
+        text_data_json = loads(text_data)
+        if not isinstance(text_data_json, dict):
+            await self.send_frame({'type': 'error', 'room_id': self.room_id, 'error': 'invalid_frame'})
+            return
         message_type = text_data_json.get('type', 'chat_message')
-        
-        if message_type == 'chat_message':
-            await self.handle_chat_message(text_data_json)
-        elif message_type == 'typing_start':
-            await self.handle_typing_start()
-        elif message_type == 'typing_stop':
-            await self.handle_typing_stop()
-        elif message_type == 'read_receipt':
-            await self.handle_read_receipt(text_data_json)
+        await self.handle_room_frame(self.room_id, message_type, text_data_json)
 
-    async def handle_chat_message(self, data):
-        message_content = data['message']
-        
-        # Save message to database
-        saved_message = await self.save_message(message_content)
-        
-        # Send message to room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message_id': saved_message.id,
-                'sender': self.user.username,
-                'sender_id': self.user.id,
-                'content': saved_message.content,
-                'timestamp': saved_message.timestamp.isoformat(),
-                'is_edited': saved_message.is_edited,
-            }
-        )
+    async def get_room(self):
+        # Reconnect storms are served from the room cache without touching the database
+        room = get_cached_room_entry(self.room_name)
+        if room is MISSING:
+            room = await database_sync_to_async(load_room_entry)(self.room_name)
+        return room
 
-    async def handle_typing_start(self):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_typing',
-                'user': self.user.username,
-                'user_id': self.user.id,
-                'typing': True
-            }
-        )
+    def is_user_in_room(self):
+        return self.room is not None and self.user.id in self.room['participants']
 
-    async def handle_typing_stop(self):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_typing',
-                'user': self.user.username,
-                'user_id': self.user.id,
-                'typing': False
-            }
-        )
+    async def membership_changed(self, room_id, added, removed):
+        self.room = apply_membership(self.room, added, removed)
+        if self.user.id in removed:
+            logger.info(f"Closing WebSocket of user {self.user.username}, removed from room {room_id}")
+            self.present = False
+            await self.leave_room(room_id)
+            # Let the membership frame reach the client before the close does
+            await self.outbox.drain(timeout=1.0)
+            await self.close(code=REMOVED_CLOSE_CODE)
 
-    async def handle_read_receipt(self, data):
-        message_id = data['message_id']
-        await self.mark_message_as_read(message_id)
-        
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'read_receipt',
-                'message_id': message_id,
-                'user': self.user.username,
-                'user_id': self.user.id,
-            }
-        )
+    def get_resume_point(self):
+        # ?last_id=<id> from the client, or the resume token of an `evicted` frame
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        if query.get('resume'):
+            rooms = read_resume_token(query['resume'][0], self.user.id, settings.CHAT_RESUME_TOKEN_MAX_AGE)
+            if rooms and self.room_id in rooms:
+                return rooms[self.room_id]
+        try:
+            return parse_cursor(query.get('last_id', [None])[0], 'last_id')
+        except ValidationError:
+            return None
 
-    # Handler methods for different message types
-    async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message_id': event['message_id'],
-            'sender': event['sender'],
-            'sender_id': event['sender_id'],
-            'content': event['content'],
-            'timestamp': event['timestamp'],
-            'is_edited': event['is_edited'],
-        }))
+    @database_sync_to_async
+    def get_room_info(self):
+        # Metadata and membership come from the room cache; only online status is queried
+        return describe_room(self.room, get_online_user_ids(self.room['participants']))
 
-    async def user_typing(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'user_typing',
-            'user': event['user'],
-            'user_id': event['user_id'],
-            'typing': event['typing'],
-        }))
+    async def send_room_info(self):
+        room_info = await self.get_room_info()
+        await self.send_frame({
+            'type': 'room_info',
+            'room': room_info
+        })
 
-    async def read_receipt(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'read_receipt',
-            'message_id': event['message_id'],
-            'user': event['user'],
-            'user_id': event['user_id'],
-        }))
+    async def send_recent_messages(self):
+        messages = await database_sync_to_async(get_recent_messages)([self.room_id])
+        messages = messages[self.room_id]
+        await self.send_frame({
+            'type': 'recent_messages',
+            'messages': messages
+        }, self.room_id, messages[-1]['id'] if messages else None)
 
-    async def user_joined(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'user_joined',
-            'user': event['user'],
-            'user_id': event['user_id'],
-        }))
 
-    async def user_left(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'user_left',
-            'user': event['user'],
-            'user_id': event['user_id'],
-        }))
+class MultiplexConsumer(RoomFramesMixin, AsyncWebsocketConsumer):
+    """One socket per user, with rooms subscribed and unsubscribed over the connection.
 
-    # Database operations
-    @database_sync_to_async
-    def is_user_in_room(self):
-        return ChatRoom.objects.filter(
-            id=int(self.room_name), 
-            participants=self.user
-        ).exists()
+    Client frames name their room with `room_id`, and every room frame sent back carries
+    one. `subscribe` takes a list of room ids and answers with a single `subscribed`
+    frame holding each room's info and recent messages, loaded in a fixed number of
+    queries however many rooms are asked for. Rooms listed in `since` ({room_id: last
+    seen message id}) or in a `resume_token` get catch-up frames instead of recent
+    messages. Frames whose `rooms`, `since` or `resume_token` have the wrong type are
+    answered with an `error` frame and change nothing.
+    """
 
-    @database_sync_to_async
-    def save_message(self, content):
-        room = ChatRoom.objects.get(id=int(self.room_name))
-        message = Message.objects.create(
-            room=room,
-            sender=self.user,
-            content=content
-        )
-        return message
+    async def connect(self):
+        self.user = self.scope['user']
+        self.rooms = {}
+        if self.user.is_anonymous:
+            logger.warning("Multiplexed connection rejected: User is anonymous")
+            await self.close()
+            return
+        await self.accept_connection()
+        logger.info(f"Multiplexed WebSocket connected: user={self.user.username}")
 
-    @database_sync_to_async
-    def mark_message_as_read(self, message_id):
-        message = Message.objects.get(id=message_id)
-        message.read_by.add(self.user)
+    async def disconnect(self, close_code):
+        logger.info(f"Multiplexed WebSocket disconnected: user={self.user}, rooms={len(self.rooms)}, code={close_code}")
+        self.close_outbox()
+        for room_id in list(self.rooms):
+            del self.rooms[room_id]
+            await self.leave_room(room_id)
 
-    @database_sync_to_async
-    def update_user_status(self, is_online):
-        status, created = UserStatus.objects.get_or_create(user=self.user)
-        status.is_online = is_online
-        status.save()
+    async def receive(self, text_data):
+        if self.user.is_anonymous:
+            return
 
-    @database_sync_to_async
-    def get_room_info(self):
-        room = ChatRoom.objects.get(id=int(self.room_name))
-        participants = room.participants.all()
-        return {
-            'room_id': room.id,
-            'room_name': room.name,
-            'room_type': room.room_type,
-            'participants': [
-                {
-                    'id': user.id,
-                    'username': user.username,
-                    'is_online': hasattr(user, 'chat_status') and user.chat_status.is_online
-                }
-                for user in participants
-            ]
-        }
+        data = loads(text_data)
+        if not isinstance(data, dict):
+            await self.send_frame({'type': 'error', 'error': 'invalid_frame'})
+            return
+        message_type = data.get('type')
+        if message_type == 'subscribe':
+            await self.subscribe(data)
+        elif message_type == 'unsubscribe':
+            await self.unsubscribe(data)
+        else:
+            room_id = parse_room_id(data.get('room_id'))
+            if room_id not in self.rooms:
+                await self.send_frame({'type': 'error', 'room_id': data.get('room_id'), 'error': 'not_subscribed'})
+                return
+            await self.handle_room_frame(room_id, message_type, data)
+
+    async def subscribe(self, data):
+        error = self.subscription_error(data)
+        if error:
+            await self.send_frame({'type': 'error', 'error': error})
+            return
+        requested = []
+        for room_id in map(parse_room_id, data.get('rooms') or []):
+            if room_id is not None and room_id not in self.rooms and room_id not in requested:
+                requested.append(room_id)
+        capacity = settings.CHAT_MAX_SUBSCRIPTIONS - len(self.rooms)
+        requested, over_limit = requested[:max(capacity, 0)], requested[max(capacity, 0):]
+
+        rooms = await self.get_rooms(requested)
+        allowed = [room_id for room_id in requested if rooms.get(room_id) and self.user.id in rooms[room_id]['participants']]
+        for room_id in allowed:
+            self.rooms[room_id] = rooms[room_id]
+            await self.join_room(room_id)
+
+        since = self.get_resume_points(data)
+        resumed = [room_id for room_id in allowed if room_id in since]
+        await self.send_frame({
+            'type': 'subscribed',
+            'rooms': await self.get_room_snapshots(allowed, data.get('recent', DEFAULT_PAGE_SIZE), resumed),
+            'rejected': [room_id for room_id in requested if room_id not in self.rooms],
+            'over_limit': over_limit,
+        })
+        for room_id in resumed:
+            await self.send_catch_up(room_id, since[room_id])
+
+    def subscription_error(self, data):
+        # The fields subscribe and unsubscribe iterate over, checked before any room is joined
+        if not isinstance(data.get('rooms') or [], list):
+            return 'invalid_rooms'
+        if not isinstance(data.get('since') or {}, dict):
+            return 'invalid_since'
+        if not isinstance(data.get('resume_token') or '', str):
+            return 'invalid_resume_token'
+        return None
+
+    def get_resume_points(self, data):
+        since = {}
+        if data.get('resume_token'):
+            since.update(read_resume_token(data['resume_token'], self.user.id, settings.CHAT_RESUME_TOKEN_MAX_AGE) or {})
+        for room_id, last_id in (data.get('since') or {}).items():
+            try:
+                since[parse_room_id(room_id)] = parse_cursor(last_id, 'since')
+            except ValidationError:
+                continue
+        return {room_id: last_id for room_id, last_id in since.items() if room_id is not None and last_id is not None}
+
+    async def unsubscribe(self, data):
+        if not isinstance(data.get('rooms') or [], list):
+            await self.send_frame({'type': 'error', 'error': 'invalid_rooms'})
+            return
+        removed = []
+        for room_id in map(parse_room_id, data.get('rooms') or []):
+            if room_id in self.rooms:
+                del self.rooms[room_id]
+                await self.leave_room(room_id)
+                removed.append(room_id)
+        await self.send_frame({'type': 'unsubscribed', 'rooms': removed})
+
+    async def membership_changed(self, room_id, added, removed):
+        if room_id not in self.rooms:
+            return
+        if self.user.id in removed:
+            # The membership frame already went out; no further frames from this room
+            del self.rooms[room_id]
+            await self.leave_room(room_id)
+        else:
+            self.rooms[room_id] = apply_membership(self.rooms[room_id], added, removed)
+
+    async def get_rooms(self, room_ids):
+        # Cached entries first, then everything missing in one bulk load
+        rooms = {room_id: get_cached_room_entry(room_id) for room_id in room_ids}
+        missing = [room_id for room_id, room in rooms.items() if room is MISSING]
+        if missing:
+            rooms.update(await database_sync_to_async(load_room_entries)(missing))
+        return rooms
 
     @database_sync_to_async
-    def get_recent_messages(self, limit=50):
-        room = ChatRoom.objects.get(id=int(self.room_name))
-        messages = Message.objects.filter(room=room).select_related('sender').order_by('-timestamp')[:limit]
+    def get_room_snapshots(self, room_ids, recent, resumed):
+        if not room_ids:
+            return []
+        online = get_online_user_ids({user_id for room_id in room_ids for user_id in self.rooms[room_id]['participants']})
+        recent = clamp_page_size(recent) if recent else 0
+        fresh = [room_id for room_id in room_ids if room_id not in resumed]
+        messages = get_recent_messages(fresh, recent) if recent and fresh else {}
         return [
             {
-                'id': msg.id,
-                'sender': msg.sender.username,
-                'sender_id': msg.sender.id,
-                'content': msg.content,
-                'timestamp': msg.timestamp.isoformat(),
-                'is_edited': msg.is_edited,
-                'read_by': [user.id for user in msg.read_by.all()]
+                'room': describe_room(self.rooms[room_id], online),
+                'messages': messages.get(room_id, []),
+                'catch_up': room_id in resumed,
             }
-            for msg in reversed(messages)
+            for room_id in room_ids
         ]
-
-    async def send_room_info(self):
-        room_info = await self.get_room_info()
-        await self.send(text_data=json.dumps({
-            'type': 'room_info',
-            'room': room_info
-        }))
-
-    async def send_recent_messages(self):
-        messages = await self.get_recent_messages()
-        await self.send(text_data=json.dumps({
-            'type': 'recent_messages',
-            'messages': messages
-        }))
\ No newline at end of file
@@ -0,0 +1,126 @@
+# chat/db.py
+import asyncio
+import functools
+import logging
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# channels' database_sync_to_async is thread-sensitive: every consumer query in the
+# process queues for asgiref's one shared thread. With CHAT_DB_THREADS set they run
+# on that many threads instead, which also caps how many connections consumers hold
+# (see DB_POOL_SIZE in settings).
+executor = None
+if settings.CHAT_DB_THREADS:
+    executor = ThreadPoolExecutor(max_workers=settings.CHAT_DB_THREADS, thread_name_prefix='chat-db')
+    metrics.register_gauge('db.queued_calls', lambda: executor._work_queue.qsize())
+
+
+def database_sync_to_async(func):
+    """Drop-in for channels.db.database_sync_to_async that honours CHAT_DB_THREADS."""
+    if executor is None:
+        return DatabaseSyncToAsync(func)
+    return DatabaseSyncToAsync(func, thread_sensitive=False, executor=executor)
+
+
+class WriteQueue:
+    """Runs database writes one after another on a single thread, several per transaction.
+
+    SQLite allows one writer at a time; writers racing from several threads spend
+    their time in busy waits or fail with "database is locked". Here whatever has
+    queued up while a transaction ran is committed together in the next one, each
+    call inside its own savepoint so a failing write doesn't undo the others.
+    Callers get their result once the transaction has committed.
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.jobs = queue.SimpleQueue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    @property
+    def depth(self):
+        return self.jobs.qsize()
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        self.jobs.put((func, args, kwargs, future))
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.work, name='chat-db-writer', daemon=True)
+                self.thread.start()
+        return future
+
+    async def run(self, func, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def work(self):
+        while True:
+            batch = [self.jobs.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            self.commit(batch)
+
+    def commit(self, batch):
+        # Calls whose caller went away (cancelled) are skipped
+        batch = [job for job in batch if job[3].set_running_or_notify_cancel()]
+        results = []
+        try:
+            with transaction.atomic():
+                for func, args, kwargs, future in batch:
+                    try:
+                        with transaction.atomic():
+                            results.append((future, func(*args, **kwargs), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+        except Exception as e:
+            logger.exception(f"Write batch of {len(batch)} calls failed to commit")
+            metrics.incr('db.write_errors')
+            connection.close()
+            results = [(future, None, e) for _, _, _, future in batch]
+        metrics.incr('db.write_batches')
+        metrics.incr('db.writes', len(batch))
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+write_queue = None
+if settings.CHAT_SQLITE_PERFORMANCE and connection.vendor == 'sqlite':
+    write_queue = WriteQueue(settings.CHAT_SQLITE_WRITE_BATCH)
+    metrics.register_gauge('db.write_queue', lambda: write_queue.depth)
+
+
+def database_write(func):
+    """database_sync_to_async for writes; goes through the WriteQueue in SQLite performance mode."""
+    if write_queue is None:
+        return database_sync_to_async(func)
+
+    @functools.wraps(func)
+    async def write(*args, **kwargs):
+        return await write_queue.run(func, *args, **kwargs)
+    return write
+
+
+def tune_sqlite(connection):
+    """PRAGMAs for CHAT_SQLITE_PERFORMANCE, run on every new SQLite connection."""
+    with connection.cursor() as cursor:
+        # WAL lets readers carry on while a write commits; NORMAL only syncs at checkpoints
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA mmap_size={int(settings.CHAT_SQLITE_MMAP_SIZE)}')
+        cursor.execute(f'PRAGMA busy_timeout={int(settings.CHAT_SQLITE_BUSY_TIMEOUT)}')
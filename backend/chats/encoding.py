@@ -0,0 +1,26 @@
+# chat/encoding.py
+import json
+
+try:
+    import orjson
+except ImportError:  # optional speed-up, see requirements.txt
+    orjson = None
+
+
+def dumps_stdlib(data):
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
+
+def dumps_orjson(data):
+    return orjson.dumps(data).decode()
+
+
+# WebSocket text frames are str, so the orjson output is decoded once here
+dumps = dumps_orjson if orjson is not None else dumps_stdlib
+ENCODER = 'orjson' if orjson is not None else 'json'
+
+
+def loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
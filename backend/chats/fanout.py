@@ -0,0 +1,135 @@
+# chat/fanout.py
+import asyncio
+import logging
+
+from django.conf import settings
+
+from . import metrics
+from .cache import MISSING, get_cached_room_entry, load_room_entry
+from .db import database_sync_to_async
+from .groups import broadcast_to_room, encode_room_frame, send_to_room
+from .lifespan import on_shutdown
+
+logger = logging.getLogger(__name__)
+
+# Queue marker telling a worker to send what it has batched for a room
+FLUSH = object()
+
+
+class FanoutService:
+    """Delivers room events from a pool of worker tasks instead of the sender's consumer.
+
+    publish() only enqueues, so the sender never waits on group_send and its latency
+    doesn't depend on the room's size. Rooms are pinned to a worker by id, which keeps
+    each room's events in order.
+
+    `channel` rooms with at least `large_room` members get tiered delivery: events
+    collected over `batch_window` seconds go out as one `batch` frame, and typing
+    frames in them name at most `typing_sample` typers.
+    """
+
+    def __init__(self, workers, large_room, batch_window, typing_sample):
+        self.worker_count = workers
+        self.large_room = large_room
+        self.batch_window = batch_window
+        self.typing_sample = typing_sample
+        self.queues = []
+        self.tasks = []
+        self.loop = None
+        self.closed = False
+        # room_id -> [event data] waiting for the room's next batch
+        self.batches = {}
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.queues = [asyncio.Queue() for _ in range(self.worker_count)]
+        self.tasks = [self.loop.create_task(self.work(queue)) for queue in self.queues]
+        self.batches = {}
+
+    @property
+    def depth(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    async def publish(self, room_id, data):
+        if not self.worker_count or self.closed:
+            # Disabled, or shutting down: deliver inline
+            await broadcast_to_room(room_id, data)
+            return
+        if self.loop is not asyncio.get_running_loop():
+            self.start()
+        metrics.incr('fanout.published')
+        self.queues[room_id % self.worker_count].put_nowait((room_id, data))
+
+    async def work(self, queue):
+        while True:
+            room_id, data = await queue.get()
+            try:
+                if data is FLUSH:
+                    await self.flush_batch(room_id)
+                elif await self.is_large(room_id):
+                    self.add_to_batch(queue, room_id, data)
+                else:
+                    await broadcast_to_room(room_id, data)
+            except Exception:
+                logger.exception(f"Fan-out to room {room_id} failed")
+                metrics.incr('fanout.errors')
+            finally:
+                queue.task_done()
+
+    async def is_large(self, room_id):
+        room = get_cached_room_entry(room_id)
+        if room is MISSING:
+            room = await database_sync_to_async(load_room_entry)(room_id)
+        return bool(room) and room['room_type'] == 'channel' and len(room['participants']) >= self.large_room
+
+    def add_to_batch(self, queue, room_id, data):
+        batch = self.batches.setdefault(room_id, [])
+        batch.append(data)
+        if len(batch) == 1:
+            # The flush goes through the same queue, so it stays ordered with the room's events
+            self.loop.call_later(self.batch_window, queue.put_nowait, (room_id, FLUSH))
+
+    async def flush_batch(self, room_id):
+        batch = [self.sample_typing(data) for data in self.batches.pop(room_id, [])]
+        if not batch:
+            return
+        if len(batch) == 1:
+            await broadcast_to_room(room_id, batch[0])
+            return
+        message_ids = [data['message_id'] for data in batch if data['type'] == 'chat_message']
+        frame = '{"type":"batch","room_id":%d,"frames":[%s]}' % (
+            room_id, ','.join(encode_room_frame(room_id, data) for data in batch)
+        )
+        metrics.incr('fanout.batches')
+        metrics.incr('fanout.batched_events', len(batch))
+        await send_to_room(room_id, 'batch', frame, max(message_ids) if message_ids else None)
+
+    def sample_typing(self, data):
+        # Nobody reads a list of 200 typers; stops are kept so indicators still clear
+        if data['type'] == 'typing' and len(data['started']) > self.typing_sample:
+            metrics.incr('fanout.typing_sampled')
+            data = dict(data, started=data['started'][:self.typing_sample], more_typing=True)
+        return data
+
+    async def close(self):
+        self.closed = True
+        if not self.tasks:
+            return
+        for room_id in list(self.batches):
+            self.queues[room_id % self.worker_count].put_nowait((room_id, FLUSH))
+        await asyncio.gather(*(queue.join() for queue in self.queues))
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        self.queues = []
+        self.loop = None
+
+
+fanout = FanoutService(
+    workers=settings.CHAT_FANOUT_WORKERS,
+    large_room=settings.CHAT_FANOUT_LARGE_ROOM,
+    batch_window=settings.CHAT_FANOUT_BATCH_WINDOW,
+    typing_sample=settings.CHAT_FANOUT_TYPING_SAMPLE,
+)
+metrics.register_gauge('fanout.queued', lambda: fanout.depth)
+on_shutdown(fanout.close)
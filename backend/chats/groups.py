@@ -0,0 +1,41 @@
+# chat/groups.py
+from channels.layers import get_channel_layer
+
+from .encoding import dumps
+
+
+def room_group_name(room_id):
+    return f'chat_{room_id}'
+
+
+def encode_room_frame(room_id, data):
+    # Frames are tagged with the room id so multiplexed sockets can tell rooms apart
+    if 'room_id' not in data:
+        data = dict(data, room_id=room_id)
+    return dumps(data)
+
+
+async def send_to_room(room_id, event_type, frame, message_id=None, channel_layer=None):
+    """group_send an already-encoded frame; consumers forward it unchanged (see forward_frame)."""
+    channel_layer = channel_layer or get_channel_layer()
+    await channel_layer.group_send(
+        room_group_name(room_id),
+        {
+            'type': event_type,
+            'frame': frame,
+            # Lets receiving outboxes track delivery without decoding the frame
+            'room_id': room_id,
+            'message_id': message_id,
+        }
+    )
+
+
+async def broadcast_to_room(room_id, data, channel_layer=None):
+    """Send a frame to every socket in a room, encoded once (see ChatConsumer.forward_frame)."""
+    await send_to_room(
+        room_id,
+        data['type'],
+        encode_room_frame(room_id, data),
+        data.get('message_id') if data['type'] == 'chat_message' else None,
+        channel_layer,
+    )
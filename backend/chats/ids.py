@@ -0,0 +1,98 @@
+# chat/ids.py
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+# Snowflake layout: 41 bits of milliseconds since EPOCH_MS, 6 bits of worker id,
+# 6 bits of per-millisecond sequence. Ids sort by creation time and stay below 2**53,
+# so JavaScript clients read them as exact numbers (good until 2093).
+EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+WORKER_BITS = 6
+SEQUENCE_BITS = 6
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+if settings.CHAT_WRITE_BEHIND:
+    # Two processes with the same worker id hand out the same ids
+    if settings.CHAT_WORKER_ID is None:
+        raise ImproperlyConfigured(
+            "CHAT_WRITE_BEHIND needs CHAT_WORKER_ID, distinct for every server process "
+            f"(0-{MAX_WORKER_ID}; 0 for a single process)"
+        )
+    if not 0 <= settings.CHAT_WORKER_ID <= MAX_WORKER_ID:
+        raise ImproperlyConfigured(f"CHAT_WORKER_ID must be between 0 and {MAX_WORKER_ID}")
+
+
+class SnowflakeGenerator:
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker_id must be between 0 and {MAX_WORKER_ID}")
+        self.worker_id = worker_id
+        self.lock = threading.Lock()
+        self.last_ms = -1
+        self.sequence = 0
+
+    def next_id(self):
+        with self.lock:
+            now_ms = int(time.time() * 1000)
+            if now_ms < self.last_ms:
+                # Clock moved backwards; keep issuing from the last timestamp
+                now_ms = self.last_ms
+            if now_ms == self.last_ms:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    # Sequence exhausted for this millisecond, borrow the next one
+                    now_ms = self.last_ms + 1
+            else:
+                self.sequence = 0
+            self.last_ms = now_ms
+            return ((now_ms - EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self.sequence
+
+
+_generator = None
+_generator_lock = threading.Lock()
+
+
+def next_message_id():
+    global _generator
+    if _generator is None:
+        with _generator_lock:
+            if _generator is None:
+                _generator = SnowflakeGenerator(settings.CHAT_WORKER_ID or 0)
+    return _generator.next_id()
+
+
+_synced = set()
+
+
+def sync_message_sequence(connection):
+    """Move the PostgreSQL message id sequence past the largest stored id.
+
+    Snowflake ids are inserted explicitly, which the sequence never sees; once
+    write-behind is switched off again it would hand out ids below them and break
+    MAX(id) lookups, unread counts and keyset pagination. SQLite's AUTOINCREMENT
+    already follows explicit ids. Runs once per process and database.
+    """
+    if connection.vendor != 'postgresql' or connection.alias in _synced:
+        return
+    _synced.add(connection.alias)
+    table = Message._meta.db_table
+    with connection.cursor() as cursor:
+        if table not in connection.introspection.table_names(cursor):
+            return
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+        sequence = cursor.fetchone()[0]
+        cursor.execute(f"SELECT last_value FROM {sequence}")
+        last_value = cursor.fetchone()[0]
+        cursor.execute(f"SELECT MAX(id) FROM {connection.ops.quote_name(table)}")
+        max_id = cursor.fetchone()[0]
+        if max_id is not None and max_id > last_value:
+            cursor.execute("SELECT setval(%s, %s)", [sequence, max_id])
+            logger.warning(f"Moved {sequence} from {last_value} to {max_id}, past the snowflake message ids")
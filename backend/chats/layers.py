@@ -0,0 +1,179 @@
+# chat/layers.py
+import asyncio
+import random
+import string
+import time
+from collections import deque
+from copy import deepcopy
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+from . import metrics
+
+
+class Mailbox:
+    __slots__ = ('messages', 'waiters')
+
+    def __init__(self):
+        # (expires_at, message)
+        self.messages = deque()
+        self.waiters = deque()
+
+
+class ShardedChannelLayer(BaseChannelLayer):
+    """In-process channel layer for single-node deployments.
+
+    A drop-in replacement for RedisChannelLayer when every consumer lives in one
+    process:
+
+        CHANNEL_LAYERS = {'default': {'BACKEND': 'chats.layers.ShardedChannelLayer'}}
+
+    Channels and groups are split over `shards` dicts by hash. Expired messages and
+    memberships are swept one shard per group_send, so the cost of housekeeping does
+    not grow with the number of connections the way InMemoryChannelLayer's full scan
+    does. Per-channel queues are bounded by `capacity` / `channel_capacity`.
+
+    group_send hands every member the same message dict instead of a deep copy, so
+    handlers must treat messages as read-only (ChatConsumer only forwards the
+    pre-encoded frame). Set `copy_messages=True` to copy on point-to-point sends too.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, shards=16,
+                 copy_messages=False, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.group_expiry = group_expiry
+        self.shard_count = shards
+        self.copy_messages = copy_messages
+        self.mailboxes = [{} for _ in range(shards)]
+        # group -> {channel: joined_at}
+        self.groups = [{} for _ in range(shards)]
+        self.next_sweep = 0
+
+    def shard(self, name):
+        return hash(name) % self.shard_count
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        assert '__asgi_channel__' not in message
+        self.deliver(channel, deepcopy(message) if self.copy_messages else message, time.monotonic())
+
+    def deliver(self, channel, message, now):
+        shard = self.mailboxes[self.shard(channel)]
+        mailbox = shard.get(channel)
+        if mailbox is None:
+            mailbox = shard[channel] = Mailbox()
+        elif len(mailbox.messages) >= self.get_capacity(channel):
+            self.expire(mailbox, now)
+            if len(mailbox.messages) >= self.get_capacity(channel):
+                raise ChannelFull(channel)
+        mailbox.messages.append((now + self.expiry, message))
+        while mailbox.waiters:
+            waiter = mailbox.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        shard = self.mailboxes[self.shard(channel)]
+        mailbox = shard.get(channel)
+        if mailbox is None:
+            mailbox = shard[channel] = Mailbox()
+        while True:
+            self.expire(mailbox, time.monotonic())
+            if mailbox.messages:
+                _, message = mailbox.messages.popleft()
+                if not mailbox.messages and not mailbox.waiters:
+                    shard.pop(channel, None)
+                return message
+            waiter = asyncio.get_running_loop().create_future()
+            mailbox.waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in mailbox.waiters:
+                    mailbox.waiters.remove(waiter)
+            # Another receiver may have emptied the mailbox and dropped it meanwhile
+            mailbox = shard.setdefault(channel, mailbox)
+
+    async def new_channel(self, prefix='specific.'):
+        return '%s.sharded!%s' % (prefix, ''.join(random.choice(string.ascii_letters) for _ in range(12)))
+
+    # Expiry
+
+    def expire(self, mailbox, now):
+        while mailbox.messages and mailbox.messages[0][0] < now:
+            mailbox.messages.popleft()
+            metrics.incr('channel_layer.expired')
+
+    def sweep(self, now):
+        """Expire messages and memberships in the next shard, round robin."""
+        index = self.next_sweep
+        self.next_sweep = (index + 1) % self.shard_count
+        mailboxes = self.mailboxes[index]
+        for channel, mailbox in list(mailboxes.items()):
+            if mailbox.messages and mailbox.messages[0][0] < now:
+                self.expire(mailbox, now)
+                # Like InMemoryChannelLayer: a channel that let messages expire is presumed dead
+                self.remove_from_groups(channel)
+            if not mailbox.messages and not mailbox.waiters:
+                del mailboxes[channel]
+        joined_before = now - self.group_expiry
+        groups = self.groups[index]
+        for group, members in list(groups.items()):
+            for channel in [channel for channel, joined_at in members.items() if joined_at < joined_before]:
+                del members[channel]
+            if not members:
+                del groups[group]
+
+    def remove_from_groups(self, channel):
+        for groups in self.groups:
+            for members in groups.values():
+                members.pop(channel, None)
+
+    # Flush extension
+
+    async def flush(self):
+        self.mailboxes = [{} for _ in range(self.shard_count)]
+        self.groups = [{} for _ in range(self.shard_count)]
+
+    async def close(self):
+        pass
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        self.groups[self.shard(group)].setdefault(group, {})[channel] = time.monotonic()
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), "Invalid channel name"
+        assert self.valid_group_name(group), "Invalid group name"
+        groups = self.groups[self.shard(group)]
+        members = groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del groups[group]
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+        now = time.monotonic()
+        self.sweep(now)
+        members = self.groups[self.shard(group)].get(group)
+        if not members:
+            return
+        for channel in list(members):
+            try:
+                self.deliver(channel, message, now)
+            except ChannelFull:
+                metrics.incr('channel_layer.full')
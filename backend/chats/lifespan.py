@@ -0,0 +1,32 @@
+# chat/lifespan.py
+import logging
+
+logger = logging.getLogger(__name__)
+
+_shutdown_hooks = []
+
+
+def on_shutdown(hook):
+    """Register an async callable to run when the ASGI server shuts down."""
+    _shutdown_hooks.append(hook)
+    return hook
+
+
+async def run_shutdown_hooks():
+    for hook in _shutdown_hooks:
+        try:
+            await hook()
+        except Exception:
+            logger.exception(f"Shutdown hook {hook!r} failed")
+
+
+async def lifespan_app(scope, receive, send):
+    # ASGI lifespan protocol (sent by uvicorn/hypercorn; daphne does not send it)
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await run_shutdown_hooks()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -0,0 +1,46 @@
+# chat/management/commands/apply_retention.py
+import time
+
+from django.core.management.base import BaseCommand
+
+from chats.models import ChatRoom
+from chats.retention import apply_policy, compact_read_states, pending, room_policy
+from chats.summaries import in_rooms
+
+
+class Command(BaseCommand):
+    help = "Archive and delete old messages per the rooms' retention policies, and compact read states"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, nargs='+', help='Only these room ids (defaults to every room)')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be archived and deleted, and change nothing')
+        parser.add_argument('--chunk-size', type=int, help='Messages per archive chunk (defaults to CHAT_ARCHIVE_CHUNK_SIZE)')
+
+    def handle(self, *args, **options):
+        room_ids = options['rooms']
+        rooms = in_rooms(ChatRoom.objects.order_by('id'), room_ids, 'id')
+        start = time.perf_counter()
+        total_archived = total_deleted = 0
+
+        for room in rooms.iterator():
+            if options['dry_run']:
+                archived, deleted = pending(room)
+            else:
+                archived, deleted = apply_policy(room, chunk_size=options['chunk_size'])
+            if archived or deleted:
+                archive_after, delete_after = room_policy(room)
+                self.stdout.write(
+                    f'room {room.pk} ({room.room_type}, archive after {archive_after} days, '
+                    f'delete after {delete_after} days): {archived} archived, {deleted} deleted'
+                )
+            total_archived += archived
+            total_deleted += deleted
+
+        if options['dry_run']:
+            self.stdout.write(f'Would archive {total_archived} and delete {total_deleted} messages')
+            return
+        compacted = compact_read_states(room_ids)
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {total_archived} and deleted {total_deleted} messages, removed {compacted} stale read states '
+            f'in {time.perf_counter() - start:.2f}s'
+        ))
@@ -0,0 +1,114 @@
+# chat/management/commands/bench_channel_layer.py
+import asyncio
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from chats.encoding import dumps
+from chats.groups import room_group_name
+from chats.management.commands.bench_encoding import sample_chat_message
+
+LAYERS = {
+    'sharded': ('chats.layers.ShardedChannelLayer', {}),
+    'memory': ('channels.layers.InMemoryChannelLayer', {}),
+    'redis': ('channels_redis.core.RedisChannelLayer', None),
+}
+
+
+class Command(BaseCommand):
+    help = "Run the ChatConsumer group fan-out workload against several channel layers and compare them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--layers', nargs='+', choices=sorted(LAYERS), default=['sharded', 'memory', 'redis'])
+        parser.add_argument('--rooms', type=int, default=50)
+        parser.add_argument('--members', type=int, default=20, help='Consumers subscribed to each room')
+        parser.add_argument('--messages', type=int, default=2000, help='group_send calls, spread over the rooms')
+        parser.add_argument('--timeout', type=float, default=60)
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{options['rooms']} rooms x {options['members']} members, {options['messages']} group sends "
+            f"({options['messages'] * options['members']} deliveries)\n"
+        )
+        self.stdout.write(f'{"layer":<10}{"send s":>10}{"total s":>10}{"deliveries/s":>15}{"p50 ms":>10}{"p99 ms":>10}{"lost":>8}')
+        for name in options['layers']:
+            try:
+                layer = self.make_layer(name)
+                result = asyncio.run(self.run(layer, options))
+            except Exception as e:
+                self.stdout.write(self.style.WARNING(f'{name:<10}failed: {e}'))
+                continue
+            self.stdout.write(
+                f'{name:<10}{result["send"]:>10.3f}{result["total"]:>10.3f}{result["rate"]:>15,.0f}'
+                f'{result["p50"]:>10.2f}{result["p99"]:>10.2f}{result["lost"]:>8}'
+            )
+
+    def make_layer(self, name):
+        backend, config = LAYERS[name]
+        if config is None:
+            # Redis is benchmarked with the project's own settings
+            layer_settings = settings.CHANNEL_LAYERS.get('default', {})
+            if layer_settings.get('BACKEND') != backend:
+                layer_settings = {'CONFIG': {'hosts': [('127.0.0.1', 6379)]}}
+            config = layer_settings.get('CONFIG', {})
+        return import_string(backend)(**config)
+
+    async def run(self, layer, options):
+        rooms, members, messages = options['rooms'], options['members'], options['messages']
+        per_room = [messages // rooms + (1 if room < messages % rooms else 0) for room in range(rooms)]
+        latencies = []
+        done = asyncio.Event()
+        expected = messages * members
+
+        async def consume(channel, count):
+            # What ChatConsumer.forward_frame does with each event, minus the socket
+            for _ in range(count):
+                event = await layer.receive(channel)
+                latencies.append(time.perf_counter() - event['sent_at'])
+            if len(latencies) >= expected:
+                done.set()
+
+        consumers = []
+        for room in range(rooms):
+            for _ in range(members):
+                channel = await layer.new_channel()
+                await layer.group_add(room_group_name(room), channel)
+                consumers.append(asyncio.create_task(consume(channel, per_room[room])))
+
+        frame = dumps(sample_chat_message())
+        start = time.perf_counter()
+        for i in range(messages):
+            await layer.group_send(room_group_name(i % rooms), {
+                'type': 'chat_message',
+                'frame': frame,
+                'sent_at': time.perf_counter(),
+            })
+            if i % rooms == 0:
+                # Let consumers drain, as a live server would between incoming frames
+                await asyncio.sleep(0)
+        sent = time.perf_counter() - start
+        try:
+            await asyncio.wait_for(done.wait(), options['timeout'])
+        except asyncio.TimeoutError:
+            pass
+        total = time.perf_counter() - start
+        for task in consumers:
+            task.cancel()
+        await asyncio.gather(*consumers, return_exceptions=True)
+        if hasattr(layer, 'flush'):
+            await layer.flush()
+        if not latencies:
+            raise CommandError('No messages were delivered')
+
+        latencies.sort()
+        return {
+            'send': sent,
+            'total': total,
+            'rate': len(latencies) / total,
+            'p50': statistics.median(latencies) * 1e3,
+            'p99': latencies[int(len(latencies) * 0.99) - 1] * 1e3,
+            'lost': expected - len(latencies),
+        }
@@ -0,0 +1,74 @@
+# chat/management/commands/bench_encoding.py
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chats import encoding
+
+
+def sample_chat_message(i=1):
+    return {
+        'type': 'chat_message',
+        'message_id': 370303856025886720 + i,
+        'sender': 'someone',
+        'sender_id': 42,
+        'content': 'Are we still on for the release review at 3pm? Bringing the numbers 📈',
+        'timestamp': timezone.now().isoformat(),
+        'is_edited': False,
+    }
+
+
+def sample_recent_messages(count=50):
+    return {
+        'type': 'recent_messages',
+        'messages': [
+            dict(sample_chat_message(i), id=i, read_by=list(range(20))) for i in range(count)
+        ],
+    }
+
+
+def time_it(func, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = "Compare stdlib json and orjson on chat frames, and per-recipient vs encode-once fan-out"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000)
+        parser.add_argument('--recipients', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        recipients = options['recipients']
+        encoders = [('json', encoding.dumps_stdlib)]
+        if encoding.orjson is not None:
+            encoders.append(('orjson', encoding.dumps_orjson))
+        else:
+            self.stdout.write(self.style.WARNING('orjson is not installed; only stdlib json is measured'))
+
+        frames = [
+            ('chat_message', sample_chat_message()),
+            ('recent_messages x50', sample_recent_messages()),
+        ]
+        self.stdout.write(f'Active encoder: {encoding.ENCODER}\n')
+        self.stdout.write(f'{"frame":<22}{"encoder":<10}{"per frame":>14}{"frames/sec":>14}')
+        for label, frame in frames:
+            runs = iterations if label == 'chat_message' else max(iterations // 50, 1)
+            for name, dumps in encoders:
+                elapsed = time_it(lambda: dumps(frame), runs)
+                self.stdout.write(f'{label:<22}{name:<10}{elapsed / runs * 1e6:>12.2f}us{runs / elapsed:>14,.0f}')
+
+        # What one chat message to a room of `recipients` members costs in encoding work
+        frame = sample_chat_message()
+        self.stdout.write(f'\nFan-out of one chat_message to {recipients} recipients')
+        for name, dumps in encoders:
+            per_recipient = time_it(lambda: [dumps(frame) for _ in range(recipients)], 20) / 20
+            once = time_it(lambda: dumps(frame), 20) / 20
+            self.stdout.write(
+                f'{name:<10} encode per recipient {per_recipient * 1e3:8.3f}ms   encode once {once * 1e3:8.3f}ms'
+            )
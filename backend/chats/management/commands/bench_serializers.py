@@ -0,0 +1,70 @@
+# chat/management/commands/bench_serializers.py
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from chats.models import Message, User, UserStatus
+from chats.serializers import CompactSerializer, MessageSerializer
+
+
+def build_page(messages, participants, room_id=1):
+    """An in-memory page of messages with every participant's read cursor, no database needed."""
+    now = timezone.now()
+    users = []
+    for i in range(participants):
+        user = User(id=i + 1, username=f'user{i}', email=f'user{i}@example.com')
+        user.chat_status = UserStatus(user=user, is_online=i % 3 == 0, last_seen=now)
+        users.append(user)
+    page = [
+        Message(
+            id=1000 + i,
+            room_id=room_id,
+            sender=users[i % participants],
+            content=f'Message {i} about the release plan and who is bringing the numbers',
+            timestamp=now - timedelta(seconds=messages - i),
+        )
+        for i in range(messages)
+    ]
+    # Spread the read cursors over the page, so read_by lists vary in length
+    readers = [(user, 1000 + (i * messages) // participants) for i, user in enumerate(users)]
+    return page, {room_id: readers}
+
+
+class Command(BaseCommand):
+    help = "Compare MessageSerializer with the compact hand-rolled serializer on a page of messages"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=100)
+        parser.add_argument('--participants', type=int, default=50)
+        parser.add_argument('--iterations', type=int, default=20)
+
+    def handle(self, *args, **options):
+        page, read_states = build_page(options['messages'], options['participants'])
+        iterations = options['iterations']
+        renderer = JSONRenderer()
+
+        def drf():
+            return MessageSerializer(page, many=True, context={'read_states': read_states}).data
+
+        def compact():
+            serializer = CompactSerializer(read_states)
+            return {'results': serializer.messages(page), 'users': serializer.users}
+
+        self.stdout.write(
+            f"{options['messages']} messages, {options['participants']} participants with read cursors\n"
+        )
+        self.stdout.write(f'{"serializer":<12}{"per page":>12}{"pages/sec":>12}{"bytes":>10}')
+        timings = {}
+        for name, func in [('drf', drf), ('compact', compact)]:
+            func()
+            start = time.perf_counter()
+            for _ in range(iterations):
+                data = func()
+            elapsed = (time.perf_counter() - start) / iterations
+            timings[name] = elapsed
+            size = len(renderer.render(data))
+            self.stdout.write(f'{name:<12}{elapsed * 1e3:>10.2f}ms{1 / elapsed:>12,.0f}{size:>10,}')
+        self.stdout.write(f'\ncompact is {timings["drf"] / timings["compact"]:.1f}x faster')
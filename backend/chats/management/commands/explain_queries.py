@@ -0,0 +1,101 @@
+# chat/management/commands/explain_queries.py
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count, Max, OuterRef, Subquery
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from chats.models import ChatRoom, Message, RoomMemberState, RoomParticipant, UserStatus, User
+from chats.search import message_search_sql, search_terms, search_users
+from chats.views import ChatRoomViewSet, MessageViewSet
+
+
+class Command(BaseCommand):
+    help = "Print EXPLAIN plans for the ORM queries issued by the chat views and consumer"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', type=int, help='Room id to plan against (defaults to the busiest room)')
+        parser.add_argument('--user', type=int, help='User id to plan as (defaults to a participant of the room)')
+        parser.add_argument('--query', default='hello', help='Search text for the search queries')
+
+    def handle(self, *args, **options):
+        room = self.get_room(options['room'])
+        user = self.get_user(room, options['user'])
+
+        self.query = options['query']
+        for label, queryset in self.get_queries(room, user):
+            self.stdout.write(self.style.MIGRATE_HEADING(label))
+            if isinstance(queryset, tuple):
+                self.stdout.write(queryset[0])
+                self.stdout.write(self.explain_sql(*queryset))
+            else:
+                self.stdout.write(str(queryset.query))
+                self.stdout.write(queryset.explain())
+            self.stdout.write('')
+
+    def explain_sql(self, sql, params):
+        # Raw SQL entries (the full-text search) have no queryset to call explain() on
+        with connection.cursor() as cursor:
+            cursor.execute(connection.ops.explain_query_prefix() + ' ' + sql, params)
+            return '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+
+    def get_room(self, room_id):
+        if room_id:
+            try:
+                return ChatRoom.objects.get(id=room_id)
+            except ChatRoom.DoesNotExist:
+                raise CommandError(f'Room {room_id} does not exist')
+        room = ChatRoom.objects.annotate(message_count=Count('messages')).order_by('-message_count').first()
+        if room is None:
+            raise CommandError('No rooms to plan against; create one or pass --room')
+        return room
+
+    def get_user(self, room, user_id):
+        if user_id:
+            try:
+                return User.objects.get(id=user_id)
+            except User.DoesNotExist:
+                raise CommandError(f'User {user_id} does not exist')
+        user = room.participants.first() or room.created_by
+        return user
+
+    def viewset_queryset(self, viewset_class, user, params=None):
+        request = Request(APIRequestFactory().get('/', params or {}))
+        request.user = user
+        return viewset_class(request=request, format_kwarg=None).get_queryset()
+
+    def get_queries(self, room, user):
+        return [
+            # ChatRoomViewSet
+            ('ChatRoomViewSet.get_queryset', self.viewset_queryset(ChatRoomViewSet, user)),
+            ('ChatRoomViewSet.mark_all_read (last message)',
+             Message.objects.filter(room=room).order_by('-id').values('id')[:1]),
+            # MessageViewSet
+            ('MessageViewSet.get_queryset', self.viewset_queryset(MessageViewSet, user, {'room_id': room.id})),
+            ('MessageViewSet.unread_count',
+             RoomMemberState.objects.filter(user=user, room=room).values('unread_count')),
+            ('RoomMemberState.recount_unread',
+             Message.objects.filter(room=room, id__gt=RoomMemberState.last_read(user.id, room.id)).exclude(sender=user)),
+            ('RoomMemberState.readers',
+             RoomMemberState.objects.filter(room=room, last_read_message_id__gt=0).select_related('user__chat_status')),
+            ('MessageViewSet.search (search_message_ids)',
+             message_search_sql(user.id, search_terms(self.query) or ['hello'])),
+            ('MessageViewSet.search (search_message_ids, recent in room)',
+             message_search_sql(user.id, search_terms(self.query) or ['hello'], room_id=room.id, order='recent')),
+            # UserViewSet
+            ('UserViewSet.search (search_users)', search_users(user, self.query)[:10]),
+            # ChatConsumer
+            ('load_room_entry (membership)',
+             RoomParticipant.objects.filter(room_id=room.id).values_list('user_id', 'user__username')),
+            ('get_recent_messages',
+             Message.objects.filter(room=room).select_related('sender').order_by('-id')[:50]),
+            ('get_recent_messages (multiplexed floors)', ChatRoom.objects.filter(id=room.id).annotate(floor=Subquery(
+                Message.objects.filter(room_id=OuterRef('pk')).order_by('-id').values('id')[49:50]
+            ))),
+            ('ReceiptAggregator.persist (newest message)',
+             Message.objects.filter(room_id__in=[room.id]).values('room_id').annotate(newest=Max('id')).order_by()),
+            ('get_online_user_ids (presence)',
+             UserStatus.objects.filter(user_id__in=list(room.participants.values_list('id', flat=True)), is_online=True)
+             .values_list('user_id', flat=True)),
+            ('Online users', UserStatus.objects.filter(is_online=True)),
+        ]
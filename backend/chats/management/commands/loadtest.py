@@ -0,0 +1,365 @@
+# chat/management/commands/loadtest.py
+import asyncio
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from importlib import import_module
+
+from chats.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+
+from accounts.serializers import issue_tokens
+from chats.encoding import loads
+from chats.lifespan import run_shutdown_hooks
+from chats.models import ChatRoom, Message, User
+
+USER_PREFIX = 'loadtest_'
+HOST = 'localhost'
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class QueryCounter:
+    """Counts queries on every database connection opened while it is installed.
+
+    Consumers run their ORM calls on per-connection sync threads, each with its own
+    connection, so the counter is attached to each connection as it is created.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def attach(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def install(self):
+        connection_created.connect(self.attach)
+        for conn in connections.all(initialized_only=True):
+            self.attach(None, conn)
+
+    def uninstall(self):
+        connection_created.disconnect(self.attach)
+
+
+class SimulatedUser:
+    def __init__(self, harness, user, room_id):
+        self.harness = harness
+        self.user = user
+        self.room_id = room_id
+        self.communicator = None
+        self.reader = None
+        self.last_message_id = 0
+        self.received = 0
+
+    async def connect(self):
+        self.communicator = WebsocketCommunicator(
+            self.harness.application,
+            self.harness.socket_path(self),
+            headers=self.harness.socket_headers(self),
+        )
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise RuntimeError(f'{self.user.username} could not connect to room {self.room_id}')
+        self.reader = asyncio.create_task(self.read())
+
+    async def read(self):
+        # Read the output queue directly: receive_from() cancels the app on timeout
+        while True:
+            message = await self.communicator.output_queue.get()
+            if message['type'] != 'websocket.send' or not message.get('text'):
+                continue
+            frame = loads(message['text'])
+            # Lagging sockets get their frames coalesced into batches
+            for frame in frame['frames'] if frame.get('type') == 'batch' else [frame]:
+                self.received += 1
+                if frame.get('type') == 'chat_message':
+                    self.last_message_id = max(self.last_message_id, frame['message_id'])
+                    self.harness.record_delivery(frame['content'])
+
+    async def send(self, data):
+        await self.communicator.send_json_to(data)
+
+    async def disconnect(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        await self.communicator.disconnect()
+
+
+class Command(BaseCommand):
+    help = "Simulate N users across M rooms against backend.asgi.application and report latency and cost"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--rooms', type=int, default=10)
+        parser.add_argument('--messages', type=int, default=5, help='Chat messages sent per user')
+        parser.add_argument('--typing', type=int, default=10, help='typing_start frames sent per user')
+        parser.add_argument('--think-time', type=float, default=0.01, help='Max random pause between sends (seconds)')
+        parser.add_argument('--settle', type=float, default=1.0, help='Seconds to wait for deliveries after each phase')
+        parser.add_argument('--rest-requests', type=int, default=50)
+        parser.add_argument('--channel-layer', choices=['memory', 'sharded', 'settings'], default='memory',
+                            help='Use an in-memory channel layer (stock or sharded) or the one in settings.CHANNEL_LAYERS')
+        parser.add_argument('--auth', choices=['jwt', 'session'], default='jwt',
+                            help='Authenticate sockets with an access token or a Django session cookie')
+        parser.add_argument('--live-database', action='store_true',
+                            help='Run against the configured database instead of a throwaway test database; '
+                                 'deletes every user and room whose name starts with loadtest_')
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the generated users, rooms and messages (with --live-database)')
+
+    def handle(self, *args, **options):
+        self.options = options
+        layers = settings.CHANNEL_LAYERS
+        if options['channel_layer'] == 'memory':
+            layers = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 10000}}}
+        elif options['channel_layer'] == 'sharded':
+            layers = {'default': {'BACKEND': 'chats.layers.ShardedChannelLayer', 'CONFIG': {'capacity': 10000}}}
+
+        live = options['live_database']
+        old_name = None if live else self.create_test_database()
+        self.stdout.write(f"Database: {connection.vendor} ({settings.DATABASES['default']['NAME']})")
+        self.stdout.write(f"Channel layer: {layers['default']['BACKEND']}")
+        try:
+            if live:
+                self.cleanup()
+            users, rooms = self.create_fixtures(options['users'], options['rooms'])
+            with override_settings(CHANNEL_LAYERS=layers):
+                from backend.asgi import application
+                self.application = application
+                asyncio.run(self.run_websocket(users, rooms))
+            self.run_rest(users, rooms)
+        finally:
+            if live and not options['keep']:
+                self.cleanup()
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                if self.temp_dir:
+                    os.rmdir(self.temp_dir)
+
+    def create_test_database(self):
+        # Like the test runner: a fresh, migrated database that is dropped afterwards
+        test = connection.settings_dict.setdefault('TEST', {})
+        self.temp_dir = None
+        if connection.vendor == 'sqlite' and not test.get('NAME'):
+            # A file rather than SQLite's in-memory default, which shares one lock between threads
+            self.temp_dir = tempfile.mkdtemp()
+            test['NAME'] = os.path.join(self.temp_dir, 'loadtest.sqlite3')
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        return old_name
+
+    # Fixtures
+    def create_fixtures(self, user_count, room_count):
+        User.objects.bulk_create([
+            User(username=f'{USER_PREFIX}{i}', email=f'{USER_PREFIX}{i}@example.com', password='!')
+            for i in range(user_count)
+        ])
+        users = list(User.objects.filter(username__startswith=USER_PREFIX).order_by('id'))
+        rooms = [
+            ChatRoom.objects.create(name=f'{USER_PREFIX}room_{i}', room_type='group', created_by=users[0])
+            for i in range(room_count)
+        ]
+        for index, user in enumerate(users):
+            rooms[index % room_count].participants.add(user)
+        return users, rooms
+
+    def cleanup(self):
+        ChatRoom.objects.filter(name__startswith=USER_PREFIX).delete()
+        User.objects.filter(username__startswith=USER_PREFIX).delete()
+
+    # WebSocket auth: an access token or a logged-in Django session per simulated user
+    def create_credentials(self, user):
+        if self.options['auth'] == 'jwt':
+            return str(issue_tokens(user).access_token)
+        return self.create_session(user)
+
+    def create_session(self, user):
+        store = import_module(settings.SESSION_ENGINE).SessionStore()
+        store[SESSION_KEY] = str(user.pk)
+        store[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        store[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        store.create()
+        return store.session_key
+
+    def socket_path(self, simulated):
+        if self.options['auth'] == 'jwt':
+            return f'/ws/chat/{simulated.room_id}/?token={simulated.credentials}'
+        return f'/ws/chat/{simulated.room_id}/'
+
+    def socket_headers(self, simulated):
+        headers = [
+            (b'origin', f'http://{HOST}'.encode()),
+            (b'host', HOST.encode()),
+        ]
+        if self.options['auth'] == 'session':
+            headers.append((b'cookie', f'{settings.SESSION_COOKIE_NAME}={simulated.credentials}'.encode()))
+        return headers
+
+    # Measurements
+    def record_delivery(self, content):
+        sent_at = self.sent_at.get(content)
+        if sent_at is not None:
+            self.last_delivery = time.perf_counter()
+            self.latencies.append(self.last_delivery - sent_at)
+
+    async def count_queries(self, phase, operations, coroutine):
+        before = self.queries.count
+        started = time.perf_counter()
+        await coroutine
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(self.options['settle'])
+        queries = self.queries.count - before
+        self.phases.append((phase, operations, elapsed, queries))
+
+    async def think(self):
+        if self.options['think_time']:
+            await asyncio.sleep(random.random() * self.options['think_time'])
+
+    async def run_websocket(self, users, rooms):
+        self.sent_at = {}
+        self.latencies = []
+        self.phases = []
+        self.queries = QueryCounter()
+
+        room_ids = [room.id for room in rooms]
+        simulated = []
+        for index, user in enumerate(users):
+            sim = SimulatedUser(self, user, room_ids[index % len(room_ids)])
+            sim.credentials = await database_sync_to_async(self.create_credentials)(user)
+            simulated.append(sim)
+
+        self.queries.install()
+        try:
+            await self.run_phases(simulated)
+            # Flush write-behind messages and presence before reporting and cleanup
+            await run_shutdown_hooks()
+        finally:
+            self.queries.uninstall()
+        self.report_websocket(simulated)
+
+    async def run_phases(self, simulated):
+        options = self.options
+
+        tracemalloc.start()
+        memory_before = tracemalloc.take_snapshot()
+        await self.count_queries('connect', len(simulated), asyncio.gather(*(sim.connect() for sim in simulated)))
+        memory_after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        allocated = sum(stat.size_diff for stat in memory_after.compare_to(memory_before, 'filename'))
+        self.memory_per_connection = allocated / max(len(simulated), 1)
+
+        async def send_messages(sim):
+            for i in range(options['messages']):
+                content = f'{sim.user.id}:{i}'
+                self.sent_at[content] = time.perf_counter()
+                await sim.send({'type': 'chat_message', 'message': content})
+                await self.think()
+
+        async def send_typing(sim):
+            for _ in range(options['typing']):
+                await sim.send({'type': 'typing_start'})
+                await self.think()
+
+        async def send_receipts(sim):
+            if sim.last_message_id:
+                await sim.send({'type': 'read_receipt', 'message_id': sim.last_message_id})
+
+        self.send_started = self.last_delivery = time.perf_counter()
+        await self.count_queries(
+            'chat_message', options['messages'] * len(simulated),
+            asyncio.gather(*(send_messages(sim) for sim in simulated)),
+        )
+        # From the first send to the last delivery
+        self.send_elapsed = max(self.last_delivery - self.send_started, 1e-6)
+        await self.count_queries(
+            'typing_start', options['typing'] * len(simulated),
+            asyncio.gather(*(send_typing(sim) for sim in simulated)),
+        )
+        await self.count_queries(
+            'read_receipt', len(simulated),
+            asyncio.gather(*(send_receipts(sim) for sim in simulated)),
+        )
+        await self.count_queries('disconnect', len(simulated), asyncio.gather(*(sim.disconnect() for sim in simulated)))
+
+    def report_websocket(self, simulated):
+        options = self.options
+        sent = options['messages'] * len(simulated)
+        delivered = len(self.latencies)
+        expected = sum(
+            options['messages'] * sum(1 for other in simulated if other.room_id == sim.room_id)
+            for sim in simulated
+        )
+        latencies_ms = [latency * 1000 for latency in self.latencies]
+
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"\nWebSocket: {len(simulated)} users in {options['rooms']} rooms"
+        ))
+        self.stdout.write(f'  messages sent         {sent} ({sent / self.send_elapsed:,.0f}/sec)')
+        self.stdout.write(f'  deliveries            {delivered}/{expected} ({delivered / self.send_elapsed:,.0f}/sec)')
+        if latencies_ms:
+            self.stdout.write(
+                f'  fan-out latency       p50 {percentile(latencies_ms, 50):.1f}ms  '
+                f'p95 {percentile(latencies_ms, 95):.1f}ms  p99 {percentile(latencies_ms, 99):.1f}ms  '
+                f'max {max(latencies_ms):.1f}ms'
+            )
+        self.stdout.write(f'  memory per connection {self.memory_per_connection / 1024:.1f} KiB (server and test client)')
+        self.stdout.write(f'  frames received       {sum(sim.received for sim in simulated)}')
+        self.stdout.write(f"\n  {'operation':<16}{'count':>8}{'seconds':>10}{'queries':>10}{'queries/op':>12}")
+        for phase, operations, elapsed, queries in self.phases:
+            self.stdout.write(
+                f'  {phase:<16}{operations:>8}{elapsed:>10.2f}{queries:>10}{queries / max(operations, 1):>12.2f}'
+            )
+
+    # REST
+    def run_rest(self, users, rooms):
+        client = APIClient(HTTP_HOST=HOST)
+        requests = self.options['rest_requests']
+        endpoints = [
+            ('GET rooms', lambda room: '/api/chat/rooms/'),
+            ('GET messages', lambda room: f'/api/chat/messages/?room_id={room.id}'),
+            ('GET unread_count', lambda room: f'/api/chat/messages/unread_count/?room_id={room.id}'),
+        ]
+
+        self.stdout.write(self.style.MIGRATE_HEADING('\nREST'))
+        self.stdout.write(f"  {'endpoint':<18}{'requests':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries/req':>13}")
+        for label, path in endpoints:
+            timings = []
+            queries = 0
+            for i in range(requests):
+                room = rooms[i % len(rooms)]
+                user = room.participants.first()
+                client.force_authenticate(user)
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    response = client.get(path(room))
+                    timings.append((time.perf_counter() - started) * 1000)
+                if response.status_code != 200:
+                    self.stderr.write(f'{label} returned {response.status_code}')
+                queries += len(captured)
+            self.stdout.write(
+                f'  {label:<18}{requests:>9}{percentile(timings, 50):>9.1f}{percentile(timings, 95):>9.1f}'
+                f'{percentile(timings, 99):>9.1f}{queries / requests:>13.2f}'
+            )
+        self.stdout.write(f'\n  messages stored: {Message.objects.filter(room__in=rooms).count()}')
@@ -0,0 +1,41 @@
+# chat/management/commands/rebuild_summaries.py
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chats.summaries import find_drift, rebuild
+
+
+class Command(BaseCommand):
+    help = "Check RoomSummary and RoomMemberState.unread_count against the messages, and rebuild them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, nargs='+', help='Only these room ids (defaults to every room)')
+        parser.add_argument('--check', action='store_true', help='Report drift and exit non-zero if any, without rebuilding')
+        parser.add_argument('--show', type=int, default=20, help='Drifted rows to print per kind')
+
+    def handle(self, *args, **options):
+        room_ids = options['rooms']
+        summaries, states, missing = find_drift(room_ids)
+        show = options['show']
+
+        for room_id, field, stored, expected in summaries[:show]:
+            self.stdout.write(f'room {room_id}: {field} is {stored!r}, expected {expected!r}')
+        for user_id, room_id, stored, expected in states[:show]:
+            self.stdout.write(f'user {user_id} in room {room_id}: unread_count is {stored}, expected {expected}')
+        for user_id, room_id in missing[:show]:
+            self.stdout.write(f'user {user_id} in room {room_id}: no read state')
+        drifted = len(summaries) + len(states) + len(missing)
+        self.stdout.write(
+            f'{len(summaries)} summary fields, {len(states)} unread counts and {len(missing)} read states drifted'
+        )
+
+        if options['check']:
+            if drifted:
+                raise CommandError('Summaries have drifted; run rebuild_summaries to fix them')
+            self.stdout.write(self.style.SUCCESS('Summaries are up to date'))
+            return
+
+        start = time.perf_counter()
+        rebuild(room_ids)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt summaries in {time.perf_counter() - start:.2f}s'))
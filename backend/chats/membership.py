@@ -0,0 +1,81 @@
+# chat/membership.py
+import logging
+
+from asgiref.sync import async_to_sync
+from django.db import transaction
+
+from .cache import invalidate_room
+from .groups import broadcast_to_room
+from .models import RoomParticipant, User
+from .summaries import drop_member_states, ensure_member_states
+
+logger = logging.getLogger(__name__)
+
+
+def parse_user_ids(user_ids):
+    """Distinct positive integer ids, in the order given; anything else is dropped."""
+    parsed = []
+    for user_id in user_ids or []:
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            continue
+        if user_id > 0 and user_id not in parsed:
+            parsed.append(user_id)
+    return parsed
+
+
+def existing_users(user_ids):
+    """{id: username} for the ids that belong to users, in one query."""
+    return dict(User.objects.filter(id__in=user_ids).values_list('id', 'username'))
+
+
+def add_members(room, users):
+    """Add {user_id: username} to a room; returns the ones that weren't members yet.
+
+    Reads current membership and inserts the rest with one bulk_create, so adding a
+    thousand users costs the same three queries as adding one.
+    """
+    current = set(RoomParticipant.objects.filter(room=room, user_id__in=users).values_list('user_id', flat=True))
+    added = {user_id: username for user_id, username in users.items() if user_id not in current}
+    if added:
+        RoomParticipant.objects.bulk_create(
+            [RoomParticipant(room=room, user_id=user_id) for user_id in added],
+            ignore_conflicts=True,
+        )
+        ensure_member_states(room.pk, added)
+        invalidate_room(room.pk)
+    return added
+
+
+def remove_members(room, user_ids):
+    """Remove users from a room; returns the ids that were members."""
+    memberships = RoomParticipant.objects.filter(room=room, user_id__in=user_ids)
+    removed = list(memberships.values_list('user_id', flat=True))
+    if removed:
+        RoomParticipant.objects.filter(room=room, user_id__in=removed).delete()
+        drop_member_states([room.pk], removed)
+        invalidate_room(room.pk)
+    return removed
+
+
+def notify_membership(room_id, added, removed):
+    """Tell the room's sockets who joined and left, in one `membership` frame, once committed."""
+    if not added and not removed:
+        return
+    data = {
+        'type': 'membership',
+        'room_id': room_id,
+        'added': [{'id': user_id, 'username': username} for user_id, username in added.items()],
+        'removed': list(removed),
+    }
+
+    def send():
+        # Again after commit, in case a reader cached the old membership in between
+        invalidate_room(room_id)
+        try:
+            async_to_sync(broadcast_to_room)(room_id, data)
+        except Exception:
+            logger.exception(f"Failed to send membership change for room {room_id}")
+
+    transaction.on_commit(send)
@@ -0,0 +1,31 @@
+# chat/metrics.py
+import threading
+from collections import defaultdict
+
+# Process-local counters and gauges for the chat hot paths.
+# Exposed to staff through MetricsView at /api/chat/metrics/.
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_gauges = {}
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def register_gauge(name, func):
+    """Register a callable that is evaluated whenever a snapshot is taken."""
+    _gauges[name] = func
+
+
+def snapshot():
+    with _lock:
+        counters = dict(_counters)
+    gauges = {}
+    for name, func in list(_gauges.items()):
+        try:
+            gauges[name] = func()
+        except Exception:
+            gauges[name] = None
+    return {'counters': counters, 'gauges': gauges}
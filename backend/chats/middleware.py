@@ -0,0 +1,109 @@
+# chat/middleware.py
+import asyncio
+import logging
+import time
+from urllib.parse import parse_qs
+
+from channels.auth import AuthMiddlewareStack
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.utils import timezone
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import metrics
+from .db import database_sync_to_async
+
+logger = logging.getLogger(__name__)
+
+# Browsers can't set headers on WebSocket handshakes, so the token may come as the
+# second entry of `new WebSocket(url, ['access_token', token])`
+TOKEN_SUBPROTOCOL = 'access_token'
+
+
+class BlacklistCache:
+    """Blacklisted refresh-token jtis, reloaded at most every `ttl` seconds per process."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.jtis = frozenset()
+        self.expires_at = 0
+        self.lock = None
+
+    async def contains(self, jti):
+        if time.monotonic() >= self.expires_at:
+            await self.refresh()
+        return jti in self.jtis
+
+    async def refresh(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if time.monotonic() < self.expires_at:
+                return
+            self.jtis = await database_sync_to_async(self.load)()
+            self.expires_at = time.monotonic() + self.ttl
+            metrics.incr('jwt_blacklist.reloads')
+
+    def load(self):
+        # Tokens past their expiry are rejected anyway, so only live ones matter
+        return frozenset(BlacklistedToken.objects.filter(
+            token__expires_at__gt=timezone.now()
+        ).values_list('token__jti', flat=True))
+
+
+blacklist_cache = BlacklistCache(settings.CHAT_JWT_BLACKLIST_TTL)
+
+
+def get_raw_token(scope):
+    query = parse_qs(scope.get('query_string', b'').decode())
+    if query.get('token'):
+        return query['token'][0]
+    subprotocols = scope.get('subprotocols') or []
+    if TOKEN_SUBPROTOCOL in subprotocols:
+        index = subprotocols.index(TOKEN_SUBPROTOCOL)
+        if index + 1 < len(subprotocols):
+            return subprotocols[index + 1]
+    return None
+
+
+async def get_token_user(raw_token):
+    """Validate a simplejwt access token and build a TokenUser from its claims, without touching the DB."""
+    try:
+        token = AccessToken(raw_token)
+    except TokenError as e:
+        logger.info(f"WebSocket token rejected: {e}")
+        metrics.incr('jwt_auth.rejected')
+        return AnonymousUser()
+    if await blacklist_cache.contains(token.get('sid')):
+        logger.info(f"WebSocket token rejected: session {token.get('sid')} is blacklisted")
+        metrics.incr('jwt_auth.revoked')
+        return AnonymousUser()
+    metrics.incr('jwt_auth.accepted')
+    return TokenUser(token)
+
+
+class JWTAuthMiddleware:
+    """Authenticate WebSocket handshakes from a simplejwt access token.
+
+    Handshakes with a token get a TokenUser (or AnonymousUser if the token is invalid
+    or revoked) and never load a session or user row. Handshakes without one fall back
+    to `fallback`, the session-based AuthMiddlewareStack.
+    """
+
+    def __init__(self, inner, fallback):
+        self.inner = inner
+        self.fallback = fallback
+
+    async def __call__(self, scope, receive, send):
+        raw_token = get_raw_token(scope)
+        if raw_token is None:
+            return await self.fallback(scope, receive, send)
+        scope = dict(scope, user=await get_token_user(raw_token))
+        return await self.inner(scope, receive, send)
+
+
+def JWTAuthMiddlewareStack(inner):
+    return JWTAuthMiddleware(inner, fallback=AuthMiddlewareStack(inner))
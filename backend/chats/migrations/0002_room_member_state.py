@@ -0,0 +1,67 @@
+# Generated by Django 5.0.4 on 2026-10-18 20:11
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def read_by_to_cursors(apps, schema_editor):
+    # A user's cursor becomes the newest message they had read in each room
+    Message = apps.get_model('chats', 'Message')
+    RoomMemberState = apps.get_model('chats', 'RoomMemberState')
+    ReadBy = Message.read_by.through
+
+    rows = ReadBy.objects.values('user_id', 'message__room_id').annotate(last_read=Max('message_id')).order_by()
+    RoomMemberState.objects.bulk_create(
+        [
+            RoomMemberState(user_id=row['user_id'], room_id=row['message__room_id'], last_read_message_id=row['last_read'])
+            for row in rows.iterator()
+        ],
+        batch_size=1000,
+    )
+
+
+def cursors_to_read_by(apps, schema_editor):
+    Message = apps.get_model('chats', 'Message')
+    RoomMemberState = apps.get_model('chats', 'RoomMemberState')
+    ReadBy = Message.read_by.through
+
+    for state in RoomMemberState.objects.iterator():
+        message_ids = Message.objects.filter(
+            room_id=state.room_id, id__lte=state.last_read_message_id
+        ).exclude(sender_id=state.user_id).values_list('id', flat=True)
+        ReadBy.objects.bulk_create(
+            [ReadBy(message_id=message_id, user_id=state.user_id) for message_id in message_ids.iterator()],
+            batch_size=1000,
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomMemberState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='member_states', to='chats.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='room_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'room')},
+            },
+        ),
+        migrations.RunPython(read_by_to_cursors, cursors_to_read_by),
+        migrations.RemoveField(
+            model_name='message',
+            name='read_by',
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.4 on 2026-10-18 20:12
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0002_room_member_state'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='message',
+            options={'ordering': ['id']},
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'timestamp'], name='chats_msg_room_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'id'], name='chats_msg_room_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userstatus',
+            index=models.Index(fields=['is_online'], name='chats_status_online_idx'),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.0.4 on 2026-10-18 21:02
+
+from django.db import migrations
+
+# Frozen copies of the statements in chats.search as they stood for this schema.
+# SQLite: an external-content FTS5 table over chats_message, kept in sync by triggers.
+# Postgres: a generated tsvector column with a GIN index.
+FORWARD = {
+    'sqlite': [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS chats_message_fts USING fts5(
+            content, content='chats_message', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS chats_message_fts_insert AFTER INSERT ON chats_message BEGIN
+            INSERT INTO chats_message_fts(rowid, content) VALUES (new.id, new.content);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS chats_message_fts_delete AFTER DELETE ON chats_message BEGIN
+            INSERT INTO chats_message_fts(chats_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS chats_message_fts_update AFTER UPDATE OF content ON chats_message BEGIN
+            INSERT INTO chats_message_fts(chats_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO chats_message_fts(rowid, content) VALUES (new.id, new.content);
+        END
+        """,
+        "INSERT INTO chats_message_fts(chats_message_fts) VALUES ('rebuild')",
+    ],
+    'postgresql': [
+        """
+        ALTER TABLE chats_message ADD COLUMN search_vector tsvector
+            GENERATED ALWAYS AS (to_tsvector('simple', coalesce(content, ''))) STORED
+        """,
+        "CREATE INDEX chats_message_search_idx ON chats_message USING GIN (search_vector)",
+    ],
+}
+BACKWARD = {
+    'sqlite': [
+        "DROP TRIGGER IF EXISTS chats_message_fts_update",
+        "DROP TRIGGER IF EXISTS chats_message_fts_delete",
+        "DROP TRIGGER IF EXISTS chats_message_fts_insert",
+        "DROP TABLE IF EXISTS chats_message_fts",
+    ],
+    'postgresql': [
+        "DROP INDEX IF EXISTS chats_message_search_idx",
+        "ALTER TABLE chats_message DROP COLUMN IF EXISTS search_vector",
+    ],
+}
+
+
+def create_search_index(apps, schema_editor):
+    for statement in FORWARD.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    for statement in BACKWARD.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0004_message_timestamp_default'),
+    ]
+
+    operations = [
+        # Vendor-specific: FTS5 on SQLite, a tsvector column with a GIN index on Postgres
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,89 @@
+# Generated by Django 5.0.4 on 2026-10-18 21:40
+
+from django.conf import settings
+from django.db import migrations
+
+# Frozen copies of the statements in chats.search as they stood for this schema; {table}
+# is the user table. SQLite: a trigram FTS5 table over it plus NOCASE prefix indexes.
+# Postgres: pg_trgm GIN indexes on the UPPER(...::text) expressions that icontains
+# compiles to, plus text_pattern_ops indexes for istartswith.
+FORWARD = {
+    'sqlite': [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS chats_user_search USING fts5(
+            username, email, content='{table}', content_rowid='id', tokenize='trigram'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS chats_user_search_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO chats_user_search(rowid, username, email) VALUES (new.id, new.username, new.email);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS chats_user_search_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO chats_user_search(chats_user_search, rowid, username, email)
+                VALUES ('delete', old.id, old.username, old.email);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS chats_user_search_update AFTER UPDATE OF username, email ON {table} BEGIN
+            INSERT INTO chats_user_search(chats_user_search, rowid, username, email)
+                VALUES ('delete', old.id, old.username, old.email);
+            INSERT INTO chats_user_search(rowid, username, email) VALUES (new.id, new.username, new.email);
+        END
+        """,
+        "CREATE INDEX IF NOT EXISTS chats_user_username_prefix_idx ON {table} (username COLLATE NOCASE)",
+        "CREATE INDEX IF NOT EXISTS chats_user_email_prefix_idx ON {table} (email COLLATE NOCASE)",
+        "INSERT INTO chats_user_search(chats_user_search) VALUES ('rebuild')",
+    ],
+    'postgresql': [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "CREATE INDEX IF NOT EXISTS chats_user_username_trgm_idx ON {table} USING GIN ((UPPER(username::text)) gin_trgm_ops)",
+        "CREATE INDEX IF NOT EXISTS chats_user_email_trgm_idx ON {table} USING GIN ((UPPER(email::text)) gin_trgm_ops)",
+        "CREATE INDEX IF NOT EXISTS chats_user_username_prefix_idx ON {table} ((UPPER(username::text)) text_pattern_ops)",
+        "CREATE INDEX IF NOT EXISTS chats_user_email_prefix_idx ON {table} ((UPPER(email::text)) text_pattern_ops)",
+    ],
+}
+BACKWARD = {
+    'sqlite': [
+        "DROP INDEX IF EXISTS chats_user_email_prefix_idx",
+        "DROP INDEX IF EXISTS chats_user_username_prefix_idx",
+        "DROP TRIGGER IF EXISTS chats_user_search_update",
+        "DROP TRIGGER IF EXISTS chats_user_search_delete",
+        "DROP TRIGGER IF EXISTS chats_user_search_insert",
+        "DROP TABLE IF EXISTS chats_user_search",
+    ],
+    'postgresql': [
+        "DROP INDEX IF EXISTS chats_user_email_prefix_idx",
+        "DROP INDEX IF EXISTS chats_user_username_prefix_idx",
+        "DROP INDEX IF EXISTS chats_user_email_trgm_idx",
+        "DROP INDEX IF EXISTS chats_user_username_trgm_idx",
+    ],
+}
+
+
+def run_statements(apps, schema_editor, statements):
+    table = apps.get_model(settings.AUTH_USER_MODEL)._meta.db_table
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement.format(table=table))
+
+
+def create_user_search_index(apps, schema_editor):
+    run_statements(apps, schema_editor, FORWARD)
+
+
+def drop_user_search_index(apps, schema_editor):
+    run_statements(apps, schema_editor, BACKWARD)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chats', '0005_message_search'),
+    ]
+
+    operations = [
+        # Vendor-specific: trigram FTS5 and NOCASE indexes on SQLite, pg_trgm on Postgres
+        migrations.RunPython(create_user_search_index, drop_user_search_index),
+    ]
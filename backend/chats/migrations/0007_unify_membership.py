@@ -0,0 +1,62 @@
+# Generated by Django 5.0.4 on 2026-10-18 22:30
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def copy_participants(apps, schema_editor):
+    # Move the auto-created participants table into RoomParticipant, then drop it
+    ChatRoom = apps.get_model('chats', 'ChatRoom')
+    RoomParticipant = apps.get_model('chats', 'RoomParticipant')
+    Through = ChatRoom.participants.through
+    db_alias = schema_editor.connection.alias
+    rows = Through.objects.using(db_alias).values_list('chatroom_id', 'user_id').iterator(chunk_size=2000)
+    batch = []
+    for room_id, user_id in rows:
+        batch.append(RoomParticipant(room_id=room_id, user_id=user_id))
+        if len(batch) >= 2000:
+            RoomParticipant.objects.using(db_alias).bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    RoomParticipant.objects.using(db_alias).bulk_create(batch, ignore_conflicts=True)
+    schema_editor.delete_model(Through)
+
+
+def restore_participants(apps, schema_editor):
+    ChatRoom = apps.get_model('chats', 'ChatRoom')
+    RoomParticipant = apps.get_model('chats', 'RoomParticipant')
+    Through = ChatRoom.participants.through
+    db_alias = schema_editor.connection.alias
+    schema_editor.create_model(Through)
+    Through.objects.using(db_alias).bulk_create(
+        [
+            Through(chatroom_id=room_id, user_id=user_id)
+            for room_id, user_id in RoomParticipant.objects.using(db_alias).values_list('room_id', 'user_id')
+        ],
+        batch_size=2000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chats', '0006_user_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_participants, restore_participants),
+        # The table already exists, so only the state learns that it is the through model
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='chatroom',
+                    name='participants',
+                    field=models.ManyToManyField(blank=True, related_name='chat_rooms', through='chats.RoomParticipant', to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='roomparticipant',
+            index=models.Index(fields=['room', 'user'], name='chats_participant_room_idx'),
+        ),
+    ]
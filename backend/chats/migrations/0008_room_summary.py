@@ -0,0 +1,66 @@
+# Generated by Django 5.0.4 on 2026-10-18 23:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def build_summaries(apps, schema_editor):
+    # Frozen copy of chats.summaries.rebuild as it stood for this schema
+    connection = schema_editor.connection
+
+    def table(name):
+        return connection.ops.quote_name(apps.get_model('chats', name)._meta.db_table)
+
+    summaries, rooms, messages = table('RoomSummary'), table('ChatRoom'), table('Message')
+    states, participants = table('RoomMemberState'), table('RoomParticipant')
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {summaries} (room_id, last_message_id, last_message_preview, last_message_at, "
+            f"message_count, updated_at) "
+            f"SELECT r.id, COALESCE(s.last_id, 0), COALESCE(SUBSTR(m.content, 1, 100), ''), "
+            f"m.timestamp, COALESCE(s.total, 0), %s FROM {rooms} r "
+            f"LEFT JOIN (SELECT room_id, MAX(id) AS last_id, COUNT(*) AS total FROM {messages} "
+            f"GROUP BY room_id) s ON s.room_id = r.id LEFT JOIN {messages} m ON m.id = s.last_id",
+            [now],
+        )
+        cursor.execute(
+            f"INSERT INTO {states} (user_id, room_id, last_read_message_id, unread_count, updated_at) "
+            f"SELECT p.user_id, p.room_id, 0, 0, %s FROM {participants} p WHERE NOT EXISTS ("
+            f"SELECT 1 FROM {states} s WHERE s.user_id = p.user_id AND s.room_id = p.room_id)",
+            [now],
+        )
+        cursor.execute(
+            f"UPDATE {states} SET unread_count = ("
+            f"SELECT COUNT(*) FROM {messages} m WHERE m.room_id = {states}.room_id "
+            f"AND m.id > {states}.last_read_message_id AND m.sender_id <> {states}.user_id)"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0007_unify_membership'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomSummary',
+            fields=[
+                ('room', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='chats.chatroom')),
+                ('last_message_id', models.BigIntegerField(default=0)),
+                ('last_message_preview', models.CharField(blank=True, max_length=100)),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='roommemberstate',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        # Summaries and unread counts for the messages already there
+        migrations.RunPython(build_summaries, migrations.RunPython.noop),
+    ]
@@ -1,10 +1,14 @@
 # chat/models.py
-from django.db import models
+from django.db import models, connection
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 
 User = get_user_model()
 
+# Cursors per statement in RoomMemberState's raw SQL; 5 parameters a row stays under
+# SQLite's default limit of 999 bound parameters
+CURSOR_BATCH_SIZE = 150
+
 class ChatRoom(models.Model):
     ROOM_TYPES = (
         ('direct', 'Direct Message'),
@@ -14,10 +18,14 @@ class ChatRoom(models.Model):
     
     name = models.CharField(max_length=255)
     room_type = models.CharField(max_length=20, choices=ROOM_TYPES, default='direct')
-    participants = models.ManyToManyField(User, related_name='chat_rooms', blank=True)
+    # RoomParticipant is the one membership table; see chats.membership for bulk changes
+    participants = models.ManyToManyField(User, through='RoomParticipant', related_name='chat_rooms', blank=True)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='created_rooms')
     created_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
+    # Retention overrides; None falls back to settings.CHAT_RETENTION[room_type]
+    archive_after_days = models.PositiveIntegerField(null=True, blank=True)
+    delete_after_days = models.PositiveIntegerField(null=True, blank=True)
     
     class Meta: 
         ordering = ['-created_at']
@@ -29,22 +37,207 @@ class Message(models.Model):
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
-    read_by = models.ManyToManyField(User, related_name='read_messages', blank=True)
+    # Not auto_now_add: write-behind batches keep the timestamp that was broadcast
+    timestamp = models.DateTimeField(default=timezone.now)
     is_edited = models.BooleanField(default=False)
     edited_at = models.DateTimeField(null=True, blank=True)
     
     class Meta:
-        ordering = ['timestamp']
+        # Ids grow with timestamps, and ordering by id lets (room, id) serve filter and sort together
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['room', 'timestamp'], name='chats_msg_room_ts_idx'),
+            models.Index(fields=['room', 'id'], name='chats_msg_room_id_idx'),
+        ]
     
     def __str__(self):
         return f"{self.sender.username}: {self.content[:50]}"
 
+class MessageArchive(models.Model):
+    """A run of a room's oldest messages, moved out of Message by chats.retention.
+    
+    data is the messages as zlib-compressed JSON lines, oldest first; a room's
+    chunks cover consecutive id ranges below its first hot message.
+    """
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='archives')
+    first_message_id = models.BigIntegerField()
+    last_message_id = models.BigIntegerField()
+    first_at = models.DateTimeField()
+    last_at = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+    archived_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['room', 'first_message_id']
+        indexes = [
+            models.Index(fields=['room', 'last_message_id'], name='chats_archive_room_last_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.room_id}: messages {self.first_message_id}-{self.last_message_id} ({self.message_count})"
+
+class RoomSummary(models.Model):
+    """Denormalized room stats, kept current by chats.summaries as messages are written."""
+    PREVIEW_LENGTH = 100
+    
+    room = models.OneToOneField(ChatRoom, on_delete=models.CASCADE, primary_key=True, related_name='summary')
+    last_message_id = models.BigIntegerField(default=0)
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    message_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.room_id}: {self.message_count} messages, last {self.last_message_id}"
+
+class RoomMemberState(models.Model):
+    """Per-user read cursor: every message up to last_read_message_id is read.
+    
+    unread_count caches the messages from other people after the cursor; message
+    writes add to it and cursor moves recount it (see chats.summaries).
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='room_states')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='member_states')
+    last_read_message_id = models.BigIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = ['user', 'room']
+    
+    def __str__(self):
+        return f"{self.user.username} read {self.room.name} up to {self.last_read_message_id}"
+    
+    @classmethod
+    def advance(cls, user_id, room_id, message_id):
+        cls.advance_many([(user_id, room_id, message_id)])
+    
+    @classmethod
+    def advance_many(cls, cursors):
+        """Move (user_id, room_id, message_id) cursors forward, CURSOR_BATCH_SIZE per upsert.
+        
+        A cursor never moves backwards, so replayed or out-of-order receipts are harmless.
+        """
+        latest = {}
+        for user_id, room_id, message_id in cursors:
+            key = (int(user_id), int(room_id))
+            latest[key] = max(latest.get(key, 0), int(message_id))
+        if not latest:
+            return
+        
+        table = connection.ops.quote_name(cls._meta.db_table)
+        greatest = 'MAX' if connection.vendor == 'sqlite' else 'GREATEST'
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        items = list(latest.items())
+        with connection.cursor() as cursor:
+            for start in range(0, len(items), CURSOR_BATCH_SIZE):
+                batch = items[start:start + CURSOR_BATCH_SIZE]
+                params = []
+                for (user_id, room_id), message_id in batch:
+                    params += [user_id, room_id, message_id, 0, now]
+                cursor.execute(
+                    f"INSERT INTO {table} (user_id, room_id, last_read_message_id, unread_count, updated_at) "
+                    f"VALUES {', '.join(['(%s, %s, %s, %s, %s)'] * len(batch))} "
+                    f"ON CONFLICT (user_id, room_id) DO UPDATE SET "
+                    f"last_read_message_id = {greatest}({table}.last_read_message_id, excluded.last_read_message_id), "
+                    f"updated_at = excluded.updated_at",
+                    params,
+                )
+        cls.recount_unread(latest)
+    
+    @classmethod
+    def recount_unread(cls, pairs):
+        """Recount unread_count for (user_id, room_id) pairs from their cursors.
+        
+        Each count is a range scan of the (room, id) index past the cursor, so a
+        cursor moved up to the newest message costs next to nothing.
+        """
+        pairs = list(pairs)
+        if not pairs:
+            return
+        table = connection.ops.quote_name(cls._meta.db_table)
+        message_table = connection.ops.quote_name(Message._meta.db_table)
+        with connection.cursor() as cursor:
+            for start in range(0, len(pairs), CURSOR_BATCH_SIZE):
+                batch = pairs[start:start + CURSOR_BATCH_SIZE]
+                params = []
+                for user_id, room_id in batch:
+                    params += [user_id, room_id]
+                cursor.execute(
+                    f"UPDATE {table} SET unread_count = ("
+                    f"SELECT COUNT(*) FROM {message_table} m WHERE m.room_id = {table}.room_id "
+                    f"AND m.id > {table}.last_read_message_id AND m.sender_id <> {table}.user_id"
+                    f") WHERE " + ' OR '.join(['(user_id = %s AND room_id = %s)'] * len(batch)),
+                    params,
+                )
+    
+    @classmethod
+    def unread(cls, user_id, room_id):
+        return cls.objects.filter(user_id=user_id, room_id=room_id).values_list(
+            'unread_count', flat=True
+        ).first() or 0
+    
+    @classmethod
+    def last_read(cls, user_id, room_id):
+        return cls.objects.filter(user_id=user_id, room_id=room_id).values_list(
+            'last_read_message_id', flat=True
+        ).first() or 0
+    
+    @classmethod
+    def readers(cls, room_ids):
+        """Map each room id to its [(user, last_read_message_id)] pairs, in one query."""
+        readers = {int(room_id): [] for room_id in room_ids}
+        states = cls.objects.filter(room_id__in=readers, last_read_message_id__gt=0).select_related('user__chat_status')
+        for state in states:
+            readers[state.room_id].append((state.user, state.last_read_message_id))
+        return readers
+    
+    @classmethod
+    def readers_of(cls, message_ids):
+        """readers() limited to who has read {room_id: message_id}, e.g. each room's last message.
+        
+        Only the cursors at or past the message are loaded, so a room list costs the
+        readers of its last messages rather than every member of every room.
+        """
+        readers = {int(room_id): [] for room_id in message_ids}
+        condition = models.Q()
+        for room_id, message_id in message_ids.items():
+            # Rooms without messages have nothing to show read_by on
+            if message_id:
+                condition |= models.Q(room_id=room_id, last_read_message_id__gte=message_id)
+        if not condition:
+            return readers
+        for state in cls.objects.filter(condition).select_related('user__chat_status'):
+            readers[state.room_id].append((state.user, state.last_read_message_id))
+        return readers
+    
+    @classmethod
+    def readers_of_page(cls, messages):
+        """readers_of() for a page of messages: only cursors at or past each room's oldest one."""
+        oldest = {}
+        for message in messages:
+            oldest[message.room_id] = min(message.id, oldest.get(message.room_id, message.id))
+        return cls.readers_of(oldest)
+
+
+def message_readers(message, readers):
+    """Derive the old read_by users from a room's read cursors."""
+    return [
+        user for user, last_read in readers
+        if last_read >= message.id and user.id != message.sender_id
+    ]
+
 class UserStatus(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='chat_status')
     is_online = models.BooleanField(default=False)
     last_seen = models.DateTimeField(auto_now=True)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['is_online'], name='chats_status_online_idx'),
+        ]
+    
     def __str__(self):
         return f"{self.user.username} - {'Online' if self.is_online else 'Offline'}"
 
@@ -55,7 +248,11 @@ class RoomParticipant(models.Model):
     is_admin = models.BooleanField(default=False)
     
     class Meta:
+        # (user, room) serves "my rooms"; (room, user) serves member lists and checks
         unique_together = ['user', 'room']
+        indexes = [
+            models.Index(fields=['room', 'user'], name='chats_participant_room_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username} in {self.room.name}"
\ No newline at end of file
@@ -0,0 +1,142 @@
+# chat/outbox.py
+import asyncio
+import logging
+import weakref
+from collections import deque
+
+from django.conf import settings
+from django.core import signing
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Frames a lagging client can lose without missing anything that matters
+DROPPABLE = frozenset({'typing', 'user_typing'})
+
+# Close code sent with an `evicted` frame (4000-4999 is for applications)
+EVICTED_CLOSE_CODE = 4008
+
+RESUME_SALT = 'chats.resume'
+
+outboxes = weakref.WeakSet()
+
+
+class Outbox:
+    """Per-connection outbound buffer between the channel layer and a socket.
+
+    Frames are queued and written by a separate task, so a slow client never stalls
+    the consumer reading from the channel layer. Past `high_water` frames, typing
+    frames are dropped (queued and incoming) and the rest are coalesced into `batch`
+    frames of up to `batch_size` until the backlog halves; past `limit` the connection
+    is handed to `evict`.
+    """
+
+    def __init__(self, send, evict, high_water, limit, batch_size):
+        self.send = send
+        self.evict = evict
+        self.high_water = high_water
+        self.limit = limit
+        self.batch_size = batch_size
+        # (kind, frame, room_id, message_id)
+        self.frames = deque()
+        # room_id -> id of the newest chat message written to the socket
+        self.delivered = {}
+        self.shedding = False
+        self.closed = False
+        self.task = None
+        outboxes.add(self)
+
+    def push(self, kind, frame, room_id=None, message_id=None):
+        if self.closed:
+            return
+        if len(self.frames) >= self.high_water:
+            if kind in DROPPABLE:
+                metrics.incr('outbox.dropped')
+                return
+            if not self.shedding:
+                self.shedding = True
+                self.drop_queued()
+            if len(self.frames) >= self.limit:
+                self.closed = True
+                self.frames.clear()
+                metrics.incr('outbox.evictions')
+                asyncio.get_running_loop().create_task(self.evict())
+                return
+        self.frames.append((kind, frame, room_id, message_id))
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def drop_queued(self):
+        depth = len(self.frames)
+        self.frames = deque(item for item in self.frames if item[0] not in DROPPABLE)
+        metrics.incr('outbox.dropped', depth - len(self.frames))
+
+    async def run(self):
+        try:
+            while self.frames and not self.closed:
+                if self.shedding:
+                    items = [self.frames.popleft() for _ in range(min(self.batch_size, len(self.frames)))]
+                else:
+                    items = [self.frames.popleft()]
+                if len(items) == 1:
+                    text = items[0][1]
+                else:
+                    # Frames are already encoded, so the batch is assembled without re-encoding them
+                    text = '{"type":"batch","frames":[' + ','.join(item[1] for item in items) + ']}'
+                    metrics.incr('outbox.coalesced', len(items))
+                await self.send(text)
+                for kind, _, room_id, message_id in items:
+                    if message_id is not None:
+                        self.delivered[room_id] = max(message_id, self.delivered.get(room_id, 0))
+                if self.shedding and len(self.frames) < self.high_water // 2:
+                    self.shedding = False
+        except Exception:
+            logger.exception("Outbox writer failed")
+
+    async def drain(self, timeout):
+        """Wait up to `timeout` seconds for the queued frames to be written."""
+        if self.task is not None and not self.task.done():
+            await asyncio.wait([self.task], timeout=timeout)
+
+    def close(self):
+        self.closed = True
+        self.frames.clear()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+def make_outbox(consumer):
+    return Outbox(
+        send=lambda text: consumer.send(text_data=text),
+        evict=consumer.evict,
+        high_water=settings.CHAT_OUTBOX_HIGH_WATER,
+        limit=settings.CHAT_OUTBOX_LIMIT,
+        batch_size=settings.CHAT_OUTBOX_BATCH_SIZE,
+    )
+
+
+def make_resume_token(user_id, delivered):
+    """Signed record of the last chat message each room delivered before an eviction."""
+    return signing.dumps(
+        {'user_id': user_id, 'rooms': {str(room_id): message_id for room_id, message_id in delivered.items()}},
+        salt=RESUME_SALT,
+        compress=True,
+    )
+
+
+def read_resume_token(token, user_id, max_age=None):
+    """The {room_id: message_id} map from a resume token, or None if it is invalid or someone else's."""
+    try:
+        data = signing.loads(token, salt=RESUME_SALT, max_age=max_age)
+    except signing.BadSignature:
+        return None
+    if data.get('user_id') != user_id:
+        return None
+    return {int(room_id): message_id for room_id, message_id in data['rooms'].items()}
+
+
+metrics.register_gauge('outbox.connections', lambda: len(outboxes))
+metrics.register_gauge('outbox.depth', lambda: sum(len(outbox.frames) for outbox in list(outboxes)))
+metrics.register_gauge('outbox.max_depth', lambda: max((len(outbox.frames) for outbox in list(outboxes)), default=0))
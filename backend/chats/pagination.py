@@ -0,0 +1,132 @@
+# chat/pagination.py
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .retention import archived_page
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def parse_cursor(value, name):
+    if value in (None, ''):
+        return None
+    try:
+        cursor = int(value)
+    except (TypeError, ValueError):
+        raise ValidationError({name: 'Must be a message id.'})
+    if cursor < 0:
+        raise ValidationError({name: 'Must be a message id.'})
+    return cursor
+
+
+def clamp_page_size(value):
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def message_page(queryset, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """Return (messages oldest first, has_more) for one keyset page.
+
+    `before` walks back into history and `after` walks forward from a known message;
+    with neither the newest page is returned. Each page is an index range scan on
+    (room, id), so its cost does not depend on how deep into the history it is.
+    """
+    if after is not None:
+        rows = list(queryset.filter(id__gt=after).order_by('id')[:limit + 1])
+        return rows[:limit], len(rows) > limit
+
+    if before is not None:
+        queryset = queryset.filter(id__lt=before)
+    rows = list(queryset.order_by('-id')[:limit + 1])
+    has_more = len(rows) > limit
+    return rows[:limit][::-1], has_more
+
+
+def history_page(queryset, before=None, after=None, limit=DEFAULT_PAGE_SIZE, archive_room=None):
+    """message_page that carries on into the room's archive past the hot messages.
+
+    archive_room is called only when the hot page is empty and must return the
+    room id if the user may read that room (None otherwise); a non-empty page
+    already shows they can.
+    """
+    if after is not None:
+        page, has_more = message_page(queryset, None, after, limit)
+        room_id = page[0].room_id if page else archive_room and archive_room()
+        if not room_id:
+            return page, has_more
+        archived, more = archived_page(room_id, after=after, limit=limit)
+        if more:
+            return archived, True
+        if not archived:
+            return page, has_more
+        space = limit - len(archived)
+        return archived + page[:space], has_more or len(page) > space
+
+    page, has_more = message_page(queryset, before, None, limit)
+    if has_more:
+        return page, has_more
+    room_id = page[0].room_id if page else archive_room and archive_room()
+    if not room_id:
+        return page, has_more
+    older, has_more = archived_page(room_id, page[0].id if page else before, None, limit - len(page))
+    return older + page, has_more
+
+
+class MessageCursorPagination(BasePagination):
+    """Keyset pagination over message ids with `before` / `after` cursors."""
+    page_size_query_param = 'limit'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.before = parse_cursor(request.query_params.get('before'), 'before')
+        self.after = parse_cursor(request.query_params.get('after'), 'after')
+        if self.before is not None and self.after is not None:
+            raise ValidationError('Pass either before or after, not both.')
+        self.limit = clamp_page_size(request.query_params.get(self.page_size_query_param, DEFAULT_PAGE_SIZE))
+
+        # Views that keep an archive offer get_archive_room_id (see history_page)
+        archive_room = getattr(view, 'get_archive_room_id', None)
+        self.page, self.has_more = history_page(queryset, self.before, self.after, self.limit, archive_room)
+        return self.page
+
+    def get_older_link(self):
+        # Walking forward we only know older messages exist if we came from a cursor
+        has_older = self.has_more if self.after is None else True
+        if not self.page or not has_older:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), 'after')
+        return replace_query_param(url, 'before', self.page[0].id)
+
+    def get_newer_link(self):
+        if self.after is not None:
+            has_newer = self.has_more
+        else:
+            has_newer = self.before is not None
+        if not self.page or not has_newer:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), 'before')
+        return replace_query_param(url, 'after', self.page[-1].id)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'previous': self.get_older_link(),
+            'next': self.get_newer_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,170 @@
+# chat/persistence.py
+import asyncio
+import atexit
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import metrics
+from .db import database_write
+from .ids import next_message_id
+from .lifespan import on_shutdown
+from .models import Message
+from .summaries import record_messages
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """Write-behind buffer for chat messages (settings.CHAT_WRITE_BEHIND).
+
+    Messages are built with a snowflake id and broadcast straight away; a background
+    task inserts them with bulk_create once BATCH_SIZE messages are pending or
+    FLUSH_INTERVAL seconds have passed, whichever comes first.
+    """
+
+    def __init__(self, batch_size, flush_interval, max_pending):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = deque()
+        # Batches taken off `pending` whose insert hasn't finished yet
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.task = None
+        self.wakeup = None
+
+    @property
+    def depth(self):
+        return len(self.pending)
+
+    def build(self, room_id, sender_id, content):
+        return Message(
+            id=next_message_id(),
+            room_id=room_id,
+            sender_id=sender_id,
+            content=content,
+            timestamp=timezone.now(),
+        )
+
+    async def enqueue(self, message):
+        self.ensure_running()
+        self.pending.append(message)
+        if self.depth >= self.max_pending:
+            # The database is falling behind: make the sender wait for a flush
+            metrics.incr('write_behind.inline_flushes')
+            await self.flush()
+        else:
+            self.wakeup.set()
+
+    def ensure_running(self):
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            if self.depth < self.batch_size:
+                await asyncio.sleep(self.flush_interval)
+            self.wakeup.clear()
+            await self.flush()
+
+    def take_batch(self):
+        with self.lock:
+            count = min(self.batch_size, len(self.pending))
+            batch = [self.pending.popleft() for _ in range(count)]
+            self.in_flight.update((message.id, message) for message in batch)
+            return batch
+
+    def unflushed(self, room_id, after):
+        """A room's messages newer than `after` that were broadcast but aren't in the database yet."""
+        with self.lock:
+            messages = [*self.in_flight.values(), *self.pending]
+        return sorted(
+            (message for message in messages if message.room_id == room_id and message.id > after),
+            key=lambda message: message.id,
+        )
+
+    async def flush(self):
+        while self.pending:
+            await database_write(self.write)(self.take_batch())
+
+    def write(self, batch):
+        if not batch:
+            return
+        # Taken up front, insert_one may give a message a new id
+        ids = [message.id for message in batch]
+        try:
+            self.insert(batch)
+        finally:
+            with self.lock:
+                for message_id in ids:
+                    self.in_flight.pop(message_id, None)
+
+    def insert(self, batch):
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(batch)
+                record_messages(batch)
+        except Exception:
+            # Fall back to row-by-row so one bad message (e.g. a deleted room) doesn't sink the batch
+            logger.exception(f"Write-behind batch of {len(batch)} messages failed, retrying row by row")
+            metrics.incr('write_behind.batch_errors')
+            for message in batch:
+                try:
+                    self.insert_one(message)
+                except Exception:
+                    logger.exception(f"Dropping message {message.id} for room {message.room_id}")
+                    metrics.incr('write_behind.dropped')
+        metrics.incr('write_behind.batches')
+        metrics.incr('write_behind.messages', len(batch))
+        logger.debug(f"Write-behind flushed {len(batch)} messages, {self.depth} pending")
+
+    def insert_one(self, message):
+        try:
+            with transaction.atomic():
+                message.save(force_insert=True)
+                record_messages([message])
+            return
+        except IntegrityError:
+            stored = Message.objects.filter(id=message.id).values_list('room_id', 'sender_id', 'content').first()
+            if stored is None:
+                # Not an id clash: the room or sender is gone
+                raise
+        if stored == (message.room_id, message.sender_id, message.content):
+            # Already stored by an earlier attempt of this batch
+            metrics.incr('write_behind.duplicates')
+            return
+        # Another process handed out the same id (CHAT_WORKER_ID reused): store it under a new one
+        old_id, message.id = message.id, next_message_id()
+        logger.error(f"Message id {old_id} was already taken; stored the message for room {message.room_id} as {message.id}")
+        metrics.incr('write_behind.reassigned')
+        with transaction.atomic():
+            message.save(force_insert=True)
+            record_messages([message])
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    def flush_sync(self):
+        # Last-chance flush at interpreter exit, for servers without lifespan events
+        while self.pending:
+            self.write(self.take_batch())
+
+
+message_writer = MessageWriter(
+    batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+    flush_interval=settings.CHAT_WRITE_BEHIND_FLUSH_INTERVAL,
+    max_pending=settings.CHAT_WRITE_BEHIND_MAX_PENDING,
+)
+metrics.register_gauge('write_behind.pending', lambda: message_writer.depth)
+on_shutdown(message_writer.close)
+atexit.register(message_writer.flush_sync)
@@ -0,0 +1,116 @@
+# chat/presence.py
+import asyncio
+import atexit
+import logging
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import metrics
+from .db import database_write
+from .lifespan import on_shutdown
+from .models import UserStatus
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceTracker:
+    """Reference-counted presence for the sockets held by this process.
+
+    A user is online while any of their sockets is open, and "in" a room while any of
+    their sockets for that room is open, so closing one of several tabs changes nothing.
+    Online/offline transitions are written to UserStatus in batches every
+    CHAT_PRESENCE_FLUSH_INTERVAL seconds instead of once per connect/disconnect.
+    """
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self.users = Counter()
+        self.rooms = Counter()
+        # user_id -> is_online, waiting to be written
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.task = None
+
+    def connect(self, user_id, room_id):
+        """Register a socket; returns (came_online, joined_room)."""
+        self.users[user_id] += 1
+        self.rooms[room_id, user_id] += 1
+        came_online = self.users[user_id] == 1
+        if came_online:
+            self.mark(user_id, True)
+        return came_online, self.rooms[room_id, user_id] == 1
+
+    def disconnect(self, user_id, room_id):
+        """Unregister a socket; returns (went_offline, left_room)."""
+        left_room = self.release(self.rooms, (room_id, user_id))
+        went_offline = self.release(self.users, user_id)
+        if went_offline:
+            self.mark(user_id, False)
+        return went_offline, left_room
+
+    def release(self, counter, key):
+        if counter[key] <= 1:
+            counter.pop(key, None)
+            return True
+        counter[key] -= 1
+        return False
+
+    def is_online(self, user_id):
+        return user_id in self.users
+
+    def mark(self, user_id, is_online):
+        with self.lock:
+            self.pending[user_id] = is_online
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        while self.pending:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def take_pending(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+    async def flush(self):
+        pending = self.take_pending()
+        if pending:
+            await database_write(self.write)(pending)
+
+    def write(self, pending):
+        now = timezone.now()
+        try:
+            # One upsert for every user whose state changed during the interval
+            UserStatus.objects.bulk_create(
+                [UserStatus(user_id=user_id, is_online=is_online, last_seen=now) for user_id, is_online in pending.items()],
+                update_conflicts=True,
+                unique_fields=['user'],
+                update_fields=['is_online', 'last_seen'],
+            )
+            metrics.incr('presence.writes', len(pending))
+        except Exception:
+            logger.exception(f"Failed to write presence for {len(pending)} users")
+            metrics.incr('presence.write_errors')
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    def flush_sync(self):
+        pending = self.take_pending()
+        if pending:
+            self.write(pending)
+
+
+presence = PresenceTracker(settings.CHAT_PRESENCE_FLUSH_INTERVAL)
+metrics.register_gauge('presence.online_users', lambda: len(presence.users))
+metrics.register_gauge('presence.pending_writes', lambda: len(presence.pending))
+on_shutdown(presence.close)
+atexit.register(presence.flush_sync)
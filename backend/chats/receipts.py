@@ -0,0 +1,126 @@
+# chat/receipts.py
+import asyncio
+import logging
+
+from django.conf import settings
+from django.db.models import Max
+
+from . import metrics
+from .db import database_write
+from .fanout import fanout
+from .lifespan import on_shutdown
+from .models import Message, RoomMemberState
+
+logger = logging.getLogger(__name__)
+
+
+def parse_read_up_to(data):
+    """The highest message id a read_receipt frame covers, or None.
+
+    Accepts `message_id` (the original single receipt), `up_to`, a `message_ids`
+    list or `ranges` of [first, last] pairs; read state is a cursor, so only the
+    highest id matters. Values of the wrong shape are ignored.
+    """
+    candidates = [data.get('message_id'), data.get('up_to')]
+    message_ids = data.get('message_ids')
+    if isinstance(message_ids, list):
+        candidates += message_ids
+    ranges = data.get('ranges')
+    if isinstance(ranges, list):
+        for message_range in ranges:
+            if isinstance(message_range, list) and len(message_range) == 2:
+                candidates.append(message_range[1])
+
+    up_to = None
+    for candidate in candidates:
+        try:
+            candidate = int(candidate)
+        except (TypeError, ValueError):
+            continue
+        if candidate > 0 and (up_to is None or candidate > up_to):
+            up_to = candidate
+    return up_to
+
+
+class ReceiptAggregator:
+    """Debounces read receipts per user per room.
+
+    Every CHAT_RECEIPT_WINDOW seconds the highest id each user read in each room is
+    persisted with a single RoomMemberState upsert, and each room gets one
+    `read_receipts` frame listing the cursors that moved.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        # (room_id, user_id) -> (up_to, username)
+        self.pending = {}
+        self.task = None
+
+    def add(self, room_id, user_id, username, up_to):
+        key = (room_id, user_id)
+        current = self.pending.get(key)
+        if current is None or up_to > current[0]:
+            self.pending[key] = (up_to, username)
+        metrics.incr('receipts.received')
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        while self.pending:
+            await asyncio.sleep(self.window)
+            await self.flush()
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        try:
+            pending = await database_write(self.persist)(pending)
+        except Exception:
+            logger.exception(f"Failed to persist {len(pending)} read receipts")
+            metrics.incr('receipts.errors')
+            return
+
+        rooms = {}
+        for (room_id, user_id), (up_to, username) in pending.items():
+            rooms.setdefault(room_id, []).append({'user_id': user_id, 'user': username, 'up_to': up_to})
+        for room_id, receipts in rooms.items():
+            metrics.incr('receipts.sent')
+            try:
+                await fanout.publish(room_id, {
+                    'type': 'read_receipts',
+                    'room_id': room_id,
+                    'receipts': receipts,
+                })
+            except Exception:
+                logger.exception(f"Failed to send read receipts for room {room_id}")
+
+    def persist(self, pending):
+        # A cursor can't point past the newest message in its room
+        room_ids = {room_id for room_id, _ in pending}
+        newest = dict(
+            Message.objects.filter(room_id__in=room_ids).values('room_id').annotate(newest=Max('id')).order_by()
+            .values_list('room_id', 'newest')
+        )
+        clamped = {}
+        for (room_id, user_id), (up_to, username) in pending.items():
+            up_to = min(up_to, newest.get(room_id, 0))
+            if up_to > 0:
+                clamped[room_id, user_id] = (up_to, username)
+
+        RoomMemberState.advance_many(
+            (user_id, room_id, up_to) for (room_id, user_id), (up_to, _) in clamped.items()
+        )
+        metrics.incr('receipts.persisted', len(clamped))
+        return clamped
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+
+receipt_aggregator = ReceiptAggregator(settings.CHAT_RECEIPT_WINDOW)
+metrics.register_gauge('receipts.pending', lambda: len(receipt_aggregator.pending))
+on_shutdown(receipt_aggregator.close)
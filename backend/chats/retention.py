@@ -0,0 +1,193 @@
+# chat/retention.py
+import zlib
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, Min, OuterRef
+from django.utils import timezone
+
+from .encoding import dumps, loads
+from .models import Message, MessageArchive, RoomMemberState, RoomParticipant, User
+from .summaries import in_rooms, rebuild
+
+
+def room_policy(room):
+    """(archive_after_days, delete_after_days) for a room; its own values win over its room_type's."""
+    defaults = settings.CHAT_RETENTION.get(room.room_type, {})
+    archive_after = room.archive_after_days
+    if archive_after is None:
+        archive_after = defaults.get('archive_after_days')
+    delete_after = room.delete_after_days
+    if delete_after is None:
+        delete_after = defaults.get('delete_after_days')
+    return archive_after, delete_after
+
+
+def pack(messages):
+    lines = [
+        dumps({
+            'id': message.id,
+            'sender_id': message.sender_id,
+            'content': message.content,
+            'timestamp': message.timestamp.isoformat(),
+            'is_edited': message.is_edited,
+            'edited_at': message.edited_at.isoformat() if message.edited_at else None,
+        })
+        for message in messages
+    ]
+    return zlib.compress('\n'.join(lines).encode())
+
+
+def unpack(archive):
+    """The archived messages as unsaved Message instances, oldest first."""
+    messages = []
+    for line in zlib.decompress(bytes(archive.data)).decode().split('\n'):
+        row = loads(line)
+        messages.append(Message(
+            id=row['id'],
+            room_id=archive.room_id,
+            sender_id=row['sender_id'],
+            content=row['content'],
+            timestamp=datetime.fromisoformat(row['timestamp']),
+            is_edited=row['is_edited'],
+            edited_at=datetime.fromisoformat(row['edited_at']) if row['edited_at'] else None,
+        ))
+    return messages
+
+
+def fill(archive, messages):
+    archive.first_message_id = messages[0].id
+    archive.last_message_id = messages[-1].id
+    archive.first_at = messages[0].timestamp
+    archive.last_at = messages[-1].timestamp
+    archive.message_count = len(messages)
+    archive.data = pack(messages)
+
+
+def archive_boundary(room, cutoff):
+    """Id of the room's first message to stay hot: the first one after cutoff, and never
+    past the newest, which stays so the room list and read cursors can still find it."""
+    newest = Message.objects.filter(room=room).order_by('-id').values_list('id', flat=True).first()
+    if newest is None:
+        return None
+    first_recent = Message.objects.filter(room=room, timestamp__gte=cutoff).aggregate(first=Min('id'))['first']
+    return min(first_recent or newest, newest)
+
+
+def archive_room(room, cutoff, chunk_size):
+    """Move the room's messages from before cutoff into MessageArchive; returns how many.
+
+    Each chunk is written and its messages deleted in one transaction. A chunk left
+    short by the previous run is topped up first instead of starting a new one.
+    """
+    boundary = archive_boundary(room, cutoff)
+    if boundary is None:
+        return 0
+    tail = MessageArchive.objects.filter(room=room).order_by('-last_message_id').first()
+    if tail and tail.message_count >= chunk_size:
+        tail = None
+    archived = 0
+    while True:
+        with transaction.atomic():
+            space = chunk_size - (tail.message_count if tail else 0)
+            messages = list(Message.objects.filter(room=room, id__lt=boundary).order_by('id')[:space])
+            if not messages:
+                break
+            if tail is None:
+                tail = MessageArchive(room=room)
+                fill(tail, messages)
+            else:
+                fill(tail, unpack(tail) + messages)
+            tail.save()
+            Message.objects.filter(id__in=[message.id for message in messages]).delete()
+        archived += len(messages)
+        if tail.message_count >= chunk_size:
+            tail = None
+    return archived
+
+
+def compact_read_states(room_ids=None):
+    """Delete read states left behind by users who are no longer in the room; returns how many."""
+    stale = in_rooms(RoomMemberState.objects.all(), room_ids).exclude(
+        Exists(RoomParticipant.objects.filter(user_id=OuterRef('user_id'), room_id=OuterRef('room_id')))
+    )
+    deleted, _ = stale.delete()
+    return deleted
+
+
+def pending(room, now=None):
+    """(messages to archive, archived messages to delete) for the room's policy, without changing anything."""
+    now = now or timezone.now()
+    archive_after, delete_after = room_policy(room)
+    to_archive = to_delete = 0
+    if archive_after is not None:
+        boundary = archive_boundary(room, now - timedelta(days=archive_after))
+        if boundary is not None:
+            to_archive = Message.objects.filter(room=room, id__lt=boundary).count()
+    if delete_after is not None:
+        chunks = MessageArchive.objects.filter(room=room, last_at__lt=now - timedelta(days=delete_after))
+        to_delete = sum(chunks.values_list('message_count', flat=True))
+    return to_archive, to_delete
+
+
+def apply_policy(room, now=None, chunk_size=None):
+    """Archive and delete a room's messages per its policy; returns (archived, deleted).
+
+    A chunk is only deleted once every message in it is past delete_after_days.
+    Summaries and unread counts of the room are recomputed afterwards.
+    """
+    now = now or timezone.now()
+    archive_after, delete_after = room_policy(room)
+    archived = deleted = 0
+    if archive_after is not None:
+        archived = archive_room(room, now - timedelta(days=archive_after), chunk_size or settings.CHAT_ARCHIVE_CHUNK_SIZE)
+    if delete_after is not None:
+        with transaction.atomic():
+            chunks = MessageArchive.objects.filter(room=room, last_at__lt=now - timedelta(days=delete_after))
+            deleted = sum(chunks.values_list('message_count', flat=True))
+            chunks.delete()
+    if archived or deleted:
+        rebuild([room.pk])
+    return archived, deleted
+
+
+def attach_senders(messages):
+    # Messages of deleted users are dropped, as Message rows would have been
+    users = User.objects.select_related('chat_status').in_bulk({message.sender_id for message in messages})
+    kept = []
+    for message in messages:
+        sender = users.get(message.sender_id)
+        if sender is not None:
+            message.sender = sender
+            kept.append(message)
+    return kept
+
+
+def archived_page(room_id, before=None, after=None, limit=50):
+    """message_page over a room's archive: (messages oldest first, has_more)."""
+    chunks = MessageArchive.objects.filter(room_id=room_id)
+    if after is not None:
+        chunks = chunks.filter(last_message_id__gt=after).order_by('first_message_id')
+    else:
+        if before is not None:
+            chunks = chunks.filter(first_message_id__lt=before)
+        chunks = chunks.order_by('-last_message_id')
+    if limit == 0:
+        return [], chunks.exists()
+
+    rows = []
+    for chunk in chunks.iterator(chunk_size=4):
+        messages = unpack(chunk)
+        if after is not None:
+            rows += [message for message in messages if message.id > after]
+        else:
+            rows += [message for message in reversed(messages) if before is None or message.id < before]
+        if len(rows) > limit:
+            break
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after is None:
+        rows.reverse()
+    return attach_senders(rows), has_more
+
@@ -0,0 +1,220 @@
+# chat/search.py
+import re
+
+from django.db import connection
+from django.db.models import Case, Exists, IntegerField, OuterRef, Q, Value, When
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Length
+
+from .models import Message, RoomParticipant, User
+
+MAX_SEARCH_TERMS = 8
+MAX_USER_QUERY_LENGTH = 64
+# Trigram indexes can't serve shorter queries, those use the prefix indexes
+TRIGRAM_LENGTH = 3
+
+# SQLite: an external-content FTS5 table over chats_message, kept in sync by triggers.
+# Created by migration 0005 (Postgres gets a tsvector column there); ensure_search_index
+# reruns these when a later migration drops the triggers.
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chats_message_fts USING fts5(
+        content, content='chats_message', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chats_message_fts_insert AFTER INSERT ON chats_message BEGIN
+        INSERT INTO chats_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chats_message_fts_delete AFTER DELETE ON chats_message BEGIN
+        INSERT INTO chats_message_fts(chats_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chats_message_fts_update AFTER UPDATE OF content ON chats_message BEGIN
+        INSERT INTO chats_message_fts(chats_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO chats_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    "INSERT INTO chats_message_fts(chats_message_fts) VALUES ('rebuild')",
+]
+
+# User search. SQLite: a trigram FTS5 table over the user table plus NOCASE prefix
+# indexes, created by migration 0006 (Postgres gets pg_trgm indexes there).
+SQLITE_USER_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chats_user_search USING fts5(
+        username, email, content='{table}', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chats_user_search_insert AFTER INSERT ON {table} BEGIN
+        INSERT INTO chats_user_search(rowid, username, email) VALUES (new.id, new.username, new.email);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chats_user_search_delete AFTER DELETE ON {table} BEGIN
+        INSERT INTO chats_user_search(chats_user_search, rowid, username, email)
+            VALUES ('delete', old.id, old.username, old.email);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chats_user_search_update AFTER UPDATE OF username, email ON {table} BEGIN
+        INSERT INTO chats_user_search(chats_user_search, rowid, username, email)
+            VALUES ('delete', old.id, old.username, old.email);
+        INSERT INTO chats_user_search(rowid, username, email) VALUES (new.id, new.username, new.email);
+    END
+    """,
+    "CREATE INDEX IF NOT EXISTS chats_user_username_prefix_idx ON {table} (username COLLATE NOCASE)",
+    "CREATE INDEX IF NOT EXISTS chats_user_email_prefix_idx ON {table} (email COLLATE NOCASE)",
+    "INSERT INTO chats_user_search(chats_user_search) VALUES ('rebuild')",
+]
+
+# SQLite triggers each search migration relies on, checked after every migrate
+SQLITE_TRIGGERS = [
+    (('chats', '0005_message_search'), SQLITE_FORWARD,
+     ['chats_message_fts_insert', 'chats_message_fts_delete', 'chats_message_fts_update']),
+    (('chats', '0006_user_search'), SQLITE_USER_FORWARD,
+     ['chats_user_search_insert', 'chats_user_search_delete', 'chats_user_search_update']),
+]
+
+
+def run_statements(schema_editor, statements, **names):
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement.format(**names))
+
+
+def ensure_search_index(using='default'):
+    """Restore SQLite search triggers that a later migration dropped; returns True if any were.
+
+    Django's SQLite schema editor alters columns by copying the table, which drops
+    its triggers; this runs after every migrate and reindexes whatever was affected.
+    """
+    from django.db import connections
+    from django.db.migrations.recorder import MigrationRecorder
+
+    db = connections[using]
+    if db.vendor != 'sqlite':
+        return False
+    applied = MigrationRecorder(db).applied_migrations()
+    restored = False
+    for migration, statements, triggers in SQLITE_TRIGGERS:
+        if migration not in applied:
+            continue
+        with db.cursor() as cursor:
+            cursor.execute(
+                "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name IN (%s, %s, %s)", triggers
+            )
+            if cursor.fetchone()[0] == len(triggers):
+                continue
+        with db.schema_editor() as schema_editor:
+            run_statements(schema_editor, {'sqlite': statements}, table=User._meta.db_table)
+        restored = True
+    return restored
+
+
+def search_terms(query):
+    """Split free text into plain word terms, so user input is never parsed as query syntax."""
+    return re.findall(r'\w+', query.lower())[:MAX_SEARCH_TERMS]
+
+
+def match_expression(terms):
+    # Every term must match; the last one also matches as a prefix (search-as-you-type)
+    if connection.vendor == 'postgresql':
+        return ' & '.join(terms[:-1] + [f'{terms[-1]}:*'])
+    return ' '.join([f'"{term}"' for term in terms[:-1]] + [f'"{terms[-1]}"*'])
+
+
+def search_message_ids(user_id, query, room_id=None, order='rank', limit=50, offset=0, before=None):
+    """Return [(message_id, rank)] for messages in the user's rooms that match `query`.
+
+    order='rank' pages by offset through best matches first; order='recent' walks
+    back from `before` by id, which stays cheap however deep the pages go.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return []
+    if connection.vendor not in ('sqlite', 'postgresql'):
+        return fallback_search(user_id, terms, room_id, limit, offset, before)
+
+    with connection.cursor() as cursor:
+        cursor.execute(*message_search_sql(user_id, terms, room_id, order, limit, offset, before))
+        return cursor.fetchall()
+
+
+def message_search_sql(user_id, terms, room_id=None, order='rank', limit=50, offset=0, before=None):
+    """The (sql, params) search_message_ids runs against the SQLite or Postgres index."""
+    membership = RoomParticipant._meta.db_table
+    params = [match_expression(terms), user_id]
+    if connection.vendor == 'postgresql':
+        sql = (
+            "SELECT m.id, ts_rank(m.search_vector, q.query) AS rank "
+            "FROM chats_message m, to_tsquery('simple', %s) AS q(query) "
+            f"WHERE m.search_vector @@ q.query AND m.room_id IN (SELECT room_id FROM {membership} WHERE user_id = %s)"
+        )
+        rank_order = 'rank DESC'
+    else:
+        # bm25() is lower for better matches
+        sql = (
+            "SELECT m.id, bm25(chats_message_fts) AS rank "
+            "FROM chats_message_fts JOIN chats_message m ON m.id = chats_message_fts.rowid "
+            f"WHERE chats_message_fts MATCH %s AND m.room_id IN (SELECT room_id FROM {membership} WHERE user_id = %s)"
+        )
+        rank_order = 'rank'
+    if room_id is not None:
+        sql += " AND m.room_id = %s"
+        params.append(room_id)
+    if order == 'recent':
+        if before is not None:
+            sql += " AND m.id < %s"
+            params.append(before)
+        sql += " ORDER BY m.id DESC LIMIT %s"
+        params.append(limit)
+    else:
+        sql += f" ORDER BY {rank_order}, m.id DESC LIMIT %s OFFSET %s"
+        params += [limit, offset]
+    return sql, params
+
+
+def fallback_search(user_id, terms, room_id, limit, offset, before):
+    # Databases without a search index get an unranked scan
+    queryset = Message.objects.filter(room__participants=user_id)
+    for term in terms:
+        queryset = queryset.filter(content__icontains=term)
+    if room_id is not None:
+        queryset = queryset.filter(room_id=room_id)
+    if before is not None:
+        queryset = queryset.filter(id__lt=before)
+        offset = 0
+    return [(message_id, None) for message_id in queryset.order_by('-id').values_list('id', flat=True)[offset:offset + limit]]
+
+
+def search_users(user, query):
+    """Users other than `user` whose username or email contains `query`.
+
+    People who share a room with `user` come first, then prefix matches, then
+    shorter usernames. Queries under three characters only match prefixes.
+    """
+    query = query.strip().lower()[:MAX_USER_QUERY_LENGTH]
+    queryset = User.objects.exclude(id=user.id)
+    if len(query) < TRIGRAM_LENGTH:
+        queryset = queryset.filter(Q(username__istartswith=query) | Q(email__istartswith=query))
+    elif connection.vendor == 'sqlite':
+        phrase = '"' + query.replace('"', '""') + '"'
+        queryset = queryset.filter(id__in=RawSQL(
+            "SELECT rowid FROM chats_user_search WHERE chats_user_search MATCH %s", [phrase]
+        ))
+    else:
+        queryset = queryset.filter(Q(username__icontains=query) | Q(email__icontains=query))
+
+    membership = RoomParticipant.objects
+    shares_room = membership.filter(
+        user_id=OuterRef('pk'),
+        room_id__in=membership.filter(user_id=user.id).values('room_id'),
+    )
+    return queryset.annotate(
+        shares_room=Exists(shares_room),
+        prefix_match=Case(When(username__istartswith=query, then=Value(1)), default=Value(0), output_field=IntegerField()),
+    ).order_by('-shares_room', '-prefix_match', Length('username'), 'username').select_related('chat_status')
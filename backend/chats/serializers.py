@@ -1,6 +1,8 @@
 # chat/serializers.py
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
 from rest_framework import serializers
-from .models import ChatRoom, Message, User, UserStatus
+from .models import ChatRoom, Message, User, UserStatus, RoomMemberState, message_readers
 
 class UserSerializer(serializers.ModelSerializer):
     is_online = serializers.BooleanField(source='chat_status.is_online', read_only=True)
@@ -12,11 +14,25 @@ class UserSerializer(serializers.ModelSerializer):
 
 class MessageSerializer(serializers.ModelSerializer):
     sender = UserSerializer(read_only=True)
-    read_by = UserSerializer(many=True, read_only=True)
+    read_by = serializers.SerializerMethodField()
     
     class Meta:
         model = Message
         fields = ['id', 'sender', 'content', 'timestamp', 'read_by', 'is_edited', 'edited_at']
+    
+    def get_read_by(self, obj):
+        # Read cursors are loaded once per room and shared through the root context
+        read_states = self.context.setdefault('read_states', {})
+        if obj.room_id not in read_states:
+            read_states.update(RoomMemberState.readers([obj.room_id]))
+        return UserSerializer(message_readers(obj, read_states[obj.room_id]), many=True).data
+
+class MessageSearchResultSerializer(MessageSerializer):
+    room_id = serializers.IntegerField(read_only=True)
+    rank = serializers.FloatField(read_only=True)
+    
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ['room_id', 'rank']
 
 class ChatRoomSerializer(serializers.ModelSerializer):
     participants = UserSerializer(many=True, read_only=True)
@@ -28,21 +44,112 @@ class ChatRoomSerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'room_type', 'participants', 'created_at', 'last_message', 'unread_count']
     
     def get_last_message(self, obj):
-        last_msg = obj.messages.last()
+        # Rooms from ChatRoomViewSet.get_queryset carry last_message_id, and the
+        # view resolves those ids in bulk into context['last_messages']
+        if hasattr(obj, 'last_message_id'):
+            last_msg = self.context.get('last_messages', {}).get(obj.last_message_id)
+        else:
+            last_msg = obj.messages.last()
         if last_msg:
-            return MessageSerializer(last_msg).data
+            return MessageSerializer(last_msg, context=self.context).data
         return None
      
     def get_unread_count(self, obj):
+        if hasattr(obj, 'unread_total'):
+            return obj.unread_total
         request = self.context.get('request')
         if request and request.user.is_authenticated:
-            return obj.messages.exclude(read_by=request.user).count()
+            return RoomMemberState.unread(request.user.id, obj.id)
         return 0
 
+def wants_compact(request):
+    return request.query_params.get('compact') in ('1', 'true')
+
+def iso_datetime(value):
+    # What DRF's DateTimeField renders with USE_TZ and TIME_ZONE = 'UTC'
+    if value is None:
+        return None
+    value = value.isoformat()
+    return value[:-6] + 'Z' if value.endswith('+00:00') else value
+
+class CompactSerializer:
+    """Hand-rolled serializer for the hot list endpoints (?compact=1).
+
+    Messages carry sender_id and read_by ids, rooms carry participant ids, and every
+    user referenced is rendered once into the `users` side-table with the fields of
+    UserSerializer. Expects senders, participants and readers with chat_status loaded.
+    """
+    
+    def __init__(self, read_states=None, last_messages=None):
+        self.read_states = read_states or {}
+        self.last_messages = last_messages or {}
+        self.users = {}
+    
+    def user_id(self, user):
+        if user.id not in self.users:
+            try:
+                status = user.chat_status
+            except ObjectDoesNotExist:
+                status = None
+            self.users[user.id] = {
+                'id': user.id,
+                'username': user.username,
+                'email': user.email,
+                'is_online': status.is_online if status else None,
+                'last_seen': iso_datetime(status.last_seen) if status else None,
+            }
+        return user.id
+    
+    def message(self, message):
+        readers = self.read_states.get(message.room_id, ())
+        return {
+            'id': message.id,
+            'sender_id': self.user_id(message.sender),
+            'content': message.content,
+            'timestamp': iso_datetime(message.timestamp),
+            'read_by': [
+                self.user_id(user) for user, last_read in readers
+                if last_read >= message.id and user.id != message.sender_id
+            ],
+            'is_edited': message.is_edited,
+            'edited_at': iso_datetime(message.edited_at),
+        }
+    
+    def room(self, room):
+        last_message = self.last_messages.get(room.last_message_id)
+        return {
+            'id': room.id,
+            'name': room.name,
+            'room_type': room.room_type,
+            'participants': [self.user_id(user) for user in room.participants.all()],
+            'created_at': iso_datetime(room.created_at),
+            'last_message': self.message(last_message) if last_message else None,
+            'unread_count': room.unread_total,
+        }
+    
+    def messages(self, messages):
+        return [self.message(message) for message in messages]
+    
+    def rooms(self, rooms):
+        return [self.room(room) for room in rooms]
+
 class CreateRoomSerializer(serializers.Serializer):
     name = serializers.CharField(max_length=255)
     room_type = serializers.ChoiceField(choices=ChatRoom.ROOM_TYPES)
     participant_ids = serializers.ListField(
         child=serializers.IntegerField(),
-        required=False
+        required=False,
+        max_length=settings.CHAT_MEMBERSHIP_BATCH_LIMIT
+    )
+
+class MembershipSerializer(serializers.Serializer):
+    add = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        required=False,
+        max_length=settings.CHAT_MEMBERSHIP_BATCH_LIMIT
+    )
+    remove = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        required=False,
+        max_length=settings.CHAT_MEMBERSHIP_BATCH_LIMIT
     )
\ No newline at end of file
@@ -0,0 +1,71 @@
+# chat/signals.py
+import logging
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_migrate, post_save
+from django.dispatch import receiver
+
+from .cache import invalidate_room
+from .db import tune_sqlite
+from .ids import sync_message_sequence
+from .models import ChatRoom
+from .search import ensure_search_index
+from .summaries import drop_member_states, ensure_member_states
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear', 'pre_clear'):
+        return
+    if action == 'post_add' and pk_set:
+        # New members need a read state for their unread counts to be kept
+        if reverse:
+            for room_id in pk_set:
+                ensure_member_states(room_id, [instance.pk])
+        else:
+            ensure_member_states(instance.pk, pk_set)
+    elif action == 'post_remove' and pk_set:
+        # Former members stop collecting unread counts
+        if reverse:
+            drop_member_states(pk_set, [instance.pk])
+        else:
+            drop_member_states([instance.pk], pk_set)
+    elif action == 'post_clear':
+        if reverse:
+            drop_member_states(user_ids=[instance.pk])
+        else:
+            drop_member_states([instance.pk])
+    if not reverse:
+        invalidate_room(instance.pk)
+    elif pk_set:
+        # user.chat_rooms.add(...) and friends: pk_set holds room ids
+        for room_id in pk_set:
+            invalidate_room(room_id)
+    elif action == 'pre_clear':
+        # user.chat_rooms.clear() doesn't report which rooms it touched
+        for room_id in instance.chat_rooms.values_list('id', flat=True):
+            invalidate_room(room_id)
+
+
+@receiver(post_save, sender=ChatRoom)
+@receiver(post_delete, sender=ChatRoom)
+def room_changed(sender, instance, **kwargs):
+    invalidate_room(instance.pk)
+
+
+@receiver(post_migrate)
+def restore_search_index(sender, using, **kwargs):
+    if sender.name == 'chats' and ensure_search_index(using):
+        logger.warning("Recreated the message search triggers and rebuilt the index")
+
+
+@receiver(connection_created)
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite' and settings.CHAT_SQLITE_PERFORMANCE:
+        tune_sqlite(connection)
+    if not settings.CHAT_WRITE_BEHIND:
+        # In case an earlier run stored snowflake ids
+        sync_message_sequence(connection)
@@ -0,0 +1,233 @@
+# chat/summaries.py
+from collections import Counter
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.db.models import Count, Exists, F, Max, OuterRef, Sum
+from django.utils import timezone
+
+from .models import ChatRoom, Message, MessageArchive, RoomMemberState, RoomParticipant, RoomSummary
+
+
+def table(model, conn=connection):
+    return conn.ops.quote_name(model._meta.db_table)
+
+
+def record_messages(messages):
+    """Fold newly inserted messages into RoomSummary and their rooms' unread counts.
+
+    One upsert for the summaries plus one UPDATE per room; call it in the same
+    transaction as the insert so the counters never run ahead of the messages.
+    """
+    rooms = {}
+    for message in messages:
+        rooms.setdefault(message.room_id, []).append(message)
+    if not rooms:
+        return
+
+    summaries = table(RoomSummary)
+    states = table(RoomMemberState)
+    greatest = 'MAX' if connection.vendor == 'sqlite' else 'GREATEST'
+    adapt = connection.ops.adapt_datetimefield_value
+    now = adapt(timezone.now())
+    params = []
+    for room_id, room_messages in rooms.items():
+        newest = max(room_messages, key=lambda message: message.id)
+        params += [
+            room_id, newest.id, newest.content[:RoomSummary.PREVIEW_LENGTH], adapt(newest.timestamp),
+            len(room_messages), now,
+        ]
+    rows = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(rooms))
+    newer = f"excluded.last_message_id > {summaries}.last_message_id"
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {summaries} (room_id, last_message_id, last_message_preview, last_message_at, "
+            f"message_count, updated_at) VALUES {rows} ON CONFLICT (room_id) DO UPDATE SET "
+            f"message_count = {summaries}.message_count + excluded.message_count, "
+            f"last_message_preview = CASE WHEN {newer} THEN excluded.last_message_preview "
+            f"ELSE {summaries}.last_message_preview END, "
+            f"last_message_at = CASE WHEN {newer} THEN excluded.last_message_at ELSE {summaries}.last_message_at END, "
+            f"last_message_id = {greatest}({summaries}.last_message_id, excluded.last_message_id), "
+            f"updated_at = excluded.updated_at",
+            params,
+        )
+        for room_id, room_messages in rooms.items():
+            # Everyone gets the batch as unread, less what they sent themselves
+            total = len(room_messages)
+            sent = Counter(message.sender_id for message in room_messages)
+            params = []
+            for sender_id, count in sent.items():
+                params += [sender_id, total - count]
+            cursor.execute(
+                f"UPDATE {states} SET unread_count = unread_count + "
+                f"CASE user_id {' '.join(['WHEN %s THEN %s'] * len(sent))} ELSE %s END WHERE room_id = %s",
+                params + [total, room_id],
+            )
+
+
+def record_edit(message):
+    """Refresh the room's preview if `message`, just edited, is its last message; one UPDATE."""
+    RoomSummary.objects.filter(room_id=message.room_id, last_message_id=message.id).update(
+        last_message_preview=message.content[:RoomSummary.PREVIEW_LENGTH],
+        updated_at=timezone.now(),
+    )
+
+
+
+def record_delete(room_id, message_id, sender_id):
+    """Take a just-deleted message out of its room's summary and unread counts.
+
+    Two UPDATEs, plus a lookup of the new last message when the deleted one was it.
+    """
+    now = timezone.now()
+    RoomSummary.objects.filter(room_id=room_id, message_count__gt=0).update(
+        message_count=F('message_count') - 1,
+        updated_at=now,
+    )
+    RoomMemberState.objects.filter(
+        room_id=room_id, last_read_message_id__lt=message_id, unread_count__gt=0
+    ).exclude(user_id=sender_id).update(unread_count=F('unread_count') - 1)
+    if RoomSummary.objects.filter(room_id=room_id, last_message_id=message_id).exists():
+        newest = Message.objects.filter(room_id=room_id).order_by('-id').first()
+        RoomSummary.objects.filter(room_id=room_id).update(
+            last_message_id=newest.id if newest else 0,
+            last_message_preview=newest.content[:RoomSummary.PREVIEW_LENGTH] if newest else '',
+            last_message_at=newest.timestamp if newest else None,
+            updated_at=now,
+        )
+
+def ensure_member_states(room_id, user_ids):
+    """Give new members of a room a read state, so message writes keep their unread count."""
+    user_ids = list(user_ids)
+    existing = set(RoomMemberState.objects.filter(room_id=room_id, user_id__in=user_ids).values_list('user_id', flat=True))
+    missing = [user_id for user_id in user_ids if user_id not in existing]
+    if missing:
+        RoomMemberState.objects.bulk_create(
+            [RoomMemberState(user_id=user_id, room_id=room_id) for user_id in missing],
+            ignore_conflicts=True,
+        )
+        RoomMemberState.recount_unread((user_id, room_id) for user_id in missing)
+
+
+def drop_member_states(room_ids=None, user_ids=None):
+    """Delete the read states of users who left a room, so message writes stop counting their unreads."""
+    states = in_rooms(RoomMemberState.objects.all(), room_ids)
+    if user_ids is not None:
+        states = states.filter(user_id__in=user_ids)
+    states.delete()
+
+
+def room_filter(column, room_ids):
+    # SQL condition (with params) limiting a statement to room_ids; None means every room
+    if room_ids is None:
+        return '', []
+    if not room_ids:
+        return " AND 1 = 0", []
+    return f" AND {column} IN ({', '.join(['%s'] * len(room_ids))})", list(room_ids)
+
+
+def in_rooms(queryset, room_ids, field='room_id'):
+    return queryset if room_ids is None else queryset.filter(**{f'{field}__in': room_ids})
+
+
+def rebuild(room_ids=None, states=True, using=DEFAULT_DB_ALIAS):
+    """Recompute summaries (and unread counts) from the messages, for some rooms or all."""
+    conn = connections[using]
+    summaries = table(RoomSummary, conn)
+    rooms = table(ChatRoom, conn)
+    messages = table(Message, conn)
+    member_states = table(RoomMemberState, conn)
+    participants = table(RoomParticipant, conn)
+    archives = table(MessageArchive, conn)
+    now = conn.ops.adapt_datetimefield_value(timezone.now())
+
+    with transaction.atomic(using=using), conn.cursor() as cursor:
+        where, params = room_filter('room_id', room_ids)
+        cursor.execute(f"DELETE FROM {summaries} WHERE 1 = 1{where}", params)
+        message_where, message_params = room_filter('room_id', room_ids)
+        where, params = room_filter('r.id', room_ids)
+        # message_count includes archived messages; the newest message is never archived
+        cursor.execute(
+            f"INSERT INTO {summaries} (room_id, last_message_id, last_message_preview, last_message_at, "
+            f"message_count, updated_at) "
+            f"SELECT r.id, COALESCE(s.last_id, 0), COALESCE(SUBSTR(m.content, 1, {RoomSummary.PREVIEW_LENGTH}), ''), "
+            f"m.timestamp, COALESCE(s.total, 0) + COALESCE(a.total, 0), %s FROM {rooms} r "
+            f"LEFT JOIN (SELECT room_id, MAX(id) AS last_id, COUNT(*) AS total FROM {messages} "
+            f"WHERE 1 = 1{message_where} GROUP BY room_id) s ON s.room_id = r.id "
+            f"LEFT JOIN (SELECT room_id, SUM(message_count) AS total FROM {archives} "
+            f"WHERE 1 = 1{message_where} GROUP BY room_id) a ON a.room_id = r.id "
+            f"LEFT JOIN {messages} m ON m.id = s.last_id WHERE 1 = 1{where}",
+            [now] + message_params + message_params + params,
+        )
+        if not states:
+            return
+        where, params = room_filter('p.room_id', room_ids)
+        cursor.execute(
+            f"INSERT INTO {member_states} (user_id, room_id, last_read_message_id, unread_count, updated_at) "
+            f"SELECT p.user_id, p.room_id, 0, 0, %s FROM {participants} p WHERE NOT EXISTS ("
+            f"SELECT 1 FROM {member_states} s WHERE s.user_id = p.user_id AND s.room_id = p.room_id){where}",
+            [now] + params,
+        )
+        where, params = room_filter('room_id', room_ids)
+        cursor.execute(
+            f"UPDATE {member_states} SET unread_count = ("
+            f"SELECT COUNT(*) FROM {messages} m WHERE m.room_id = {member_states}.room_id "
+            f"AND m.id > {member_states}.last_read_message_id AND m.sender_id <> {member_states}.user_id"
+            f") WHERE 1 = 1{where}",
+            params,
+        )
+
+
+def find_drift(room_ids=None):
+    """Compare the stored summaries and unread counts with the messages.
+
+    Returns (summaries, states, missing): [(room_id, field, stored, expected)],
+    [(user_id, room_id, stored, expected)] and the (user_id, room_id) members
+    without a read state.
+    """
+    expected = {
+        room_id: (last_id, total)
+        for room_id, last_id, total in in_rooms(Message.objects.all(), room_ids).values('room_id')
+        .annotate(last_id=Max('id'), total=Count('id')).order_by().values_list('room_id', 'last_id', 'total')
+    }
+    archived = dict(
+        in_rooms(MessageArchive.objects.all(), room_ids).values('room_id')
+        .annotate(total=Sum('message_count')).order_by().values_list('room_id', 'total')
+    )
+    previews = dict(Message.objects.filter(id__in=[last_id for last_id, _ in expected.values()]).values_list('id', 'content'))
+    stored = {
+        room_id: (last_id, total, preview)
+        for room_id, last_id, total, preview in in_rooms(RoomSummary.objects.all(), room_ids)
+        .values_list('room_id', 'last_message_id', 'message_count', 'last_message_preview')
+    }
+    summaries = []
+    for room_id in in_rooms(ChatRoom.objects.all(), room_ids, 'id').values_list('id', flat=True).iterator():
+        last_id, total = expected.get(room_id, (0, 0))
+        total += archived.get(room_id, 0)
+        preview = previews.get(last_id, '')[:RoomSummary.PREVIEW_LENGTH]
+        stored_id, stored_total, stored_preview = stored.get(room_id, (0, 0, ''))
+        for field, value, expected_value in [
+            ('last_message_id', stored_id, last_id),
+            ('message_count', stored_total, total),
+            ('last_message_preview', stored_preview, preview),
+        ]:
+            if value != expected_value:
+                summaries.append((room_id, field, value, expected_value))
+
+    member_states = table(RoomMemberState)
+    messages = table(Message)
+    where, params = room_filter('s.room_id', room_ids)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT user_id, room_id, unread_count, expected FROM (SELECT s.user_id, s.room_id, s.unread_count, ("
+            f"SELECT COUNT(*) FROM {messages} m WHERE m.room_id = s.room_id "
+            f"AND m.id > s.last_read_message_id AND m.sender_id <> s.user_id"
+            f") AS expected FROM {member_states} s WHERE 1 = 1{where}) counts WHERE unread_count <> expected",
+            params,
+        )
+        states = cursor.fetchall()
+
+    missing = list(in_rooms(RoomParticipant.objects.all(), room_ids).exclude(
+        Exists(RoomMemberState.objects.filter(user_id=OuterRef('user_id'), room_id=OuterRef('room_id')))
+    ).values_list('user_id', 'room_id'))
+    return summaries, states, missing
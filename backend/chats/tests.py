@@ -1,3 +1,807 @@
-from django.test import TestCase
+# chat/tests.py
+import asyncio
+import json
+from datetime import timedelta
 
-# Create your tests here.
+from accounts.serializers import issue_tokens
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .cache import MISSING, get_cached_room_entry, get_room_entry, room_cache
+from .fanout import FanoutService
+from .layers import ShardedChannelLayer
+from .models import CURSOR_BATCH_SIZE, ChatRoom, Message, MessageArchive, RoomMemberState, RoomParticipant, RoomSummary
+from .membership import remove_members
+from .middleware import TOKEN_SUBPROTOCOL, JWTAuthMiddlewareStack, blacklist_cache
+from .outbox import EVICTED_CLOSE_CODE, Outbox, make_resume_token, read_resume_token
+from .persistence import MessageWriter
+from .presence import presence
+from .groups import room_group_name
+from .receipts import parse_read_up_to
+from .retention import apply_policy, pack, unpack
+from .routing import websocket_urlpatterns
+from .summaries import find_drift
+
+IN_MEMORY_LAYER = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def migrate(targets):
+    executor = MigrationExecutor(connection)
+    executor.migrate(targets)
+    return executor.loader.project_state(targets).apps
+
+
+class ReadCursorMigrationTests(TransactionTestCase):
+    """0002 turns Message.read_by into one read cursor per user and room."""
+
+    def setUp(self):
+        apps = migrate([('chats', '0001_initial')])
+        OldUser = apps.get_model('auth', 'User')
+        OldRoom = apps.get_model('chats', 'ChatRoom')
+        OldMessage = apps.get_model('chats', 'Message')
+
+        self.users = [OldUser.objects.create(username=f'user{i}') for i in range(3)]
+        self.rooms = [OldRoom.objects.create(name=f'room{i}', created_by=self.users[0]) for i in range(2)]
+        self.read_by = {}
+        for room in self.rooms:
+            messages = [
+                OldMessage.objects.create(room=room, sender=self.users[i % 3], content=f'{room.name} {i}')
+                for i in range(6)
+            ]
+            # Clients mark messages read in order: user1 is 3 messages in, user2 read everything
+            for user, count in [(self.users[1], 3), (self.users[2], 6)]:
+                for message in messages[:count]:
+                    if message.sender_id != user.id:
+                        message.read_by.add(user)
+            for message in messages:
+                self.read_by[message.id] = (
+                    message.room_id, message.sender_id, set(message.read_by.values_list('id', flat=True))
+                )
+
+        self.apps = migrate([('chats', '0002_room_member_state')])
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_cursors_reproduce_read_by(self):
+        State = self.apps.get_model('chats', 'RoomMemberState')
+        cursors = {(state.user_id, state.room_id): state.last_read_message_id for state in State.objects.all()}
+        for message_id, (room_id, sender_id, read_by) in self.read_by.items():
+            readers = {
+                user_id for (user_id, state_room_id), last_read in cursors.items()
+                if state_room_id == room_id and last_read >= message_id and user_id != sender_id
+            }
+            self.assertEqual(readers, read_by, f'message {message_id}')
+
+    def test_cursor_is_newest_read_message(self):
+        State = self.apps.get_model('chats', 'RoomMemberState')
+        for room in self.rooms:
+            ids = sorted(message_id for message_id, (room_id, _, _) in self.read_by.items() if room_id == room.id)
+            cursors = dict(State.objects.filter(room_id=room.id).values_list('user_id', 'last_read_message_id'))
+            # user2 sent the last message, so it was never in their read_by
+            self.assertEqual(cursors, {self.users[1].id: ids[2], self.users[2].id: ids[4]})
+
+
+class ReadCursorTests(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(f'user{i}', password='pw') for i in range(3)]
+        self.room = ChatRoom.objects.create(name='room', room_type='group', created_by=self.users[0])
+        self.room.participants.add(*self.users)
+        self.messages = [
+            Message.objects.create(room=self.room, sender=self.users[i % 2], content=str(i)) for i in range(6)
+        ]
+
+    def test_advance_many_never_moves_backwards(self):
+        user, room = self.users[2], self.room
+        RoomMemberState.advance(user.id, room.id, self.messages[4].id)
+        RoomMemberState.advance_many([
+            (user.id, room.id, self.messages[1].id),
+            (user.id, room.id, self.messages[2].id),
+        ])
+        self.assertEqual(RoomMemberState.last_read(user.id, room.id), self.messages[4].id)
+        self.assertEqual(RoomMemberState.unread(user.id, room.id), 1)
+
+    def test_advance_many_keeps_the_newest_cursor_of_a_batch(self):
+        user, room = self.users[2], self.room
+        RoomMemberState.advance_many([
+            (user.id, room.id, self.messages[3].id),
+            (user.id, room.id, self.messages[1].id),
+            (self.users[1].id, room.id, self.messages[5].id),
+        ])
+        self.assertEqual(RoomMemberState.last_read(user.id, room.id), self.messages[3].id)
+        self.assertEqual(RoomMemberState.last_read(self.users[1].id, room.id), self.messages[5].id)
+        self.assertEqual(RoomMemberState.unread(user.id, room.id), 2)
+        self.assertEqual(RoomMemberState.unread(self.users[1].id, room.id), 0)
+
+    def test_advance_many_past_the_bind_parameter_limit(self):
+        users = User.objects.bulk_create([User(username=f'reader{i}') for i in range(40)])
+        ChatRoom.objects.bulk_create([
+            ChatRoom(name=f'room {i}', room_type='group', created_by=self.users[0]) for i in range(30)
+        ])
+        rooms = list(ChatRoom.objects.all())
+        cursors = [(user.id, room.id, self.messages[3].id) for user in users for room in rooms]
+        # An upsert and a recount per CURSOR_BATCH_SIZE cursors
+        with self.assertNumQueries(2 * -(-len(cursors) // CURSOR_BATCH_SIZE)):
+            RoomMemberState.advance_many(cursors)
+        self.assertEqual(
+            RoomMemberState.objects.filter(last_read_message_id=self.messages[3].id).count(),
+            len(users) * len(rooms),
+        )
+        self.assertEqual(RoomMemberState.unread(users[-1].id, self.room.id), 2)
+
+    def test_readers_of_page_skips_cursors_behind_it(self):
+        RoomMemberState.advance(self.users[1].id, self.room.id, self.messages[5].id)
+        RoomMemberState.advance(self.users[2].id, self.room.id, self.messages[1].id)
+        readers = RoomMemberState.readers_of_page(self.messages[3:])
+        self.assertEqual(readers, {self.room.id: [(self.users[1], self.messages[5].id)]})
+
+
+class MessageWriterTests(TransactionTestCase):
+    """Write-behind inserts; a TransactionTestCase so foreign keys are checked at commit."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('writer', password='pw')
+        self.room = ChatRoom.objects.create(name='room', room_type='group', created_by=self.user)
+        self.room.participants.add(self.user)
+        self.writer = MessageWriter(batch_size=10, flush_interval=0, max_pending=100)
+
+    def build(self, content, room_id=None):
+        return self.writer.build(room_id or self.room.id, self.user.id, content)
+
+    def stored(self):
+        return list(Message.objects.filter(room=self.room).values_list('content', flat=True))
+
+    def test_batch_is_stored_and_summarized(self):
+        self.writer.pending.extend(self.build(str(i)) for i in range(3))
+        self.writer.write(self.writer.take_batch())
+        self.assertEqual(self.stored(), ['0', '1', '2'])
+        self.assertEqual(RoomSummary.objects.get(room=self.room).message_count, 3)
+        self.assertEqual(self.writer.in_flight, {})
+
+    def test_bad_message_falls_back_to_row_by_row(self):
+        batch = [self.build('before'), self.build('lost', room_id=self.room.id + 1000), self.build('after')]
+        with self.assertLogs('chats.persistence', 'ERROR'):
+            self.writer.write(batch)
+        self.assertEqual(self.stored(), ['before', 'after'])
+        self.assertEqual(RoomSummary.objects.get(room=self.room).message_count, 2)
+
+    def test_retried_batch_skips_stored_messages(self):
+        first = self.build('first')
+        self.writer.write([first])
+        with self.assertLogs('chats.persistence', 'ERROR'):
+            self.writer.write([first, self.build('second')])
+        self.assertEqual(self.stored(), ['first', 'second'])
+        self.assertEqual(RoomSummary.objects.get(room=self.room).message_count, 2)
+
+    def test_id_clash_stores_the_message_under_a_new_id(self):
+        first = self.build('first')
+        self.writer.write([first])
+        clash = self.build('clash')
+        clash.id = first.id
+        with self.assertLogs('chats.persistence', 'ERROR'):
+            self.writer.write([clash])
+        self.assertNotEqual(clash.id, first.id)
+        self.assertEqual(Message.objects.get(id=first.id).content, 'first')
+        self.assertEqual(Message.objects.get(id=clash.id).content, 'clash')
+
+
+class RoomSummaryTests(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(f'user{i}', password='pw') for i in range(3)]
+        self.room = ChatRoom.objects.create(name='room', room_type='group', created_by=self.users[0])
+        self.room.participants.add(*self.users)
+        self.clients = []
+        for user in self.users:
+            client = APIClient()
+            client.force_authenticate(user)
+            self.clients.append(client)
+        self.messages = [self.send(i % 3, f'message {i}') for i in range(4)]
+
+    def send(self, sender, content):
+        response = self.clients[sender].post('/api/chat/messages/', {'room_id': self.room.id, 'content': content})
+        self.assertEqual(response.status_code, 201)
+        return response.data['id']
+
+    def summary(self):
+        summary = RoomSummary.objects.get(room=self.room)
+        return summary.message_count, summary.last_message_id, summary.last_message_preview
+
+    def unread(self):
+        return [RoomMemberState.unread(user.id, self.room.id) for user in self.users]
+
+    def test_create_counts_messages(self):
+        self.assertEqual(self.summary(), (4, self.messages[-1], 'message 3'))
+        # user0 sent messages 0 and 3, user1 message 1, user2 message 2
+        self.assertEqual(self.unread(), [2, 3, 3])
+        self.assertEqual(find_drift(), ([], [], []))
+
+    def test_delete_recounts(self):
+        response = self.clients[0].delete(f'/api/chat/messages/{self.messages[-1]}/?room_id={self.room.id}')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.summary(), (3, self.messages[-2], 'message 2'))
+        self.assertEqual(self.unread(), [2, 2, 2])
+        self.assertEqual(find_drift(), ([], [], []))
+
+    def test_delete_of_an_older_message_keeps_the_last_one(self):
+        RoomMemberState.advance(self.users[1].id, self.room.id, self.messages[1])
+        response = self.clients[0].delete(f'/api/chat/messages/{self.messages[0]}/?room_id={self.room.id}')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.summary(), (3, self.messages[-1], 'message 3'))
+        # Only user2 still had message 0 unread
+        self.assertEqual(self.unread(), [2, 2, 2])
+        self.assertEqual(find_drift(), ([], [], []))
+
+    def test_deleting_every_message_empties_the_summary(self):
+        for message_id, sender in reversed(list(zip(self.messages, [0, 1, 2, 0]))):
+            self.clients[sender].delete(f'/api/chat/messages/{message_id}/?room_id={self.room.id}')
+        self.assertEqual(self.summary(), (0, 0, ''))
+        self.assertEqual(self.unread(), [0, 0, 0])
+        self.assertEqual(find_drift(), ([], [], []))
+
+    def test_edit_updates_only_the_last_message_preview(self):
+        url = f'/api/chat/messages/{{}}/?room_id={self.room.id}'
+        self.clients[0].patch(url.format(self.messages[0]), {'content': 'edited first'})
+        self.assertEqual(self.summary(), (4, self.messages[-1], 'message 3'))
+        self.clients[0].patch(url.format(self.messages[-1]), {'content': 'edited last'})
+        self.assertEqual(self.summary(), (4, self.messages[-1], 'edited last'))
+        self.assertEqual(find_drift(), ([], [], []))
+
+    def test_removed_members_stop_collecting_unreads(self):
+        remove_members(self.room, [self.users[2].id])
+        self.send(0, 'after')
+        self.assertFalse(RoomMemberState.objects.filter(room=self.room, user=self.users[2]).exists())
+        self.assertEqual(self.unread()[:2], [2, 4])
+        self.assertEqual(find_drift(), ([], [], []))
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(f'user{i}', password='pw') for i in range(3)]
+        self.room = ChatRoom.objects.create(
+            name='room', room_type='group', created_by=self.users[0], archive_after_days=30
+        )
+        self.room.participants.add(*self.users)
+        old = timezone.now() - timedelta(days=60)
+        self.ids = []
+        for i in range(20):
+            # The 15 oldest messages are past archive_after_days
+            message = Message.objects.create(
+                room=self.room, sender=self.users[i % 2], content=f'message {i}',
+                timestamp=old if i < 15 else timezone.now(),
+            )
+            self.ids.append(message.id)
+        # user2 has read into what will be archived
+        RoomMemberState.advance(self.users[2].id, self.room.id, self.ids[6])
+        self.client = APIClient()
+        self.client.force_authenticate(self.users[1])
+
+    def archive(self):
+        self.assertEqual(apply_policy(self.room, chunk_size=4), (15, 0))
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 5)
+
+    def walk(self, url, link):
+        ids, pages = [], 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.append([message['id'] for message in response.data['results']])
+            url = response.data[link]
+            pages += 1
+            self.assertLess(pages, 20)
+        return ids
+
+    def test_pack_round_trip(self):
+        messages = list(Message.objects.filter(room=self.room).order_by('id')[:5])
+        messages[1].is_edited, messages[1].edited_at = True, timezone.now()
+        archive = MessageArchive(room=self.room, data=pack(messages))
+        fields = ['id', 'room_id', 'sender_id', 'content', 'timestamp', 'is_edited', 'edited_at']
+        self.assertEqual(
+            [[getattr(message, field) for field in fields] for message in unpack(archive)],
+            [[getattr(message, field) for field in fields] for message in messages],
+        )
+
+    def test_pages_walk_back_through_the_archive(self):
+        self.archive()
+        pages = self.walk(f'/api/chat/messages/?room_id={self.room.id}&limit=4', 'previous')
+        self.assertEqual([message_id for page in reversed(pages) for message_id in page], self.ids)
+        # The page that crosses from hot messages into the archive is still full
+        self.assertEqual(pages[1], self.ids[12:16])
+
+    def test_pages_walk_forward_out_of_the_archive(self):
+        self.archive()
+        pages = self.walk(f'/api/chat/messages/?room_id={self.room.id}&limit=4&after=0', 'next')
+        self.assertEqual([message_id for page in pages for message_id in page], self.ids)
+
+    def test_archived_messages_keep_read_by(self):
+        self.archive()
+        response = self.client.get(f'/api/chat/messages/?room_id={self.room.id}&limit=10&before={self.ids[10]}')
+        read_by = {message['id']: [user['id'] for user in message['read_by']] for message in response.data['results']}
+        user2 = self.users[2].id
+        self.assertEqual([message_id for message_id, readers in read_by.items() if user2 in readers], self.ids[:7])
+
+        response = self.client.get(f'/api/chat/messages/?room_id={self.room.id}&limit=10&before={self.ids[10]}&compact=1')
+        compact = {message['id']: message['read_by'] for message in response.data['results']}
+        self.assertEqual(compact, read_by)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER)
+class ConsumerTestCase(TransactionTestCase):
+    """Sockets against the consumers, with an in-memory channel layer.
+
+    A TransactionTestCase: consumer queries run on another thread's connection.
+    """
+
+    def setUp(self):
+        room_cache.clear()
+        self.users = [User.objects.create_user(f'user{i}', password='pw') for i in range(3)]
+        self.room = ChatRoom.objects.create(name='room', room_type='group', created_by=self.users[0])
+        self.room.participants.add(*self.users)
+
+    def tearDown(self):
+        # Write presence now rather than at exit, when the test database is gone
+        presence.flush_sync()
+
+    async def connect(self, user, path=None, app=None):
+        inner = app or URLRouter(websocket_urlpatterns)
+
+        async def application(scope, receive, send):
+            return await inner(dict(scope, user=user), receive, send)
+
+        communicator = WebsocketCommunicator(application, path or f'/ws/chat/{self.room.id}/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_frames(self, communicator, timeout=0.2):
+        frames = []
+        while not await communicator.receive_nothing(timeout=timeout):
+            frames.append(json.loads(await communicator.receive_from()))
+        return frames
+
+
+class ReadReceiptTests(ConsumerTestCase):
+    def test_parse_read_up_to(self):
+        self.assertEqual(parse_read_up_to({'message_id': 4}), 4)
+        self.assertEqual(parse_read_up_to({'up_to': '7', 'message_ids': [3, 9, 'x']}), 9)
+        self.assertEqual(parse_read_up_to({'ranges': [[1, 5], [8, 12]]}), 12)
+        self.assertIsNone(parse_read_up_to({'message_ids': []}))
+
+    def test_parse_read_up_to_ignores_malformed_values(self):
+        for data in [
+            {'message_ids': 5},
+            {'message_ids': {'1': 2}},
+            {'ranges': [1, 2]},
+            {'ranges': 7},
+            {'ranges': [[1, 2, 3], [4], 'ab', [None, {}]]},
+            {'message_id': [1]},
+        ]:
+            self.assertIsNone(parse_read_up_to(data), data)
+        self.assertEqual(parse_read_up_to({'message_ids': 5, 'ranges': [[1, 6]]}), 6)
+
+    async def test_malformed_receipts_keep_the_socket_open(self):
+        communicator = await self.connect(self.users[1], '/ws/chat/')
+        await communicator.send_json_to({'type': 'subscribe', 'rooms': [self.room.id]})
+        await self.receive_frames(communicator)
+        for frame in [{'message_ids': 5}, {'ranges': [1, 2]}, {'ranges': [[1]]}]:
+            await communicator.send_json_to(dict(frame, type='read_receipt', room_id=self.room.id))
+        await communicator.send_json_to({'type': 'load_history', 'room_id': self.room.id})
+        frames = await self.receive_frames(communicator)
+        self.assertEqual([frame['type'] for frame in frames], ['history'])
+        await communicator.disconnect()
+
+
+class RoomFrameValidationTests(ConsumerTestCase):
+    async def test_bad_chat_messages_get_an_error_frame(self):
+        communicator = await self.connect(self.users[1], '/ws/chat/')
+        await communicator.send_json_to({'type': 'subscribe', 'rooms': [self.room.id]})
+        await self.receive_frames(communicator)
+        for frame in [{}, {'message': 5}, {'message': ['hi']}, {'message': '  '}]:
+            await communicator.send_json_to(dict(frame, type='chat_message', room_id=self.room.id))
+            self.assertEqual(
+                await self.receive_frames(communicator),
+                [{'type': 'error', 'room_id': self.room.id, 'error': 'invalid_message'}],
+            )
+        await communicator.send_json_to({'type': 'chat_message', 'room_id': self.room.id, 'message': 'hello'})
+        frames = await self.receive_frames(communicator)
+        self.assertEqual([frame['content'] for frame in frames if frame['type'] == 'chat_message'], ['hello'])
+        await communicator.disconnect()
+
+    async def test_bad_history_cursor_gets_an_error_frame(self):
+        communicator = await self.connect(self.users[1])
+        await self.receive_frames(communicator)
+        await communicator.send_json_to({'type': 'load_history', 'before': 'x'})
+        self.assertEqual(
+            await self.receive_frames(communicator),
+            [{'type': 'error', 'room_id': self.room.id, 'error': 'invalid_cursor'}],
+        )
+        await communicator.send_json_to({'type': 'chat_message'})
+        self.assertEqual(
+            await self.receive_frames(communicator),
+            [{'type': 'error', 'room_id': self.room.id, 'error': 'invalid_message'}],
+        )
+        await communicator.disconnect()
+
+
+class WhoAmIConsumer(AsyncWebsocketConsumer):
+    async def connect(self):
+        await self.accept()
+        user = self.scope['user']
+        await self.send(text_data=json.dumps({'user_id': user.id if user.is_authenticated else None}))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER)
+class JWTAuthMiddlewareTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('user0', password='pw')
+        self.app = JWTAuthMiddlewareStack(WhoAmIConsumer.as_asgi())
+        # Reload the blacklist on the next handshake
+        blacklist_cache.expires_at = 0
+
+    async def handshake_user(self, path='/ws/chat/', **kwargs):
+        communicator = WebsocketCommunicator(self.app, path, **kwargs)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        user_id = (await communicator.receive_json_from())['user_id']
+        await communicator.disconnect()
+        return user_id
+
+    async def access_token(self):
+        # issue_tokens records the refresh token as outstanding
+        refresh = await database_sync_to_async(issue_tokens)(self.user)
+        return str(refresh.access_token)
+
+    async def test_token_in_query_string(self):
+        self.assertEqual(await self.handshake_user(f'/ws/chat/?token={await self.access_token()}'), self.user.id)
+
+    async def test_token_in_subprotocol(self):
+        user_id = await self.handshake_user(subprotocols=[TOKEN_SUBPROTOCOL, await self.access_token()])
+        self.assertEqual(user_id, self.user.id)
+
+    async def test_invalid_and_expired_tokens_are_anonymous(self):
+        expired = AccessToken.for_user(self.user)
+        expired.set_exp(lifetime=-timedelta(minutes=1))
+        for token in ['garbage', str(expired)]:
+            self.assertIsNone(await self.handshake_user(f'/ws/chat/?token={token}'))
+
+    async def test_blacklisted_session_is_anonymous(self):
+        refresh = await database_sync_to_async(issue_tokens)(self.user)
+        access = str(refresh.access_token)
+        self.assertEqual(await self.handshake_user(f'/ws/chat/?token={access}'), self.user.id)
+        await database_sync_to_async(refresh.blacklist)()
+        blacklist_cache.expires_at = 0
+        self.assertIsNone(await self.handshake_user(f'/ws/chat/?token={access}'))
+
+    async def test_no_token_falls_back_to_the_session(self):
+        self.assertIsNone(await self.handshake_user())
+        client = Client()
+        await database_sync_to_async(client.force_login)(self.user)
+        cookie = f"{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}"
+        self.assertEqual(await self.handshake_user(headers=[(b'cookie', cookie.encode())]), self.user.id)
+
+
+class MembershipTests(TestCase):
+    def setUp(self):
+        room_cache.clear()
+        # user0 created the room, user1 is an admin, user2 and user3 are members, user4 is outside
+        self.users = [User.objects.create_user(f'user{i}', password='pw') for i in range(5)]
+        self.room = ChatRoom.objects.create(name='room', room_type='group', created_by=self.users[0])
+        self.room.participants.add(*self.users[:4])
+        RoomParticipant.objects.filter(room=self.room, user=self.users[1]).update(is_admin=True)
+        Message.objects.create(room=self.room, sender=self.users[0], content='hello')
+
+    def members(self, user, **data):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.post(f'/api/chat/rooms/{self.room.id}/members/', data, format='json')
+
+    def member_ids(self):
+        return set(self.room.participants.values_list('id', flat=True))
+
+    def test_members_can_add_people(self):
+        response = self.members(self.users[2], add=[self.users[4].id])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['added'], [self.users[4].id])
+        self.assertIn(self.users[4].id, self.member_ids())
+        self.assertEqual(RoomMemberState.unread(self.users[4].id, self.room.id), 1)
+
+    def test_members_cannot_remove_others(self):
+        response = self.members(self.users[2], remove=[self.users[3].id])
+        self.assertEqual(response.status_code, 403)
+        self.assertIn(self.users[3].id, self.member_ids())
+        # Not even alongside themselves
+        response = self.members(self.users[2], remove=[self.users[2].id, self.users[3].id])
+        self.assertEqual(response.status_code, 403)
+        self.assertIn(self.users[2].id, self.member_ids())
+
+    def test_creator_and_admins_can_remove_others(self):
+        for manager, removed in [(self.users[0], self.users[2]), (self.users[1], self.users[3])]:
+            response = self.members(manager, remove=[removed.id])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['removed'], [removed.id])
+            self.assertNotIn(removed.id, self.member_ids())
+
+    def test_members_can_remove_themselves(self):
+        response = self.members(self.users[3], remove=[self.users[3].id])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(self.users[3].id, self.member_ids())
+
+    def test_outsiders_cannot_change_membership(self):
+        response = self.members(self.users[4], add=[self.users[4].id])
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn(self.users[4].id, self.member_ids())
+
+    def test_removal_drops_read_state_and_cached_room(self):
+        self.assertIn(self.users[2].id, get_room_entry(self.room.id)['participants'])
+        self.assertTrue(RoomMemberState.objects.filter(room=self.room, user=self.users[2]).exists())
+        self.members(self.users[0], remove=[self.users[2].id])
+        self.assertIs(get_cached_room_entry(self.room.id), MISSING)
+        self.assertNotIn(self.users[2].id, get_room_entry(self.room.id)['participants'])
+        self.assertFalse(RoomMemberState.objects.filter(room=self.room, user=self.users[2]).exists())
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(f'user{i}', password='pw') for i in range(2)]
+        self.rooms = []
+        for user in self.users:
+            room = ChatRoom.objects.create(name=f'{user.username} room', room_type='group', created_by=user)
+            room.participants.add(user)
+            self.rooms.append(room)
+        self.mine = Message.objects.create(room=self.rooms[0], sender=self.users[0], content='release notes')
+        self.theirs = Message.objects.create(room=self.rooms[1], sender=self.users[1], content='release plan')
+        self.client = APIClient()
+        self.client.force_authenticate(self.users[0])
+
+    def search(self, **params):
+        response = self.client.get('/api/chat/messages/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return [message['id'] for message in response.data['results']]
+
+    def test_search_only_returns_the_requesters_rooms(self):
+        for order in ['rank', 'recent']:
+            self.assertEqual(self.search(q='release', order=order), [self.mine.id])
+        self.assertEqual(self.search(q='plan'), [])
+        self.assertEqual(self.search(q='release', room_id=self.rooms[1].id), [])
+
+    def test_search_follows_membership_changes(self):
+        self.rooms[1].participants.add(self.users[0])
+        self.assertEqual(set(self.search(q='release')), {self.mine.id, self.theirs.id})
+        self.rooms[1].participants.remove(self.users[0])
+        self.assertEqual(self.search(q='release'), [self.mine.id])
+
+
+class OutboxTests(SimpleTestCase):
+    def make_outbox(self, high_water, limit, batch_size=3):
+        self.gate = asyncio.Event()
+        self.sent = []
+        self.evictions = 0
+
+        async def send(text):
+            await self.gate.wait()
+            self.sent.append(json.loads(text))
+
+        async def evict():
+            self.evictions += 1
+
+        return Outbox(send, evict, high_water, limit, batch_size)
+
+    async def test_backlog_drops_typing_and_batches_the_rest(self):
+        outbox = self.make_outbox(high_water=4, limit=10)
+        outbox.push('chat_message', '{"id":1}', 1, 1)
+        outbox.push('typing', '{"typing":1}')
+        outbox.push('chat_message', '{"id":2}', 1, 2)
+        outbox.push('chat_message', '{"id":3}', 1, 3)
+        outbox.push('chat_message', '{"id":4}', 1, 4)
+        outbox.push('typing', '{"typing":2}')
+        self.gate.set()
+        await outbox.drain(timeout=1)
+        self.assertEqual(self.sent, [
+            {'type': 'batch', 'frames': [{'id': 1}, {'id': 2}, {'id': 3}]},
+            {'id': 4},
+        ])
+        self.assertEqual(outbox.delivered, {1: 4})
+        self.assertFalse(outbox.shedding)
+
+    async def test_backlog_past_the_limit_evicts(self):
+        outbox = self.make_outbox(high_water=2, limit=4)
+        for message_id in range(1, 7):
+            outbox.push('chat_message', '{"id":%d}' % message_id, 1, message_id)
+        await asyncio.sleep(0)
+        self.assertEqual(self.evictions, 1)
+        self.assertTrue(outbox.closed)
+        self.assertFalse(outbox.frames)
+        outbox.close()
+
+
+@override_settings(CHAT_OUTBOX_HIGH_WATER=2, CHAT_OUTBOX_LIMIT=4)
+class EvictionTests(ConsumerTestCase):
+    async def test_slow_client_gets_an_evicted_frame_and_close(self):
+        gate = asyncio.Event()
+        inner = URLRouter(websocket_urlpatterns)
+
+        async def stalled(scope, receive, send):
+            async def slow_send(message):
+                if message['type'] == 'websocket.send':
+                    await gate.wait()
+                await send(message)
+            return await inner(scope, receive, slow_send)
+
+        slow = await self.connect(self.users[1], app=stalled)
+        sender = await self.connect(self.users[0])
+        for i in range(6):
+            await sender.send_json_to({'message': f'message {i}'})
+        await self.receive_frames(sender)
+        gate.set()
+
+        frames = []
+        while True:
+            output = await slow.receive_output(timeout=1)
+            if output['type'] == 'websocket.close':
+                break
+            frames.append(json.loads(output['text']))
+        self.assertEqual(output['code'], EVICTED_CLOSE_CODE)
+        self.assertEqual(frames[-1]['type'], 'evicted')
+        self.assertEqual(frames[-1]['reason'], 'slow_consumer')
+        self.assertIsInstance(read_resume_token(frames[-1]['resume_token'], self.users[1].id), dict)
+        await slow.disconnect()
+        await sender.disconnect()
+
+
+@override_settings(CHAT_CATCH_UP_CHUNK=2, CHAT_CATCH_UP_MAX=5)
+class ResumeTests(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ids = [
+            Message.objects.create(room=self.room, sender=self.users[0], content=f'message {i}').id
+            for i in range(6)
+        ]
+
+    def test_resume_token_round_trip(self):
+        token = make_resume_token(self.users[1].id, {self.room.id: self.ids[2]})
+        self.assertEqual(read_resume_token(token, self.users[1].id), {self.room.id: self.ids[2]})
+        self.assertIsNone(read_resume_token(token, self.users[2].id))
+        tampered = token[:-1] + ('A' if token[-1] != 'A' else 'B')
+        self.assertIsNone(read_resume_token(tampered, self.users[1].id))
+        self.assertIsNone(read_resume_token('garbage', self.users[1].id))
+
+    async def test_catch_up_streams_in_chunks(self):
+        communicator = await self.connect(self.users[1], f'/ws/chat/{self.room.id}/?last_id={self.ids[0]}')
+        frames = [frame for frame in await self.receive_frames(communicator) if frame['type'] == 'catch_up']
+        self.assertEqual(
+            [[message['id'] for message in frame['messages']] for frame in frames],
+            [self.ids[1:3], self.ids[3:5], self.ids[5:]],
+        )
+        self.assertEqual([frame['after'] for frame in frames], [self.ids[0], self.ids[2], self.ids[4]])
+        self.assertEqual([frame['complete'] for frame in frames], [False, False, True])
+        await communicator.disconnect()
+
+    async def test_too_far_behind_gets_a_history_gap(self):
+        communicator = await self.connect(self.users[1], f'/ws/chat/{self.room.id}/?last_id=0')
+        frames = await self.receive_frames(communicator)
+        types = [frame['type'] for frame in frames]
+        self.assertNotIn('catch_up', types)
+        gap = frames[types.index('history_gap')]
+        self.assertEqual(gap['after'], 0)
+        self.assertEqual(gap['before'], self.ids[0])
+        self.assertEqual(types[types.index('history_gap') + 1], 'recent_messages')
+        await communicator.disconnect()
+
+    async def test_resume_token_picks_the_catch_up_point(self):
+        token = make_resume_token(self.users[1].id, {self.room.id: self.ids[3]})
+        communicator = await self.connect(self.users[1], f'/ws/chat/{self.room.id}/?resume={token}')
+        frames = [frame for frame in await self.receive_frames(communicator) if frame['type'] == 'catch_up']
+        self.assertEqual([message['id'] for message in frames[0]['messages']], self.ids[4:])
+        await communicator.disconnect()
+
+        # Someone else's token is ignored: the client gets the recent messages instead
+        communicator = await self.connect(self.users[2], f'/ws/chat/{self.room.id}/?resume={token}')
+        types = [frame['type'] for frame in await self.receive_frames(communicator)]
+        self.assertIn('recent_messages', types)
+        self.assertNotIn('catch_up', types)
+        await communicator.disconnect()
+
+
+class ShardedChannelLayerTests(SimpleTestCase):
+    async def receive_nothing(self, layer, channel):
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(channel), timeout=0.05)
+
+    async def test_group_send_reaches_every_member(self):
+        layer = ShardedChannelLayer(shards=4)
+        channels = [await layer.new_channel() for _ in range(3)]
+        for channel in channels:
+            await layer.group_add('room', channel)
+        await layer.group_discard('room', channels[2])
+        await layer.group_send('room', {'type': 'chat.message', 'n': 1})
+        for channel in channels[:2]:
+            self.assertEqual(await layer.receive(channel), {'type': 'chat.message', 'n': 1})
+        await self.receive_nothing(layer, channels[2])
+
+    async def test_full_channels_are_skipped_by_group_send(self):
+        layer = ShardedChannelLayer(capacity=2)
+        full, other = await layer.new_channel(), await layer.new_channel()
+        await layer.send(full, {'type': 'a'})
+        await layer.send(full, {'type': 'b'})
+        with self.assertRaises(ChannelFull):
+            await layer.send(full, {'type': 'c'})
+        await layer.group_add('room', full)
+        await layer.group_add('room', other)
+        await layer.group_send('room', {'type': 'd'})
+        self.assertEqual(await layer.receive(other), {'type': 'd'})
+        self.assertEqual([(await layer.receive(full))['type'] for _ in range(2)], ['a', 'b'])
+        await self.receive_nothing(layer, full)
+
+    async def test_expired_messages_and_channels_are_dropped(self):
+        layer = ShardedChannelLayer(expiry=0.05, shards=1)
+        stale, live = await layer.new_channel(), await layer.new_channel()
+        await layer.group_add('room', stale)
+        await layer.group_add('room', live)
+        await layer.send(stale, {'type': 'old'})
+        await asyncio.sleep(0.1)
+        # The sweep finds the expired message and takes its channel out of the group
+        await layer.group_send('room', {'type': 'new'})
+        self.assertEqual(list(layer.groups[0]['room']), [live])
+        self.assertEqual(await layer.receive(live), {'type': 'new'})
+        await self.receive_nothing(layer, stale)
+
+    async def test_memberships_expire(self):
+        layer = ShardedChannelLayer(group_expiry=0.05, shards=1)
+        channel = await layer.new_channel()
+        await layer.group_add('room', channel)
+        await asyncio.sleep(0.1)
+        await layer.group_send('room', {'type': 'new'})
+        await self.receive_nothing(layer, channel)
+        self.assertEqual(layer.groups, [{}])
+
+
+class FanoutServiceTests(ConsumerTestCase):
+    async def listen(self, *room_ids):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        for room_id in room_ids:
+            await layer.group_add(room_group_name(room_id), channel)
+        return layer, channel
+
+    async def test_rooms_keep_their_order_across_workers(self):
+        other = await database_sync_to_async(ChatRoom.objects.create)(
+            name='other', room_type='group', created_by=self.users[0]
+        )
+        layer, channel = await self.listen(self.room.id, other.id)
+        service = FanoutService(workers=2, large_room=100, batch_window=0.05, typing_sample=3)
+        for n in range(10):
+            for room_id in (self.room.id, other.id):
+                await service.publish(room_id, {'type': 'chat_message', 'message_id': n, 'n': n})
+        events = [await layer.receive(channel) for _ in range(20)]
+        await service.close()
+        for room_id in (self.room.id, other.id):
+            self.assertEqual([event['message_id'] for event in events if event['room_id'] == room_id], list(range(10)))
+
+    async def test_large_rooms_get_batches_with_sampled_typers(self):
+        await database_sync_to_async(ChatRoom.objects.filter(id=self.room.id).update)(room_type='channel')
+        layer, channel = await self.listen(self.room.id)
+        service = FanoutService(workers=2, large_room=3, batch_window=0.05, typing_sample=1)
+        await service.publish(self.room.id, {'type': 'chat_message', 'message_id': 5})
+        await service.publish(self.room.id, {'type': 'typing', 'started': [1, 2, 3], 'stopped': []})
+        await service.publish(self.room.id, {'type': 'chat_message', 'message_id': 7})
+        event = await asyncio.wait_for(layer.receive(channel), timeout=1)
+        await service.close()
+        self.assertEqual(event['type'], 'batch')
+        self.assertEqual(event['message_id'], 7)
+        self.assertEqual(json.loads(event['frame'])['frames'], [
+            {'type': 'chat_message', 'message_id': 5, 'room_id': self.room.id},
+            {'type': 'typing', 'started': [1], 'stopped': [], 'more_typing': True, 'room_id': self.room.id},
+            {'type': 'chat_message', 'message_id': 7, 'room_id': self.room.id},
+        ])
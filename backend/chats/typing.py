@@ -0,0 +1,90 @@
+# chat/typing.py
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+
+from . import metrics
+from .fanout import fanout
+
+logger = logging.getLogger(__name__)
+
+
+class TypingCoalescer:
+    """Turns per-keystroke typing_start/typing_stop frames into one event per room per window.
+
+    Each window, the users typing in a room are compared with what was last announced and
+    a single `typing` frame lists who started and who stopped. A typing_start only refreshes
+    the user's expiry, so repeats inside the window cost nothing, and a user who stops
+    sending typing_start drops out after `ttl` seconds without an explicit typing_stop.
+
+    State is per process: each process announces changes for the sockets it holds, and
+    because frames are deltas, announcements from several processes compose.
+    """
+
+    def __init__(self, window, ttl):
+        self.window = window
+        self.ttl = ttl
+        # room_id -> {user_id: (username, expires_at)}
+        self.typing = {}
+        # room_id -> {user_id: username} as of the last frame sent
+        self.announced = {}
+        self.task = None
+
+    def start(self, room_id, user_id, username):
+        self.typing.setdefault(room_id, {})[user_id] = (username, time.monotonic() + self.ttl)
+        metrics.incr('typing.received')
+        self.ensure_running()
+
+    def stop(self, room_id, user_id):
+        room = self.typing.get(room_id)
+        if room and room.pop(user_id, None) is not None:
+            metrics.incr('typing.received')
+            self.ensure_running()
+
+    def ensure_running(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def collect(self):
+        """Expire stale typers and return [(room_id, started, stopped)] since the last call."""
+        now = time.monotonic()
+        changes = []
+        for room_id in list(self.typing.keys() | self.announced.keys()):
+            room = self.typing.get(room_id, {})
+            for user_id in [user_id for user_id, (_, expires_at) in room.items() if expires_at <= now]:
+                del room[user_id]
+            announced = self.announced.get(room_id, {})
+            started = [
+                {'user_id': user_id, 'user': username}
+                for user_id, (username, _) in room.items() if user_id not in announced
+            ]
+            stopped = [user_id for user_id in announced if user_id not in room]
+            if started or stopped:
+                changes.append((room_id, started, stopped))
+
+            if room:
+                self.announced[room_id] = {user_id: username for user_id, (username, _) in room.items()}
+            else:
+                self.typing.pop(room_id, None)
+                self.announced.pop(room_id, None)
+        return changes
+
+    async def run(self):
+        while self.typing or self.announced:
+            await asyncio.sleep(self.window)
+            for room_id, started, stopped in self.collect():
+                metrics.incr('typing.sent')
+                try:
+                    await fanout.publish(room_id, {
+                        'type': 'typing',
+                        'room_id': room_id,
+                        'started': started,
+                        'stopped': stopped,
+                    })
+                except Exception:
+                    logger.exception(f"Failed to send typing update for room {room_id}")
+
+
+typing_coalescer = TypingCoalescer(settings.CHAT_TYPING_WINDOW, settings.CHAT_TYPING_TTL)
@@ -10,4 +10,5 @@ router.register(r'users', views.UserViewSet, basename='user')
 
 urlpatterns = [
     path('api/chat/', include(router.urls)),
+    path('api/chat/metrics/', views.MetricsView.as_view(), name='chat-metrics'),
 ]   
\ No newline at end of file
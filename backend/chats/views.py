@@ -2,34 +2,100 @@
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
-from django.db.models import Q, Count
-from .models import ChatRoom, Message, UserStatus
-from .serializers import ChatRoomSerializer, MessageSerializer, CreateRoomSerializer, UserSerializer
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from rest_framework.views import APIView
+from rest_framework.utils.urls import replace_query_param
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, Prefetch
+from django.db.models.functions import Coalesce
+from .models import ChatRoom, Message, User, RoomMemberState, RoomParticipant
+from .serializers import (
+    ChatRoomSerializer, MessageSerializer, MessageSearchResultSerializer, CreateRoomSerializer, UserSerializer,
+    CompactSerializer, MembershipSerializer, wants_compact,
+)
+from .membership import add_members, existing_users, notify_membership, parse_user_ids, remove_members
+from .summaries import record_delete, record_edit, record_messages
+from .pagination import MessageCursorPagination, clamp_page_size, parse_cursor, DEFAULT_PAGE_SIZE
+from .search import search_message_ids, search_users
+from .cache import MISSING, user_search_cache
+from .ids import next_message_id
+from . import metrics
 
 class ChatRoomViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     serializer_class = ChatRoomSerializer
     
     def get_queryset(self):
-        return ChatRoom.objects.filter(participants=self.request.user).prefetch_related('participants', 'messages')
+        user = self.request.user
+        unread = RoomMemberState.objects.filter(room=OuterRef('pk'), user=user).values('unread_count')[:1]
+        
+        # Last message id and unread count are read off RoomSummary and the user's
+        # RoomMemberState, so the room list is index lookups for 1 or 500 rooms
+        return ChatRoom.objects.filter(participants=user).annotate(
+            last_message_id=F('summary__last_message_id'),
+            unread_total=Coalesce(Subquery(unread), 0),
+        ).prefetch_related(
+            Prefetch('participants', queryset=User.objects.select_related('chat_status'))
+        )
+    
+    def get_last_messages(self, rooms):
+        # One query for the last message of every room in the page
+        message_ids = [room.last_message_id for room in rooms if room.last_message_id]
+        if not message_ids:
+            return {}
+        return Message.objects.filter(id__in=message_ids).select_related(
+            'sender__chat_status'
+        ).in_bulk()
+    
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        rooms = list(page if page is not None else queryset)
+        last_messages = self.get_last_messages(rooms)
+        # read_by only shows on each room's last message, so only its readers are loaded
+        read_states = RoomMemberState.readers_of({room.id: room.last_message_id or 0 for room in rooms})
+        
+        if wants_compact(request):
+            compact = CompactSerializer(read_states, last_messages)
+            data = compact.rooms(rooms)
+            response = self.get_paginated_response(data) if page is not None else Response({'results': data})
+            response.data['users'] = compact.users
+            return response
+        
+        context = self.get_serializer_context()
+        context['last_messages'] = last_messages
+        context['read_states'] = read_states
+        serializer = self.get_serializer_class()(rooms, many=True, context=context)
+        
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
+    
+    def retrieve(self, request, *args, **kwargs):
+        room = self.get_object()
+        context = self.get_serializer_context()
+        context['last_messages'] = self.get_last_messages([room])
+        context['read_states'] = RoomMemberState.readers_of({room.id: room.last_message_id or 0})
+        return Response(self.get_serializer_class()(room, context=context).data)
     
     def create(self, request):
         serializer = CreateRoomSerializer(data=request.data)
         if serializer.is_valid():
-            room = ChatRoom.objects.create(
-                name=serializer.validated_data['name'],
-                room_type=serializer.validated_data['room_type'],
-                created_by=request.user
-            )
+            # Creator first, then the requested participants, all checked in one query
+            participant_ids = parse_user_ids([request.user.id] + serializer.validated_data.get('participant_ids', []))
+            users = existing_users(participant_ids)
+            unknown = [user_id for user_id in participant_ids if user_id not in users]
+            if unknown:
+                return Response({'error': 'Users not found', 'user_ids': unknown}, status=status.HTTP_400_BAD_REQUEST)
             
-            # Add creator as participant
-            room.participants.add(request.user)
-            
-            # Add other participants if provided
-            participant_ids = serializer.validated_data.get('participant_ids', [])
-            if participant_ids:
-                room.participants.add(*participant_ids)
+            with transaction.atomic():
+                room = ChatRoom.objects.create(
+                    name=serializer.validated_data['name'],
+                    room_type=serializer.validated_data['room_type'],
+                    created_by=request.user
+                )
+                add_members(room, users)
             
             return Response(ChatRoomSerializer(room, context={'request': request}).data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -37,44 +103,71 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'])
     def add_participant(self, request, pk=None):
         room = self.get_object()
-        user_id = request.data.get('user_id')
-        
-        try:
-            from django.contrib.auth import get_user_model
-            User = get_user_model()
-            user = User.objects.get(id=user_id)
-            room.participants.add(user)
-            return Response({'status': 'participant added'})
-        except User.DoesNotExist:
+        users = existing_users(parse_user_ids([request.data.get('user_id')]))
+        if not users:
             return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+        notify_membership(room.id, add_members(room, users), [])
+        return Response({'status': 'participant added'})
+    
+    @action(detail=True, methods=['post'])
+    def members(self, request, pk=None):
+        """Bulk membership change: {"add": [user ids], "remove": [user ids]}.
+        
+        Anyone in the room can add people; removing anyone but yourself takes the
+        room's creator or an admin. Connected sockets get one `membership` frame.
+        """
+        room = self.get_object()
+        serializer = MembershipSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        add_ids = parse_user_ids(serializer.validated_data.get('add'))
+        remove_ids = parse_user_ids(serializer.validated_data.get('remove'))
+        if set(add_ids) & set(remove_ids):
+            return Response({'error': 'A user cannot be added and removed at once'}, status=status.HTTP_400_BAD_REQUEST)
+        if any(user_id != request.user.id for user_id in remove_ids) and not self.can_manage_members(room):
+            return Response({'error': 'Only the room creator or an admin can remove members'}, status=status.HTTP_403_FORBIDDEN)
+        
+        users = existing_users(add_ids)
+        with transaction.atomic():
+            added = add_members(room, users)
+            removed = remove_members(room, remove_ids)
+            notify_membership(room.id, added, removed)
+        return Response({
+            'added': list(added),
+            'removed': removed,
+            'not_found': [user_id for user_id in add_ids if user_id not in users],
+        })
+    
+    def can_manage_members(self, room):
+        user = self.request.user
+        return room.created_by_id == user.id or RoomParticipant.objects.filter(
+            room=room, user=user, is_admin=True
+        ).exists()
     
     @action(detail=True, methods=['post']) 
     def leave_room(self, request, pk=None):
         room = self.get_object()
-        room.participants.remove(request.user)
+        notify_membership(room.id, {}, remove_members(room, [request.user.id]))
         return Response({'status': 'left room'})
     
     @action(detail=True, methods=['post'])
     def mark_all_read(self, request, pk=None):
         room = self.get_object()
-        print(room)
         # Verify user is a participant
         if not room.participants.filter(id=request.user.id).exists():
             return Response({'error': 'Not a participant'}, status=status.HTTP_403_FORBIDDEN)
         
-        # Mark all unread messages in this room as read for current user
-        unread_messages = Message.objects.filter(
-            room=room
-        ).exclude(read_by=request.user)
-        print(unread_messages)
-        for message in unread_messages:
-            message.read_by.add(request.user)
+        # Move the user's read cursor to the newest message in the room
+        last_message_id = Message.objects.filter(room=room).order_by('-id').values_list('id', flat=True).first()
+        if last_message_id:
+            RoomMemberState.advance(request.user.id, room.id, last_message_id)
             
         return Response({'status': 'all messages marked as read'})
 
 class MessageViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     serializer_class = MessageSerializer
+    pagination_class = MessageCursorPagination
     
     def get_queryset(self):
         room_id = self.request.query_params.get('room_id')
@@ -82,18 +175,54 @@ class MessageViewSet(viewsets.ModelViewSet):
             return Message.objects.filter(
                 room_id=room_id,
                 room__participants=self.request.user
-            ).select_related('sender').prefetch_related('read_by')
+            ).select_related('sender__chat_status')
         return Message.objects.none()
+    
+    def get_archive_room_id(self):
+        # Pages past the hot messages come from the archive, for members only
+        room_id = parse_cursor(self.request.query_params.get('room_id'), 'room_id')
+        if room_id and RoomParticipant.objects.filter(room_id=room_id, user=self.request.user).exists():
+            return room_id
+        return None
+    
+    def list(self, request, *args, **kwargs):
+        if not wants_compact(request):
+            return super().list(request, *args, **kwargs)
+        # Users are sent once in a side-table instead of nested in every message
+        page = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        compact = CompactSerializer(RoomMemberState.readers_of_page(page))
+        response = self.get_paginated_response(compact.messages(page))
+        response.data['users'] = compact.users
+        return response
      
     def perform_create(self, serializer):
         room_id = self.request.data.get('room_id')
         room = ChatRoom.objects.get(id=room_id, participants=self.request.user)
-        serializer.save(sender=self.request.user, room=room)
+        with transaction.atomic():
+            if settings.CHAT_WRITE_BEHIND:
+                # Keep REST messages on the same snowflake id sequence as the write-behind ones
+                serializer.save(id=next_message_id(), sender=self.request.user, room=room)
+            else:
+                serializer.save(sender=self.request.user, room=room)
+            record_messages([serializer.instance])
+    
+    def perform_update(self, serializer):
+        # Edits can change the last message's preview
+        with transaction.atomic():
+            super().perform_update(serializer)
+            record_edit(serializer.instance)
+    
+    def perform_destroy(self, instance):
+        # delete() clears the instance's id
+        message_id = instance.id
+        with transaction.atomic():
+            instance.delete()
+            record_delete(instance.room_id, message_id, instance.sender_id)
      
     @action(detail=True, methods=['post'])
     def mark_read(self, request, pk=None):
         message = self.get_object()
-        message.read_by.add(request.user)
+        RoomMemberState.advance(request.user.id, message.room_id, message.id)
         return Response({'status': 'message marked as read'})
     
     
@@ -102,12 +231,47 @@ class MessageViewSet(viewsets.ModelViewSet):
     def unread_count(self, request):
         room_id = request.query_params.get('room_id')
         if room_id:
-            count = Message.objects.filter(
-                room_id=room_id,
-                room__participants=request.user
-            ).exclude(read_by=request.user).count()
-            return Response({'unread_count': count})
+            if not ChatRoom.objects.filter(id=room_id, participants=request.user).exists():
+                return Response({'unread_count': 0})
+            return Response({'unread_count': RoomMemberState.unread(request.user.id, room_id)})
         return Response({'error': 'room_id required'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        # Full-text search over the user's rooms: ?q=, optional room_id, order=rank|recent
+        query = request.query_params.get('q', '')
+        order = request.query_params.get('order', 'rank')
+        if order not in ('rank', 'recent'):
+            return Response({'error': 'order must be rank or recent'}, status=status.HTTP_400_BAD_REQUEST)
+        room_id = parse_cursor(request.query_params.get('room_id'), 'room_id')
+        before = parse_cursor(request.query_params.get('before'), 'before')
+        offset = parse_cursor(request.query_params.get('offset'), 'offset') or 0
+        limit = clamp_page_size(request.query_params.get('limit', DEFAULT_PAGE_SIZE))
+        
+        hits = search_message_ids(request.user.id, query, room_id, order, limit + 1, offset, before)
+        has_more = len(hits) > limit
+        hits = hits[:limit]
+        messages = Message.objects.select_related('sender__chat_status').in_bulk([message_id for message_id, _ in hits])
+        results = []
+        for message_id, rank in hits:
+            message = messages.get(message_id)
+            if message is not None:
+                message.rank = rank
+                results.append(message)
+        
+        context = self.get_serializer_context()
+        context['read_states'] = RoomMemberState.readers_of_page(results)
+        next_page = None
+        if has_more:
+            url = request.build_absolute_uri()
+            if order == 'recent':
+                next_page = replace_query_param(url, 'before', hits[-1][0])
+            else:
+                next_page = replace_query_param(url, 'offset', offset + limit)
+        return Response({
+            'next': next_page,
+            'results': MessageSearchResultSerializer(results, many=True, context=context).data,
+        })
 
 class UserViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = [IsAuthenticated]
@@ -121,8 +285,17 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
     @action(detail=False, methods=['get'])
     def search(self, request):
         query = request.query_params.get('q', '')
-        users = self.get_queryset().filter(
-            Q(username__icontains=query) | Q(email__icontains=query)
-        )[:10]
-        serializer = self.get_serializer(users, many=True)
-        return Response(serializer.data)
\ No newline at end of file
+        # The user picker searches on every keystroke; repeats within the TTL skip the database
+        key = (request.user.id, query.strip().lower())
+        data = user_search_cache.get(key)
+        if data is MISSING:
+            serializer = self.get_serializer(search_users(request.user, query)[:10], many=True)
+            data = serializer.data
+            user_search_cache.set(key, data)
+        return Response(data)
+
+class MetricsView(APIView):
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request):
+        return Response(metrics.snapshot())
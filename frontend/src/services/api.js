@@ -56,8 +56,11 @@ class ApiService {
   }
 
   // Message methods
-  async getMessages(roomId) {
-    return this.request(`/messages/?room_id=${roomId}`); 
+  // Messages are paginated by id: pass { before } for older pages or { after } for newer ones
+  async getMessages(roomId, cursor = {}) {
+    const params = new URLSearchParams({ room_id: roomId, ...cursor });
+    const page = await this.request(`/messages/?${params}`);
+    return page.results;
   }
 
   async sendMessage(roomId, content) { 
@@ -5,15 +5,20 @@ class WebSocketService {
     this.messageHandlers = new Set();
     this.reconnectAttempts = 0;
     this.maxReconnectAttempts = 5;
+    // user_id -> username of the people currently typing, to name them when they stop
+    this.typingUsers = new Map();
   }
 
   connect(roomId, token) {
     if (this.socket) {
       this.disconnect();
     }
+    this.typingUsers.clear();
 
+    // The access token authenticates the socket without a session lookup on the server
+    const query = token ? `?token=${encodeURIComponent(token)}` : '';
     this.socket = new WebSocket(
-      `ws://localhost:8000/ws/chat/${roomId}/`
+      `ws://localhost:8000/ws/chat/${roomId}/${query}`
     );
 
     this.socket.onopen = () => {
@@ -22,8 +27,7 @@ class WebSocketService {
     };
 
     this.socket.onmessage = (event) => {
-      const data = JSON.parse(event.data);
-      this.messageHandlers.forEach(handler => handler(data));
+      this.dispatch(JSON.parse(event.data));
     };
 
     this.socket.onclose = (event) => {
@@ -36,6 +40,39 @@ class WebSocketService {
     };
   }
 
+  dispatch(data) {
+    if (data.type === 'batch') {
+      // A backlog or a busy room's events, coalesced into one frame
+      data.frames.forEach(frame => this.dispatch(frame));
+      return;
+    }
+    if (data.type === 'typing') {
+      // Typing changes arrive as deltas; handlers get one user_typing event per user
+      data.started.forEach(({ user_id, user }) => {
+        this.typingUsers.set(user_id, user);
+        this.emit({ type: 'user_typing', room_id: data.room_id, user_id, user, typing: true });
+      });
+      data.stopped.forEach(user_id => {
+        const user = this.typingUsers.get(user_id);
+        this.typingUsers.delete(user_id);
+        this.emit({ type: 'user_typing', room_id: data.room_id, user_id, user, typing: false });
+      });
+      return;
+    }
+    if (data.type === 'read_receipts') {
+      // Batched cursors: the user has read everything up to and including up_to
+      data.receipts.forEach(({ user_id, user, up_to }) => {
+        this.emit({ type: 'read_receipt', room_id: data.room_id, message_id: up_to, up_to, user_id, user });
+      });
+      return;
+    }
+    this.emit(data);
+  }
+
+  emit(data) {
+    this.messageHandlers.forEach(handler => handler(data));
+  }
+
   attemptReconnect(roomId, token) {
     if (this.reconnectAttempts < this.maxReconnectAttempts) {
       this.reconnectAttempts++;